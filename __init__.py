@@ -4,10 +4,14 @@ This module contains the following sub-modules:
     base - The basic functions for interacting with whisk. Everything is
         imported from base into the main WhiskiWrap namespace.
     tests - Benchmarks for running whiski
+    test_units - small tests that need neither whisk nor any video, run
+        with `python -m unittest WhiskiWrap.test_units`
     utils - utility functions for dealing with files and programs on the
         system
     video_utils - functions for dealing with video files, usually via
         system calls to ffmpeg
+    whisker_io - functions for reading whisk output files with numpy
+    spool - tracing on other computers through a shared spool directory
 
 To read Photonfocus double-rate files, you need to install libpfdoublerate
 This requires libboost_thread 1.50 to be installed to /usr/local/lib
@@ -37,5 +41,7 @@ import base
 import tests
 #import video_utils
 import utils
+import whisker_io
 reload(base)
+import spool
 from base import *
\ No newline at end of file
@@ -6,7 +6,14 @@ The overall algorithm is contained in `interleaved_reading_and_tracing`.
   as uncompressed tiff stacks.
 * Trace is called in parallel on each tiff stack
 * Additional chunks are read as trace completes.
-* At the end, all of the HDF5 files are stitched together.
+* Each chunk is parsed by the worker that traced it, and stitched into 
+  the HDF5 file as soon as it and all earlier chunks are traced.
+
+The whiskers files of a previous run can be stitched again in parallel with
+`rebuild_hdf5_from_whiskers_directory`.
+
+Several sessions can be traced by one shared pool of workers with
+`interleaved_batch_tracing`.
 
 The previous function `pipeline_trace` is now deprecated.
 """
@@ -25,9 +32,12 @@ try:
     from whisk.python.traj import MeasurementsTable
 except ImportError:
     print "cannot import whisk"
+    trace = None
+    MeasurementsTable = None
 import pandas
 import WhiskiWrap
 from WhiskiWrap import video_utils
+from WhiskiWrap import whisker_io
 import my
 import scipy.io
 import ctypes
@@ -35,6 +45,15 @@ import glob
 import time
 import shutil
 import itertools
+import struct
+import tempfile
+import json
+import hashlib
+import threading
+import Queue
+import signal
+import traceback
+import errno
 
 # Find the repo directory and the default param files
 # The banks don't differe with sensitive or default
@@ -47,6 +66,9 @@ LINE_DB_FILE = os.path.join(DIRECTORY, 'line.detectorbank')
 # libpfDoubleRate library, needed for PFReader
 LIB_DOUBLERATE = os.path.join(DIRECTORY, 'libpfDoubleRate.so')
 
+# trace fails on tiff stacks with this many frames
+TRACE_UNSAFE_CHUNK_LENGTHS = (3, 4)
+
 def copy_parameters_files(target_directory, sensitive=False):
     """Copies in parameters and banks"""
     if sensitive:
@@ -90,161 +112,371 @@ class WhiskerSeg_measure(tables.IsDescription):
 def write_chunk(chunk, chunkname, directory='.'):
     tifffile.imsave(os.path.join(directory, chunkname), chunk, compress=0)
 
-def trace_chunk(video_filename, delete_when_done=False):
+def _die_with_parent():
+    """Ask Linux to kill this process when its parent dies
+    
+    This runs in the child process of trace or measure, so that they do not
+    outlive a pool worker that is terminated. It does nothing elsewhere.
+    """
+    try:
+        # 1 is PR_SET_PDEATHSIG
+        ctypes.CDLL('libc.so.6').prctl(1, signal.SIGKILL)
+    except Exception:
+        pass
+
+def _run_command(command, run_dir, timeout=None):
+    """Run command in run_dir and wait for it to finish
+    
+    timeout : if not None, the command is killed after this many seconds,
+        and IOError is raised
+    
+    Returns:
+        stdout, stderr
+    """
+    pipe = subprocess.Popen(command,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=run_dir,
+        preexec_fn=_die_with_parent,
+        close_fds=True,
+        )
+    
+    # Kill the command from a timer thread if it takes too long
+    timed_out = []
+    def kill():
+        timed_out.append(True)
+        try:
+            pipe.kill()
+        except OSError:
+            pass
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+    try:
+        stdout, stderr = pipe.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+    
+    if timed_out:
+        raise IOError("%s timed out after %r s" % (command[0], timeout))
+    return stdout, stderr
+
+def _attempt_filename(filename, attempt):
+    """Where attempt number `attempt` writes `filename`
+    
+    Each attempt writes to its own file, and then renames it to filename,
+    so that a straggler or a killed attempt never leaves a partial file 
+    where the result of another attempt is being read.
+    """
+    if attempt is None:
+        return filename
+    
+    # Keep the extension, which trace and measure use to choose the format
+    root, ext = os.path.splitext(filename)
+    return root + '.attempt%d' % attempt + ext
+
+def _remove_attempt_files(filename_pairs):
+    """Remove what a failed attempt wrote, if it wrote anything
+    
+    filename_pairs : list of (attempt_filename, filename)
+        The attempt files are removed, unless they are the final files
+    """
+    for attempt_filename, filename in filename_pairs:
+        if attempt_filename == filename:
+            continue
+        try:
+            os.remove(attempt_filename)
+        except OSError:
+            pass
+
+def _keep_attempt_files(filename_pairs):
+    """Rename the files of a finished attempt to their final names
+    
+    filename_pairs : list of (attempt_filename, filename)
+    
+    If the first final file already exists, another attempt of the same
+    chunk finished first, and its files may already have been read, so
+    the files of this attempt are removed instead.
+    
+    Returns: whether the files of this attempt were kept
+    """
+    filename_pairs = [(attempt_filename, filename) 
+        for attempt_filename, filename in filename_pairs
+        if attempt_filename != filename]
+    if len(filename_pairs) == 0:
+        return True
+    
+    # Unlike rename, link fails if the final file already exists, so only
+    # one attempt can win even if they finish at the same time
+    attempt_filename, filename = filename_pairs[0]
+    try:
+        os.link(attempt_filename, filename)
+    except OSError as e:
+        if e.errno == errno.EEXIST:
+            _remove_attempt_files(filename_pairs)
+            return False
+        
+        # The filesystem does not support links
+        if os.path.exists(filename):
+            _remove_attempt_files(filename_pairs)
+            return False
+        os.rename(attempt_filename, filename)
+    else:
+        os.remove(attempt_filename)
+    
+    for attempt_filename, filename in filename_pairs[1:]:
+        os.rename(attempt_filename, filename)
+    return True
+
+def trace_chunk(video_filename, delete_when_done=False, timeout=None,
+    attempt=None):
     """Run trace on an input file
     
     First we create a whiskers filename from `video_filename`, which is
     the same file with '.whiskers' replacing the extension. Then we run
-    trace using subprocess.
+    trace using subprocess, in the directory of `video_filename`.
     
-    Care is taken to move into the working directory during trace, and then
-    back to the original directory.
+    timeout : if not None, trace is killed after this many seconds and
+        IOError is raised
+    attempt : if not None, trace writes to a file named after the attempt,
+        which is then renamed to the whiskers file. This is how 
+        RetryingPool runs several attempts of the same chunk. The file is
+        removed if the attempt fails, or if another attempt already 
+        wrote the whiskers file.
     
-    Returns:
-        stdout, stderr
+    Returns: dict
+        video_filename, stdout, stderr
+        duration : how long it took, in seconds
     """
     print "Starting", video_filename
-    orig_dir = os.getcwd()
+    start_time = time.time()
     run_dir, raw_video_filename = os.path.split(os.path.abspath(video_filename))
-    whiskers_file = WhiskiWrap.utils.FileNamer.from_video(video_filename).whiskers
-    command = ['trace', raw_video_filename, whiskers_file]
+    whiskers_file = os.path.abspath(
+        WhiskiWrap.utils.FileNamer.from_video(video_filename).whiskers)
+    attempt_whiskers_file = _attempt_filename(whiskers_file, attempt)
+    filename_pairs = [(attempt_whiskers_file, whiskers_file)]
+    command = ['trace', raw_video_filename, attempt_whiskers_file]
 
-    os.chdir(run_dir)
     try:
-        pipe = subprocess.Popen(command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            )
-        stdout, stderr = pipe.communicate()  
+        stdout, stderr = _run_command(command, run_dir, timeout=timeout)
+        print "Done", video_filename
+        
+        if not os.path.exists(attempt_whiskers_file):
+            print raw_video_filename
+            raise IOError("tracing seems to have failed")
     except:
+        _remove_attempt_files(filename_pairs)
         raise
-    finally:
-        os.chdir(orig_dir)
-    print "Done", video_filename
-    
-    if not os.path.exists(whiskers_file):
-        print raw_video_filename
-        raise IOError("tracing seems to have failed")
+    _keep_attempt_files(filename_pairs)
 
     if delete_when_done:
         os.remove(video_filename)
     
-    return {'video_filename': video_filename, 'stdout': stdout, 'stderr': stderr}
+    return {'video_filename': video_filename, 'stdout': stdout, 'stderr': stderr,
+        'duration': time.time() - start_time}
 
-def measure_chunk(whiskers_filename, face, delete_when_done=False):
+def measure_chunk(whiskers_filename, face, delete_when_done=False,
+    timeout=None, attempt=None):
     """Run measure on an input file
     
     First we create a measurement filename from `whiskers_filename`, which is
     the same file with '.measurements' replacing the extension. Then we run
-    trace using subprocess.
+    measure using subprocess, in the directory of `whiskers_filename`.
     
-    Care is taken to move into the working directory during trace, and then
-    back to the original directory.
+    timeout, attempt : as in trace_chunk
     
     Returns:
         stdout, stderr
     """
     print "Starting", whiskers_filename
-    orig_dir = os.getcwd()
     run_dir, raw_whiskers_filename = os.path.split(os.path.abspath(whiskers_filename))
-    measurements_file = WhiskiWrap.utils.FileNamer.from_whiskers(whiskers_filename).measurements
-    command = ['measure', '--face', face, raw_whiskers_filename, measurements_file]
+    measurements_file = os.path.abspath(
+        WhiskiWrap.utils.FileNamer.from_whiskers(whiskers_filename).measurements)
+    attempt_measurements_file = _attempt_filename(measurements_file, attempt)
+    filename_pairs = [(attempt_measurements_file, measurements_file)]
+    command = ['measure', '--face', face, raw_whiskers_filename, 
+        attempt_measurements_file]
 
-    os.chdir(run_dir)
     try:
-        pipe = subprocess.Popen(command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            )
-        stdout, stderr = pipe.communicate()  
+        stdout, stderr = _run_command(command, run_dir, timeout=timeout)
+        print "Done", whiskers_filename
+        
+        if not os.path.exists(attempt_measurements_file):
+            print raw_whiskers_filename
+            raise IOError("measurement seems to have failed")
     except:
+        _remove_attempt_files(filename_pairs)
         raise
-    finally:
-        os.chdir(orig_dir)
-    print "Done", whiskers_filename
-    
-    if not os.path.exists(measurements_file):
-        print raw_whiskers_filename
-        raise IOError("measurement seems to have failed")
+    _keep_attempt_files(filename_pairs)
 
     if delete_when_done:
         os.remove(whiskers_filename)
     
     return {'whiskers_filename': whiskers_filename, 'stdout': stdout, 'stderr': stderr}
 
-def trace_and_measure_chunk(video_filename, delete_when_done=False, face='right'):
-    """Run trace on an input file
+def trace_and_measure_chunk(video_filename, delete_when_done=False, face='right',
+    timeout=None, attempt=None):
+    """Run trace and then measure on an input file
     
     First we create a whiskers filename from `video_filename`, which is
     the same file with '.whiskers' replacing the extension. Then we run
-    trace using subprocess.
+    trace and measure using subprocess, in the directory of `video_filename`.
     
-    Care is taken to move into the working directory during trace, and then
-    back to the original directory.
+    timeout : if not None, trace and measure are each killed after this 
+        many seconds and IOError is raised
+    attempt : as in trace_chunk. Both output files are renamed only after
+        measure has finished, or both are removed.
     
-    Returns:
-        stdout, stderr
+    Returns: dict
+        video_filename, stdout, stderr
+        duration : how long it took, in seconds
     """
     print "Starting", video_filename
+    start_time = time.time()
     
-    orig_dir = os.getcwd()
     run_dir, raw_video_filename = os.path.split(os.path.abspath(video_filename))
+    fn = WhiskiWrap.utils.FileNamer.from_video(video_filename)
 
-    # Run trace:
-    whiskers_file = WhiskiWrap.utils.FileNamer.from_video(video_filename).whiskers
-    trace_command = ['trace', raw_video_filename, whiskers_file]
-
-    os.chdir(run_dir)
-    try:
-        trace_pipe = subprocess.Popen(trace_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            )
-        stdout, stderr = trace_pipe.communicate()  
-    except:
-        raise
-    finally:
-        os.chdir(orig_dir)
-    print "Done", video_filename
+    whiskers_file = os.path.abspath(fn.whiskers)
+    attempt_whiskers_file = _attempt_filename(whiskers_file, attempt)
+    measurements_file = os.path.abspath(fn.measurements)
+    attempt_measurements_file = _attempt_filename(measurements_file, attempt)
+    filename_pairs = [(attempt_whiskers_file, whiskers_file),
+        (attempt_measurements_file, measurements_file)]
     
-    if not os.path.exists(whiskers_file):
-        print raw_video_filename
-        raise IOError("tracing seems to have failed")
+    try:
+        # Run trace:
+        trace_command = ['trace', raw_video_filename, attempt_whiskers_file]
+
+        stdout, stderr = _run_command(trace_command, run_dir, 
+            timeout=timeout)
+        print "Done", video_filename
+        
+        if not os.path.exists(attempt_whiskers_file):
+            print raw_video_filename
+            raise IOError("tracing seems to have failed")
 
-    # Run measure:
-    measurements_file = WhiskiWrap.utils.FileNamer.from_video(video_filename).measurements
-    measure_command = ['measure', '--face', face, whiskers_file, measurements_file]
+        # Run measure:
+        measure_command = ['measure', '--face', face, attempt_whiskers_file, 
+            attempt_measurements_file]
 
-    os.chdir(run_dir)
-    try:
-        measure_pipe = subprocess.Popen(measure_command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            )
-        stdout, stderr = measure_pipe.communicate()  
+        stdout, stderr = _run_command(measure_command, run_dir, 
+            timeout=timeout)
+        print "Done", whiskers_file
+        
+        if not os.path.exists(attempt_measurements_file):
+            print whiskers_file
+            raise IOError("measuring seems to have failed")
     except:
+        _remove_attempt_files(filename_pairs)
         raise
-    finally:
-        os.chdir(orig_dir)
-    print "Done", whiskers_file
-    
-    if not os.path.exists(measurements_file):
-        print whiskers_file
-        raise IOError("measuring seems to have failed")
 
     # Clean up:    
+    _keep_attempt_files(filename_pairs)
     if delete_when_done:
         os.remove(video_filename)
    
-    return {'video_filename': video_filename,'stdout': stdout, 'stderr': stderr}
+    return {'video_filename': video_filename,'stdout': stdout, 'stderr': stderr,
+        'duration': time.time() - start_time}
+
 
+def trace_and_parse_chunk(video_filename, delete_when_done=False, 
+    measure=False, face='right', timeout=None, chunk_start=0, dtype=None,
+    roi_offset=None, attempt=None):
+    """Trace (and optionally measure) an input file, then parse the result
+    
+    This lets the trace workers also do the slow part of stitching, so 
+    that the stitcher only has to write.
+    
+    timeout, attempt : as in trace_chunk
+    chunk_start, dtype, roi_offset : passed to parse_chunk_to_arrays.
+        The dtype should be that of the /summary table. It defaults to 
+        WhiskerSeg_measure if measure, else WhiskerSeg, as in a file set
+        up with pixel_layout 'vlarray'.
+    
+    Returns: the result of trace_chunk or trace_and_measure_chunk, with
+        the result of parse_chunk_to_arrays added as 'parsed', and 
+        parsing included in 'duration'
+    """
+    start_time = time.time()
+    fn = WhiskiWrap.utils.FileNamer.from_video(video_filename)
+    if measure:
+        result = trace_and_measure_chunk(video_filename, 
+            delete_when_done=delete_when_done, face=face, timeout=timeout,
+            attempt=attempt)
+        if dtype is None:
+            dtype = tables.description.dtype_from_descr(WhiskerSeg_measure)
+        result['parsed'] = parse_chunk_to_arrays(fn.whiskers, chunk_start,
+            dtype, fn.measurements, roi_offset)
+    else:
+        result = trace_chunk(video_filename, 
+            delete_when_done=delete_when_done, timeout=timeout, 
+            attempt=attempt)
+        if dtype is None:
+            dtype = tables.description.dtype_from_descr(WhiskerSeg)
+        result['parsed'] = parse_chunk_to_arrays(fn.whiskers, chunk_start,
+            dtype, roi_offset=roi_offset)
+    result['duration'] = time.time() - start_time
+    return result
 
 def sham_trace_chunk(video_filename):
     print "sham tracing", video_filename
     time.sleep(2)
     return video_filename
 
-def setup_hdf5(h5_filename, expectedrows, measure=False):
+# PyTables is not thread safe, so threads that can access HDF5 files at
+# the same time, like the stitchers of interleaved_batch_tracing, hold 
+# this while they do
+HDF5_LOCK = threading.RLock()
+
+# Typical number of pixels in a whisker segment, to size the flat arrays
+EXPECTED_PIXELS_PER_SEGMENT = 100
+
+def setup_hdf5(h5_filename, expectedrows, measure=False, 
+    pixel_layout='vlarray', complib='zlib', complevel=0, shuffle=True,
+    chunkshape=None, pixels_chunkshape=None):
+    """Create an empty HDF5 file to stitch whiskers into
+    
+    h5_filename : file to create, overwriting it if it exists
+    expectedrows : expected number of whisker segments
+    measure : if True, the summary table has the measurement columns
+    pixel_layout : how to store the pixels of each segment
+        'vlarray' : /pixels_x and /pixels_y are VLArrays with one row of
+            pixels per row of /summary
+        'flat' : /pixels_x and /pixels_y are flat EArrays with the pixels
+            of every segment one after another, and /summary has a 
+            pixel_offset column. Segment i is 
+            pixels_x[pixel_offset[i]:pixel_offset[i] + pixlen[i]]
+            This is much faster to write and to read in bulk, see 
+            read_pixels.
+    The layout is stored as the pixel_layout attribute of the root.
+    complib : compression library for every array, as named by PyTables,
+        e.g. 'zlib', 'blosc', 'blosc:lz4', 'blosc:zstd'. Only used if
+        complevel > 0.
+    complevel : compression level from 0 (no compression) to 9
+    shuffle : whether to byte-shuffle before compressing, which usually
+        helps the float columns and pixels compress
+    chunkshape : rows of /summary per HDF5 chunk, or None to let PyTables
+        choose from expectedrows. Each chunk is read and decompressed as
+        a whole, so this is the smallest unit of a partial read.
+    pixels_chunkshape : rows (for 'vlarray') or pixels (for 'flat') of
+        /pixels_x and /pixels_y per HDF5 chunk, or None to let PyTables 
+        choose
+    
+    See tests.run_hdf5_storage_benchmark to compare these settings.
+    """
+    if pixel_layout not in ['vlarray', 'flat']:
+        raise ValueError("unknown pixel_layout: %r" % pixel_layout)
+    
+    # This raises ValueError on an unknown complib
+    filters = tables.Filters(complevel=complevel, complib=complib,
+        shuffle=shuffle)
+    if chunkshape is not None:
+        chunkshape = (chunkshape,)
+    if pixels_chunkshape is not None:
+        pixels_chunkshape = (pixels_chunkshape,)
 
     # Open file
     h5file = tables.open_file(h5_filename, mode="w")    
@@ -254,26 +486,163 @@ def setup_hdf5(h5_filename, expectedrows, measure=False):
     elif measure:
         WhiskerDescription = WhiskerSeg_measure
     
+    # Index into the flat pixel arrays
+    if pixel_layout == 'flat':
+        WhiskerDescription = WhiskerDescription.columns.copy()
+        WhiskerDescription['pixel_offset'] = tables.UInt64Col()
+    
     # A group for the normal data
     table = h5file.create_table(h5file.root, "summary", WhiskerDescription, 
         "Summary data about each whisker segment",
-        expectedrows=expectedrows)
+        filters=filters, expectedrows=expectedrows, chunkshape=chunkshape)
 
     # Put the contour here
-    xpixels_vlarray = h5file.create_vlarray(
-        h5file.root, 'pixels_x', 
-        tables.Float32Atom(shape=()),
-        title='Every pixel of each whisker (x-coordinate)',
-        expectedrows=expectedrows)
-    ypixels_vlarray = h5file.create_vlarray(
-        h5file.root, 'pixels_y', 
-        tables.Float32Atom(shape=()),
-        title='Every pixel of each whisker (y-coordinate)',
-        expectedrows=expectedrows)
+    if pixel_layout == 'vlarray':
+        xpixels_vlarray = h5file.create_vlarray(
+            h5file.root, 'pixels_x', 
+            tables.Float32Atom(shape=()),
+            title='Every pixel of each whisker (x-coordinate)',
+            filters=filters, expectedrows=expectedrows, 
+            chunkshape=pixels_chunkshape)
+        ypixels_vlarray = h5file.create_vlarray(
+            h5file.root, 'pixels_y', 
+            tables.Float32Atom(shape=()),
+            title='Every pixel of each whisker (y-coordinate)',
+            filters=filters, expectedrows=expectedrows, 
+            chunkshape=pixels_chunkshape)
+    else:
+        for coord in ['x', 'y']:
+            h5file.create_earray(
+                h5file.root, 'pixels_' + coord,
+                tables.Float32Atom(), shape=(0,),
+                title='Every pixel of every whisker, concatenated '
+                    '(%s-coordinate)' % coord,
+                filters=filters, 
+                expectedrows=expectedrows * EXPECTED_PIXELS_PER_SEGMENT,
+                chunkshape=pixels_chunkshape)
+    
+    h5file.root._v_attrs.pixel_layout = pixel_layout
     
     h5file.close()
+
+def index_hdf5(h5_filename):
+    """Index the summary table of an HDF5 file by frame and whisker
+    
+    This creates PyTables indexes on the time and id columns of /summary,
+    and the /frame_row_offsets array, which is used by 
+    query_whiskers_hdf5_summary to read the rows of a range of frames.
+    Rows of frame f are frame_row_offsets[f]:frame_row_offsets[f + 1].
+    
+    The indexes are updated by PyTables as rows are appended, but 
+    /frame_row_offsets is not. So call this again after appending, 
+    which HDF5Stitcher does when it is closed.
+    """
+    with tables.open_file(h5_filename, mode='a') as h5file:
+        table = h5file.get_node('/summary')
+        for column in [table.cols.time, table.cols.id]:
+            if not column.is_indexed:
+                column.create_index()
+        
+        # Replace the frame offsets
+        if '/frame_row_offsets' in h5file:
+            h5file.remove_node('/frame_row_offsets')
+        
+        # This requires the rows to be in order of frame, as stitched
+        times = table.col('time').astype(np.int64)
+        if np.any(np.diff(times) < 0):
+            print "warning: %s is not sorted by frame" % h5_filename
+            return
+        n_frames = times[-1] + 1 if len(times) > 0 else 0
+        frame_row_offsets = np.searchsorted(times, 
+            np.arange(n_frames + 1)).astype(np.uint64)
+        
+        offsets_array = h5file.create_array(h5file.root, 
+            'frame_row_offsets', frame_row_offsets,
+            title='First row of /summary in each frame')
+        offsets_array._v_attrs.summary_nrows = table.nrows
+
+def get_frame_row_offsets(h5file):
+    """Returns /frame_row_offsets of an open HDF5 file
+    
+    Returns None if it does not exist, or if rows were appended to
+    /summary after it was created. See index_hdf5.
+    """
+    if '/frame_row_offsets' not in h5file:
+        return None
+    offsets_array = h5file.get_node('/frame_row_offsets')
+    nrows = h5file.get_node('/summary').nrows
+    if getattr(offsets_array._v_attrs, 'summary_nrows', None) != nrows:
+        return None
+    return offsets_array.read().astype(np.int64)
+
+def get_pixel_layout(h5file):
+    """Returns the pixel layout of an open HDF5 file: 'vlarray' or 'flat'
+    
+    Files written before the layout was stored are 'vlarray'.
+    """
+    return getattr(h5file.root._v_attrs, 'pixel_layout', 'vlarray')
+
+def read_pixels(h5_filename, rows=None):
+    """Read the pixels of some whisker segments from an HDF5 file
+    
+    h5_filename : HDF5 file written by append_whiskers_to_hdf5, with
+        either pixel layout
+    rows : indices into /summary, or None to read every segment
+    
+    With the flat layout, the requested segments are grouped into runs 
+    that are contiguous in the file, and each run is read at once.
+    
+    Returns: pixels_x, pixels_y
+        Lists of arrays, with the coordinates of each requested segment
+    """
+    with tables.open_file(h5_filename) as h5file:
+        xpixels = h5file.get_node('/pixels_x')
+        ypixels = h5file.get_node('/pixels_y')
+        
+        if get_pixel_layout(h5file) == 'vlarray':
+            if rows is None:
+                return xpixels.read(), ypixels.read()
+            return ([xpixels[row] for row in rows], 
+                [ypixels[row] for row in rows])
+        
+        # Find where each segment is
+        # Offsets increase with row, so sorted rows are sorted in the file
+        table = h5file.get_node('/summary')
+        if rows is None:
+            offsets = table.col('pixel_offset').astype(np.int64)
+            pixlens = table.col('pixlen').astype(np.int64)
+        else:
+            rows, inverse = np.unique(np.asarray(rows, dtype=np.int64), 
+                return_inverse=True)
+            if len(rows) == 0:
+                return [], []
+            segs = table.read_coordinates(rows)
+            offsets = segs['pixel_offset'].astype(np.int64)
+            pixlens = segs['pixlen'].astype(np.int64)
+        if len(offsets) == 0:
+            return [], []
+        
+        # Group the segments into runs that are contiguous in the file
+        stops = offsets + pixlens
+        run_edges = np.concatenate([[0],
+            np.flatnonzero(offsets[1:] != stops[:-1]) + 1, [len(offsets)]])
+        
+        # Read each run, and split it into segments
+        pixels_x, pixels_y = [], []
+        for first, last in zip(run_edges[:-1], run_edges[1:]):
+            run_start, run_stop = offsets[first], stops[last - 1]
+            split_at = stops[first:last - 1] - run_start
+            pixels_x += np.split(xpixels[run_start:run_stop], split_at)
+            pixels_y += np.split(ypixels[run_start:run_stop], split_at)
+    
+    # Put them back in the requested order
+    if rows is not None:
+        pixels_x = [pixels_x[idx] for idx in inverse]
+        pixels_y = [pixels_y[idx] for idx in inverse]
+    return pixels_x, pixels_y
     
-def append_whiskers_to_hdf5(whisk_filename, h5_filename, chunk_start, measurements_filename=None):
+def append_whiskers_to_hdf5(whisk_filename, h5_filename, chunk_start, 
+    measurements_filename=None, roi_offset=None):
     """Load data from whisk_file and put it into an hdf5 file
     
     The HDF5 file will have two basic components:
@@ -283,75 +652,541 @@ def append_whiskers_to_hdf5(whisk_filename, h5_filename, chunk_start, measuremen
         /pixels_x : A vlarray of the same length as summary but with the
             entire array of x-coordinates of each segment.
         /pixels_y : Same but for y-coordinates
+    If the file was set up with pixel_layout='flat', /pixels_x and 
+    /pixels_y instead hold the pixels of every segment one after another,
+    starting at the pixel_offset column of summary. See setup_hdf5.
+    
+    roi_offset : (x, y) offset of the traced frames in the full frame,
+        if they were cropped while reading (see FFmpegReader.roi_offset).
+        This is added to all of the coordinates, so that the HDF5 file
+        is always in full-frame coordinates.
     """
-    ## Load it, so we know what expectedrows is
-    # This loads all whisker info into C data types
-    # wv is like an array of trace.LP_cWhisker_Seg
-    # Each entry is a trace.cWhisker_Seg and can be converted to
-    # a python object via: wseg = trace.Whisker_Seg(wv[idx])
-    # The python object responds to .time and .id (integers) and .x and .y (numpy
-    # float arrays).
-    #wv, nwhisk = trace.Debug_Load_Whiskers(whisk_filename)
-    print whisk_filename
+    # Open file
+    h5file = tables.open_file(h5_filename, mode="a")
+    try:
+        _append_whiskers_to_open_hdf5(h5file, whisk_filename, chunk_start,
+            measurements_filename=measurements_filename, 
+            roi_offset=roi_offset)
+    finally:
+        h5file.close()
+
+def load_whisker_segments(whisk_filename):
+    """Load a .whiskers file as whisker_io.WhiskerSegments
+    
+    The file is parsed with numpy by whisker_io.read_whiskers. If it is
+    not in the binary format that trace writes, it is loaded with whisk's
+    trace.Load_Whiskers instead, which raises ImportError if whisk is 
+    not installed. A truncated file raises IOError.
+    """
+    try:
+        return whisker_io.read_whiskers(whisk_filename)
+    except whisker_io.FormatError as error:
+        if trace is None:
+            raise ImportError("%s, and whisk is needed to load it" % error)
+        print "loading %s with whisk" % whisk_filename
+        return whisker_io.WhiskerSegments.from_whisk_dict(
+            trace.Load_Whiskers(whisk_filename))
+
+def load_measurements(measurements_filename):
+    """Load a .measurements file as an array of measurements
+    
+    The file is parsed with numpy by whisker_io.read_measurements. If it
+    is not in the binary format that measure writes, it is loaded with 
+    whisk's MeasurementsTable instead, which raises ImportError if whisk
+    is not installed. A truncated file raises IOError.
     
-    whiskers = trace.Load_Whiskers(whisk_filename)
-    nwhisk = np.sum(map(len, whiskers.values()))
+    Returns: array of whisker_io.MEASUREMENTS_DTYPE
+    """
+    try:
+        return whisker_io.read_measurements(measurements_filename)
+    except whisker_io.FormatError as error:
+        if MeasurementsTable is None:
+            raise ImportError("%s, and whisk is needed to load it" % error)
+        print "loading %s with whisk" % measurements_filename
+        return whisker_io.measurements_from_table_array(
+            MeasurementsTable(str(measurements_filename)).asarray())
+
+def whiskers_to_arrays(whiskers, chunk_start, dtype, measurements=None,
+    roi_offset=None):
+    """Convert the whiskers of one chunk into arrays ready to append
+    
+    whiskers : whisker_io.WhiskerSegments of the chunk
+    chunk_start : frame number of the first frame in the chunk, which is
+        added to the time of each segment
+    dtype : dtype of the summary table, like WhiskerSeg or 
+        WhiskerSeg_measure
+    measurements : array of whisker_io.MEASUREMENTS_DTYPE, as returned
+        by load_measurements, or None. Each segment is joined to the row
+        with the same frame and whisker id, so the order does not matter.
+    roi_offset : added to all coordinates, see append_whiskers_to_hdf5
+    
+    Returns: summary, pixels_x, pixels_y
+        summary : structured array of dtype, one row per segment
+            If dtype has a pixel_offset column, it is the offset of each
+            segment in pixels_x and pixels_y.
+        pixels_x, pixels_y : arrays of the coordinates of every segment,
+            one after another. summary['pixlen'] is the length of each.
+    """
+    if roi_offset is None:
+        roi_offset = (0, 0)
+    x_offset, y_offset = roi_offset
+    
+    summary = np.zeros(len(whiskers), dtype=dtype)
+    if len(whiskers) == 0:
+        return summary, np.array([]), np.array([])
+    
+    # All the pixels, in full-frame coordinates
+    all_x = whiskers.x + x_offset
+    all_y = whiskers.y + y_offset
+    
+    # The first and last pixel of each segment
+    starts = whiskers.offsets
+    stops = starts + whiskers.pixlen
+    
+    summary['chunk_start'] = chunk_start
+    summary['time'] = whiskers.time + chunk_start
+    summary['id'] = whiskers.id
+    summary['pixlen'] = whiskers.pixlen
+    if 'pixel_offset' in summary.dtype.names:
+        summary['pixel_offset'] = starts
+    summary['fol_x'] = all_x[starts]
+    summary['fol_y'] = all_y[starts]
+    summary['tip_x'] = all_x[stops - 1]
+    summary['tip_y'] = all_y[stops - 1]
+    
+    if measurements is not None:
+        # This raises ValueError if any segment was not measured
+        measurements = whisker_io.join_measurements(whiskers, measurements)
+        for column in ['length', 'score', 'angle', 'curvature']:
+            summary[column] = measurements[column]
+        summary['fol_x'] = measurements['fol_x'] + x_offset
+        summary['fol_y'] = measurements['fol_y'] + y_offset
+        summary['tip_x'] = measurements['tip_x'] + x_offset
+        summary['tip_y'] = measurements['tip_y'] + y_offset
+    
+    return summary, all_x, all_y
+
+def parse_chunk(whisk_filename, measurements_filename=None):
+    """Load the whiskers, and optionally measurements, of a traced chunk
+    
+    This is the slow part of stitching. It does not touch the HDF5 file,
+    so many chunks can be parsed at once in worker processes, and the
+    results appended by a single writer.
+    
+    Returns: whisker_io.WhiskerSegments, and the measurements array
+        (or None if measurements_filename is None)
+    """
+    print whisk_filename
+    whiskers = load_whisker_segments(whisk_filename)
 
     if measurements_filename is not None:
         print measurements_filename
-        M = MeasurementsTable(str(measurements_filename))
-        measurements = M.asarray()
-        measurements_idx = 0
+        measurements = load_measurements(measurements_filename)
+    else:
+        measurements = None
+    
+    return whiskers, measurements
 
-    # Open file
-    h5file = tables.open_file(h5_filename, mode="a")
+def parse_chunk_to_arrays(whisk_filename, chunk_start, dtype,
+    measurements_filename=None, roi_offset=None):
+    """Parse a traced chunk into the arrays that are appended to HDF5
+    
+    This is parse_chunk followed by whiskers_to_arrays, so that all of the
+    work but writing can be done in a worker process.
+    
+    Returns: summary, pixels_x, pixels_y, see whiskers_to_arrays
+    """
+    whiskers, measurements = parse_chunk(whisk_filename, 
+        measurements_filename)
+    return whiskers_to_arrays(whiskers, chunk_start, dtype, 
+        measurements=measurements, roi_offset=roi_offset)
 
-    ## Iterate over rows and store
-    table = h5file.get_node('/summary')
-    h5seg = table.row
-    xpixels_vlarray = h5file.get_node('/pixels_x')
-    ypixels_vlarray = h5file.get_node('/pixels_y')
-    for frame, frame_whiskers in whiskers.iteritems():
-        for whisker_id, wseg in frame_whiskers.iteritems():
-            # Write to the table
-            h5seg['chunk_start'] = chunk_start
-            h5seg['time'] = wseg.time + chunk_start
-            h5seg['id'] = wseg.id
-            h5seg['fol_x'] = wseg.x[0]
-            h5seg['fol_y'] = wseg.y[0]
-            h5seg['tip_x'] = wseg.x[-1]
-            h5seg['tip_y'] = wseg.y[-1]
-
-            if measurements_filename is not None:
-                h5seg['length'] = measurements[measurements_idx][3]
-                h5seg['score'] = measurements[measurements_idx][4]
-                h5seg['angle'] = measurements[measurements_idx][5]
-                h5seg['curvature'] = measurements[measurements_idx][6]
-                h5seg['pixlen'] = len(wseg.x)
-                h5seg['fol_x'] = measurements[measurements_idx][7] 
-                h5seg['fol_y'] = measurements[measurements_idx][8]
-                h5seg['tip_x'] = measurements[measurements_idx][9]
-                h5seg['tip_y'] = measurements[measurements_idx][10]
-
-
-                measurements_idx += 1
-           
-            assert len(wseg.x) == len(wseg.y)
-            h5seg.append()
-            
-            # Write x
-            xpixels_vlarray.append(wseg.x)
-            ypixels_vlarray.append(wseg.y)
+def _append_whiskers_to_open_hdf5(h5file, whisk_filename, chunk_start, 
+    measurements_filename=None, roi_offset=None):
+    """Append whiskers to an HDF5 file that is already open
+    
+    See append_whiskers_to_hdf5 for the arguments. The table is flushed,
+    but the file is not.
+    
+    Returns: the number of whisker segments appended
+    """
+    whiskers, measurements = parse_chunk(whisk_filename, 
+        measurements_filename)
+    return _append_parsed_chunk_to_open_hdf5(h5file, whiskers, chunk_start,
+        measurements=measurements, roi_offset=roi_offset)
+
+def _append_parsed_chunk_to_open_hdf5(h5file, whiskers, chunk_start,
+    measurements=None, roi_offset=None):
+    """Append a chunk returned by parse_chunk to an open HDF5 file
     
+    Returns: the number of whisker segments appended
+    """
+    ## Convert to arrays and store them all at once
+    summary, pixels_x, pixels_y = whiskers_to_arrays(whiskers, chunk_start,
+        h5file.get_node('/summary').dtype, measurements=measurements, 
+        roi_offset=roi_offset)
+    return _append_arrays_to_open_hdf5(h5file, summary, pixels_x, pixels_y)
 
+def _append_arrays_to_open_hdf5(h5file, summary, pixels_x, pixels_y):
+    """Append arrays returned by whiskers_to_arrays to an open HDF5 file
+    
+    Returns: the number of whisker segments appended
+    """
+    table = h5file.get_node('/summary')
+    xpixels = h5file.get_node('/pixels_x')
+    ypixels = h5file.get_node('/pixels_y')
+    
+    if len(summary) == 0:
+        return 0
+    
+    if get_pixel_layout(h5file) == 'flat':
+        # Offsets are relative to the pixels already stored
+        summary['pixel_offset'] += xpixels.nrows
+        xpixels.append(pixels_x)
+        ypixels.append(pixels_y)
+    else:
+        # A VLArray can only be appended one row at a time
+        stops = np.cumsum(summary['pixlen'].astype(np.int64))
+        for wseg_x, wseg_y in itertools.izip(
+            np.split(pixels_x, stops[:-1]), np.split(pixels_y, stops[:-1])):
+            xpixels.append(wseg_x)
+            ypixels.append(wseg_y)
+    
+    table.append(summary)
     table.flush()
-    h5file.close()    
+    
+    return len(summary)
+
+class HDF5Stitcher(object):
+    """Stitches traced chunks into an HDF5 file, in order, as they finish
+    
+    Each chunk is registered with expect() when it is created, and passed
+    to add_chunk() when it has been traced, which can happen in any order
+    and from any thread. A background thread appends each chunk to the
+    HDF5 file as soon as it and all of the chunks expected before it
+    have been added. So stitching overlaps with tracing, and the file 
+    always holds a contiguous run of chunks from the start.
+    
+    The file is kept open by the background thread, and flushed every 
+    flush_interval whisker segments, so that it is valid up to the last
+    flush if the process dies. close() stitches whatever is left, and 
+    closes it.
+    
+    The background thread is the only writer, and does nothing but write.
+    Parsing the chunks into arrays is the slow part, so it can be done 
+    elsewhere: either the caller parses each chunk with 
+    parse_chunk_to_arrays, using self.dtype and self.roi_offset, and passes
+    the result to add_chunk, or the stitcher parses them in a pool of 
+    n_parse_processes workers.
+    """
+    def __init__(self, h5_filename, roi_offset=None, flush_interval=100000,
+        on_stitched=None, n_parse_processes=0, max_parsed_chunks=None,
+        index=True):
+        """Initialize a new stitcher
+        
+        h5_filename : HDF5 file, already set up with setup_hdf5
+        roi_offset : passed to whiskers_to_arrays
+        flush_interval : flush after this many whisker segments
+        on_stitched : function called with (chunk_start, whisk_filename,
+            measurements_filename) after a chunk is stitched, or None
+        n_parse_processes : if > 0, chunks that are added without being
+            parsed are parsed in a pool of this many processes. Otherwise
+            they are parsed by the stitching thread.
+        max_parsed_chunks : add_chunk blocks while this many chunks are
+            being parsed or waiting to be written by the pool, to limit
+            memory use. Defaults to 2 * n_parse_processes.
+        index : if True, the file is indexed with index_hdf5 when closed
+        """
+        self.h5_filename = h5_filename
+        self.roi_offset = roi_offset
+        self.flush_interval = flush_interval
+        self.on_stitched = on_stitched
+        self.index = index
+        
+        # The parsing pool, started before the file is opened so that the
+        # workers do not inherit it
+        if n_parse_processes > 0:
+            if max_parsed_chunks is None:
+                max_parsed_chunks = 2 * n_parse_processes
+            self.parse_pool = multiprocessing.Pool(n_parse_processes)
+            self.parse_slots = threading.Semaphore(max_parsed_chunks)
+        else:
+            self.parse_pool = None
+        self.parse_results = []
+        self.chunk_starts_parsing = set()
+        
+        # The dtype of the summary table, which the arrays must have
+        with HDF5_LOCK:
+            with tables.open_file(h5_filename, mode="r") as h5file:
+                self.dtype = h5file.get_node('/summary').dtype
+        
+        # Chunk starts expected but not yet stitched, and those traced
+        self.expected_chunk_starts = []
+        self.traced_chunks = {}
+        self.chunk_starts_stitched = []
+        self.lock = threading.Lock()
+        
+        # Rows of /summary and /pixels_x after the last chunk stitched
+        self.summary_nrows = None
+        self.pixels_nrows = None
+        
+        # Errors raised by the stitching thread, raised again by close
+        self.errors = []
+        
+        # Start the stitching thread
+        self.stitch_queue = Queue.Queue()
+        self.stitch_thread = threading.Thread(target=self._stitch_loop)
+        self.stitch_thread.daemon = True
+        self.stitch_thread.start()
+    
+    def expect(self, chunk_start):
+        """Register a chunk that will be traced"""
+        with self.lock:
+            self.expected_chunk_starts.append(chunk_start)
+            self.expected_chunk_starts.sort()
+    
+    def add_chunk(self, chunk_start, whisk_filename, 
+        measurements_filename=None, parsed=None):
+        """Queue a traced chunk for stitching
+        
+        parsed : the result of parse_chunk_to_arrays on these files, with
+            self.dtype and self.roi_offset, or None to parse them here
+        """
+        if parsed is not None or self.parse_pool is None:
+            self.stitch_queue.put((chunk_start, whisk_filename, 
+                measurements_filename, parsed))
+            return
+        
+        # Wait until the writer has caught up
+        # If stitching or parsing failed it never will, and close() raises
+        while not self.parse_slots.acquire(False):
+            if (not self.stitch_thread.is_alive() or 
+                self._prune_parse_results()):
+                break
+            time.sleep(.01)
+        
+        # Parse in the pool, and queue the result when done
+        def queue_parsed(parsed):
+            self.stitch_queue.put((chunk_start, whisk_filename, 
+                measurements_filename, parsed))
+        with self.lock:
+            self.chunk_starts_parsing.add(chunk_start)
+        self._prune_parse_results()
+        self.parse_results.append(self.parse_pool.apply_async(
+            parse_chunk_to_arrays, args=(whisk_filename, chunk_start, 
+            self.dtype, measurements_filename, self.roi_offset), 
+            callback=queue_parsed))
+    
+    def _prune_parse_results(self):
+        """Forget the pool results that succeeded, to free their memory
+        
+        Returns: True if parsing any chunk failed
+        """
+        self.parse_results = [parse_result 
+            for parse_result in self.parse_results
+            if not (parse_result.ready() and parse_result.successful())]
+        return any(parse_result.ready() 
+            for parse_result in self.parse_results)
+    
+    def _pop_next_chunk(self):
+        """Returns the next chunk in order if it was traced, else None"""
+        with self.lock:
+            if len(self.expected_chunk_starts) == 0:
+                return None
+            chunk_start = self.expected_chunk_starts[0]
+            if chunk_start not in self.traced_chunks:
+                return None
+            self.expected_chunk_starts.pop(0)
+            return (chunk_start,) + self.traced_chunks.pop(chunk_start)
+    
+    def _stitch_loop(self):
+        """Stitch chunks as they become ready, until None is queued"""
+        with HDF5_LOCK:
+            h5file = tables.open_file(self.h5_filename, mode="a")
+        n_unflushed = 0
+        try:
+            while True:
+                item = self.stitch_queue.get()
+                if item is None:
+                    break
+                chunk_start = item[0]
+                with self.lock:
+                    self.traced_chunks[chunk_start] = item[1:]
+                
+                # Stitch every chunk that is ready, in order
+                while True:
+                    next_chunk = self._pop_next_chunk()
+                    if next_chunk is None:
+                        break
+                    chunk_start, whisk_filename, measurements_filename, \
+                        parsed = next_chunk
+                    if parsed is None:
+                        parsed = parse_chunk_to_arrays(whisk_filename, 
+                            chunk_start, self.dtype, measurements_filename,
+                            self.roi_offset)
+                    with HDF5_LOCK:
+                        n_unflushed += _append_arrays_to_open_hdf5(
+                            h5file, *parsed)
+                        self.summary_nrows = h5file.get_node(
+                            '/summary').nrows
+                        self.pixels_nrows = h5file.get_node(
+                            '/pixels_x').nrows
+                    self.chunk_starts_stitched.append(chunk_start)
+                    if self.on_stitched is not None:
+                        self.on_stitched(chunk_start, whisk_filename,
+                            measurements_filename)
+                    
+                    # Free the parsing slot
+                    with self.lock:
+                        if chunk_start in self.chunk_starts_parsing:
+                            self.chunk_starts_parsing.remove(chunk_start)
+                            self.parse_slots.release()
+                    
+                    # Flush periodically
+                    if n_unflushed >= self.flush_interval:
+                        with HDF5_LOCK:
+                            h5file.flush()
+                        n_unflushed = 0
+        except Exception as error:
+            self.errors.append(error)
+        finally:
+            with HDF5_LOCK:
+                h5file.close()
+    
+    def close(self):
+        """Wait for stitching to finish, close the file, and index it
+        
+        Raises the first error from the stitching thread, or ValueError
+        if any expected chunk was never added. The file is only indexed
+        if there was no error.
+        """
+        if self.stitch_thread is None:
+            return
+        
+        # Wait for the last chunks to be parsed
+        if self.parse_pool is not None:
+            self.parse_pool.close()
+            self.parse_pool.join()
+        
+        self.stitch_queue.put(None)
+        self.stitch_thread.join()
+        self.stitch_thread = None
+        
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        
+        # This raises any error from parsing in the pool
+        for parse_result in self.parse_results:
+            parse_result.get()
+        if len(self.expected_chunk_starts) > 0:
+            raise ValueError("chunks starting at %r were not stitched" % 
+                self.expected_chunk_starts)
+        
+        if self.index:
+            with HDF5_LOCK:
+                index_hdf5(self.h5_filename)
+
+def stitch_chunks(h5_filename, chunk_starts, whisk_filenames,
+    measurements_filenames=None, roi_offset=None, n_parse_processes=4,
+    flush_interval=100000):
+    """Append traced chunks to an HDF5 file, parsing them in parallel
+    
+    The chunks are parsed in a pool of n_parse_processes workers, and 
+    appended in order of chunk_starts by a single HDF5Stitcher.
+    
+    h5_filename : HDF5 file, already set up with setup_hdf5
+    chunk_starts : the first frame of each chunk
+    whisk_filenames : the whiskers file of each chunk
+    measurements_filenames : the measurements file of each chunk, or None
+    roi_offset, flush_interval : see HDF5Stitcher
+    
+    Returns: the chunk starts that were stitched, in order
+    """
+    if measurements_filenames is None:
+        measurements_filenames = [None] * len(whisk_filenames)
+    
+    # Sort the chunks, so that they are parsed in the order written
+    chunks = sorted(zip(chunk_starts, whisk_filenames, 
+        measurements_filenames))
+    
+    stitcher = HDF5Stitcher(h5_filename, roi_offset=roi_offset,
+        flush_interval=flush_interval, n_parse_processes=n_parse_processes)
+    for chunk_start, whisk_filename, measurements_filename in chunks:
+        stitcher.expect(chunk_start)
+    try:
+        for chunk_start, whisk_filename, measurements_filename in chunks:
+            stitcher.add_chunk(chunk_start, whisk_filename, 
+                measurements_filename)
+    finally:
+        stitcher.close()
+    
+    return stitcher.chunk_starts_stitched
+
+def rebuild_hdf5_from_whiskers_directory(whiskers_directory, h5_filename,
+    measure=False, n_parse_processes=4, expectedrows=1000000, 
+    pixel_layout='vlarray', roi_offset=None, flush_interval=100000,
+    hdf5_kwargs=None):
+    """Create an HDF5 file from a directory of traced chunks
+    
+    This re-stitches the whiskers files left behind by a previous run,
+    without tracing anything. The chunks are parsed in parallel, see
+    stitch_chunks.
+    
+    whiskers_directory : directory containing the whiskers files
+    h5_filename : output HDF5 file, which is overwritten
+    measure : if True, also stitch the measurements file of each chunk,
+        which must exist
+    n_parse_processes : how many simultaneous processes to use for parsing
+    expectedrows, pixel_layout : used to set up hdf5 file
+    hdf5_kwargs : dict of other kwargs to pass to setup_hdf5, like 
+        complib, complevel and chunkshape
+    roi_offset : (x, y) offset of the traced frames in the full frame,
+        if they were cropped, see append_whiskers_to_hdf5
+    flush_interval : flush the hdf5 file after this many whisker segments
+    
+    The whiskers files must be named like chunk00000200.whiskers, where
+    the number is the first frame of the chunk.
+    
+    Returns: the chunk starts that were stitched, in order
+    """
+    # Figure out which chunks there are
+    file_number_strings = my.misc.apply_and_filter_by_regex(
+        '^chunk(\d+).whiskers$', os.listdir(whiskers_directory), 
+        sort=False)
+    if len(file_number_strings) == 0:
+        raise IOError("no whiskers files in %s" % whiskers_directory)
+    whisk_filenames = [
+        os.path.join(whiskers_directory, 'chunk%s.whiskers' % fns)
+        for fns in file_number_strings]
+    chunk_starts = map(int, file_number_strings)
+    
+    if measure:
+        measurements_filenames = [
+            WhiskiWrap.utils.FileNamer.from_whiskers(whisk_filename
+            ).measurements for whisk_filename in whisk_filenames]
+        for measurements_filename in measurements_filenames:
+            if not os.path.exists(measurements_filename):
+                raise IOError("missing %s" % measurements_filename)
+    else:
+        measurements_filenames = None
+    
+    # Setup the result file
+    if hdf5_kwargs is None:
+        hdf5_kwargs = {}
+    setup_hdf5(h5_filename, expectedrows, measure=measure, 
+        pixel_layout=pixel_layout, **hdf5_kwargs)
+    
+    return stitch_chunks(h5_filename, chunk_starts, whisk_filenames,
+        measurements_filenames=measurements_filenames, 
+        roi_offset=roi_offset, n_parse_processes=n_parse_processes,
+        flush_interval=flush_interval)
 
 def pipeline_trace(input_vfile, h5_filename,
     epoch_sz_frames=3200, chunk_sz_frames=200, 
     frame_start=0, frame_stop=None,
     n_trace_processes=4, expectedrows=1000000, flush_interval=100000,
-    measure=False,face='right'):
+    measure=False,face='right', crop=None, pixel_layout='vlarray',
+    hdf5_kwargs=None, chunk_timeout=None, max_retries=1, speculate=False):
     """Trace a video file using a chunked strategy.
     
     This is now deprecated in favor of interleaved_reading_and_tracing.
@@ -364,7 +1199,23 @@ def pipeline_trace(input_vfile, h5_filename,
     chunk_sz_frames : Each epoch is broken into chunks of this length
     frame_start, frame_stop : where to start and stop processing
     n_trace_processes : how many simultaneous processes to use for tracing
-    expectedrows, flush_interval : used to set up hdf5 file
+    expectedrows : used to set up hdf5 file
+    flush_interval : flush the hdf5 file after stitching this many
+        whisker segments. Each epoch is parsed in parallel and stitched 
+        in the background while the next one is read.
+    crop : (x, y, width, height) to crop each frame to while reading, or
+        'auto' to choose it with video_utils.detect_whisker_roi. The 
+        results are stitched in full-frame coordinates.
+    pixel_layout : how to store the pixels, see setup_hdf5
+    hdf5_kwargs : dict of other kwargs to pass to setup_hdf5, like 
+        complib, complevel and chunkshape
+    chunk_timeout, max_retries, speculate : how to handle chunks that 
+        fail or are slow to trace or measure, see 
+        interleaved_reading_and_tracing
+    
+    Returns: dict
+        retried_chunks : the chunks that failed, were retried, or were
+            duplicated, see RetryingPool.report
     
     TODO: combine the reading and writing stages using frame_func so that
     we don't have to load the whole epoch in at once. In fact then we don't
@@ -377,135 +1228,276 @@ def pipeline_trace(input_vfile, h5_filename,
     input_dir = os.path.split(input_vfile)[0]    
 
     # Setup the result file
-    setup_hdf5(h5_filename, expectedrows, measure=measure)
+    if hdf5_kwargs is None:
+        hdf5_kwargs = {}
+    setup_hdf5(h5_filename, expectedrows, measure=measure, 
+        pixel_layout=pixel_layout, **hdf5_kwargs)
 
     # Figure out how many frames and epochs
-    duration = my.video.get_video_duration2(input_vfile)
-    frame_rate = my.video.get_video_params(input_vfile)[2]
-    total_frames = int(np.rint(duration * frame_rate))
+    # The index gives the exact number of frames, and exact seek times
+    frame_index = video_utils.FrameIndex.load_or_build(input_vfile)
+    total_frames = frame_index.n_frames
+    
+    # Choose the crop
+    if crop == 'auto':
+        crop = video_utils.detect_whisker_roi(input_vfile,
+            frame_index=frame_index)
+    if crop is not None:
+        roi_offset = (crop[0], crop[1])
+    else:
+        roi_offset = None
+    
     if frame_stop is None:
         frame_stop = total_frames
     if frame_stop > total_frames:
         print "too many frames requested, truncating"
         frame_stop = total_frames
     
-    # Iterate over epochs
-    for start_epoch in range(frame_start, frame_stop, epoch_sz_frames):
-        # How many frames in this epoch
-        stop_epoch = np.min([frame_stop, start_epoch + epoch_sz_frames])
-        print "Epoch %d - %d" % (start_epoch, stop_epoch)
-        
-        # Chunks
-        chunk_starts = np.arange(start_epoch, stop_epoch, chunk_sz_frames)
-        chunk_names = ['chunk%08d.tif' % nframe for nframe in chunk_starts]
-        whisk_names = ['chunk%08d.whiskers' % nframe for nframe in chunk_starts]
-        
-
-        # read everything
-        # need to be able to crop here
-        print "Reading"
-        frames = video_utils.process_chunks_of_video(input_vfile, 
-            frame_start=start_epoch, frame_stop=stop_epoch,
-            frames_per_chunk=chunk_sz_frames, # only necessary for chunk_func
-            frame_func=None, chunk_func=None,
-            verbose=False, finalize='listcomp')
-
-        # Dump frames into tiffs or lossless
-        print "Writing"
-        for n_whiski_chunk, chunk_name in enumerate(chunk_names):
-            print n_whiski_chunk
-            chunkstart = n_whiski_chunk * chunk_sz_frames
-            chunkstop = (n_whiski_chunk + 1) * chunk_sz_frames
-            chunk = frames[chunkstart:chunkstop]
-            if len(chunk) in [3, 4]:
-                print "WARNING: trace will fail on tiff stacks of length 3 or 4"
-            write_chunk(chunk, chunk_name, input_dir)
-        
-        # Also write lossless and/or lossy monitor video here?
-        # would really only be useful if cropping applied
-
-        # trace each
-        print "Tracing"
-        pool = multiprocessing.Pool(n_trace_processes)        
-        trace_res = pool.map(trace_chunk, 
-            [os.path.join(input_dir, chunk_name)
-                for chunk_name in chunk_names])
-        pool.close()
+    # One pool traces (and measures) every epoch. It is started before
+    # the stitcher opens the HDF5 file, so the workers do not inherit it
+    trace_pool = RetryingPool(n_trace_processes, max_retries=max_retries,
+        speculate=speculate)
+    stitcher = None
+    finished = False
+    try:
+        # Stitch in the background, parsing up to an epoch at a time
+        stitcher = HDF5Stitcher(h5_filename, roi_offset=roi_offset,
+            flush_interval=flush_interval, 
+            n_parse_processes=n_trace_processes,
+            max_parsed_chunks=int(np.ceil(epoch_sz_frames / 
+            float(chunk_sz_frames))))
+        
+        # Iterate over epochs
+        for start_epoch in range(frame_start, frame_stop, epoch_sz_frames):
+            _trace_epoch(input_vfile, input_dir, start_epoch, 
+                min(frame_stop, start_epoch + epoch_sz_frames),
+                chunk_sz_frames, frame_index, crop, measure, face, 
+                chunk_timeout, trace_pool, stitcher)
+        
+        # Wait for the last epoch to be stitched
+        stitcher.close()
+        trace_pool.close()
+        trace_pool.join()
+        retried_chunks = trace_pool.report()
+        finished = True
+    finally:
+        # On an error, stop tracing, and close the HDF5 file with the 
+        # chunks stitched so far
+        if not finished:
+            trace_pool.terminate()
+            if stitcher is not None:
+                try:
+                    stitcher.close()
+                except Exception as error:
+                    print "error closing %s: %r" % (h5_filename, error)
+    
+    if len(retried_chunks) > 0:
+        print "chunks that were retried or duplicated: %s" % (
+            ', '.join(sorted(retried_chunks.keys())))
+    return {'retried_chunks': retried_chunks}
 
-        # take measurements:
-        if measure:
-            print "Measuring"
-            pool = multiprocessing.Pool(n_trace_processes)
-            meas_res = pool.map(measure_chunk_star, 
-                itertools.izip([os.path.join(input_dir, whisk_name)
-                    for whisk_name in whisk_names],itertools.repeat(face)))
-            pool.close()
-        
-
-        # stitch
-        print "Stitching"
-        for chunk_start, chunk_name in zip(chunk_starts, chunk_names):
-            # Append each chunk to the hdf5 file
-            fn = WhiskiWrap.utils.FileNamer.from_tiff_stack(
-                os.path.join(input_dir, chunk_name))
-            
-            if not measure:
-                append_whiskers_to_hdf5(
-                    whisk_filename=fn.whiskers,
-                    h5_filename=h5_filename, 
-                    chunk_start=chunk_start)
-            elif measure:
-                append_whiskers_to_hdf5(
-                    whisk_filename=fn.whiskers,
-                    measurements_filename=fn.measurements,
-                    h5_filename=h5_filename, 
-                    chunk_start=chunk_start)
+def _trace_epoch(input_vfile, input_dir, start_epoch, stop_epoch, 
+    chunk_sz_frames, frame_index, crop, measure, face, chunk_timeout, 
+    trace_pool, stitcher):
+    """Read, write, trace, and measure one epoch of pipeline_trace
+    
+    The chunks are traced in trace_pool, and queued to be stitched by
+    stitcher.
+    """
+    print "Epoch %d - %d" % (start_epoch, stop_epoch)
+    
+    # Chunks
+    chunk_starts = np.arange(start_epoch, stop_epoch, chunk_sz_frames)
+    chunk_names = ['chunk%08d.tif' % nframe for nframe in chunk_starts]
+    whisk_names = ['chunk%08d.whiskers' % nframe for nframe in chunk_starts]
+
+    # read everything
+    print "Reading"
+    frames = video_utils.process_chunks_of_video(input_vfile, 
+        frame_start=start_epoch, frame_stop=stop_epoch,
+        frames_per_chunk=chunk_sz_frames, # only necessary for chunk_func
+        frame_func=None, chunk_func=None,
+        verbose=False, finalize='listcomp', frame_index=frame_index,
+        crop=crop)
+
+    # Dump frames into tiffs or lossless
+    print "Writing"
+    for n_whiski_chunk, chunk_name in enumerate(chunk_names):
+        print n_whiski_chunk
+        chunkstart = n_whiski_chunk * chunk_sz_frames
+        chunkstop = (n_whiski_chunk + 1) * chunk_sz_frames
+        chunk = frames[chunkstart:chunkstop]
+        if len(chunk) in TRACE_UNSAFE_CHUNK_LENGTHS:
+            print "WARNING: trace will fail on tiff stacks of length 3 or 4"
+        write_chunk(chunk, chunk_name, input_dir)
+    
+    # Also write lossless and/or lossy monitor video here?
+    # would really only be useful if cropping applied
+
+    # trace each
+    print "Tracing"
+    map_with_retries(trace_chunk, 
+        [(os.path.join(input_dir, chunk_name), False, chunk_timeout)
+            for chunk_name in chunk_names], None, pool=trace_pool)
+
+    # take measurements:
+    if measure:
+        print "Measuring"
+        map_with_retries(measure_chunk, 
+            [(os.path.join(input_dir, whisk_name), face, False, 
+                chunk_timeout) for whisk_name in whisk_names], 
+            None, pool=trace_pool)
 
+    # stitch
+    print "Stitching"
+    for chunk_start, chunk_name in zip(chunk_starts, chunk_names):
+        # Queue each chunk to be appended to the hdf5 file
+        fn = WhiskiWrap.utils.FileNamer.from_tiff_stack(
+            os.path.join(input_dir, chunk_name))
+        stitcher.expect(chunk_start)
+        stitcher.add_chunk(chunk_start, fn.whiskers,
+            fn.measurements if measure else None)
+
+def _stack_frames_into_chunks(frame_iterator, chunk_size):
+    """Yields arrays of up to chunk_size frames from frame_iterator"""
+    while True:
+        frames = list(itertools.islice(frame_iterator, chunk_size))
+        if len(frames) == 0:
+            return
+        yield np.array(frames)
+
+def invert_frames(frames):
+    """Returns 255 - frames, for a uint8 frame or chunk of frames
+    
+    Writeable arrays are inverted in place, without copying them.
+    """
+    if frames.flags.writeable:
+        return np.subtract(255, frames, out=frames)
+    return 255 - frames
+
+def iter_chunks_of_frames(input_reader, chunk_size, frame_func=None,
+    stop_after_frame=None, skip_frames=0, chunk_func=None):
+    """Yields arrays of `chunk_size` frames from input_reader
+    
+    input_reader : object providing .iter_frames(), and optionally
+        .iter_chunks(n_frames) to read a whole chunk at once, like
+        FFmpegReader. Readers without .iter_chunks, like PFReader, are
+        read one frame at a time and the frames are stacked into chunks.
+    chunk_size : frames per chunk. Only the last chunk can be shorter.
+        Empty chunks are never yielded.
+    frame_func : function to apply to each frame, or None
+        If 'invert', invert_frames is applied to the whole chunk at once.
+        Any other function is called on each frame, so pass it as 
+        chunk_func instead if it also works on a whole chunk.
+    stop_after_frame : stop after this many frames, or None
+    skip_frames : read and discard this many frames first. They count
+        towards stop_after_frame.
+    chunk_func : function to apply to each whole chunk, or None
+        This is called once per chunk, so it is much faster than an
+        equivalent frame_func. It is applied after frame_func.
+    
+    Each chunk is an array of shape (n_frames, height, width).
+    """
+    if hasattr(input_reader, 'iter_chunks'):
+        chunk_iterator = input_reader.iter_chunks(chunk_size)
+    else:
+        chunk_iterator = _stack_frames_into_chunks(
+            input_reader.iter_frames(), chunk_size)
+    
+    nframe = 0
+    try:
+        for chunk in chunk_iterator:
+            # Stop early?
+            if stop_after_frame is not None:
+                chunk = chunk[:stop_after_frame - nframe]
+                if len(chunk) == 0:
+                    break
+            nframe = nframe + len(chunk)
+        
+            # Discard the skipped frames
+            if nframe - len(chunk) < skip_frames:
+                chunk = chunk[skip_frames - (nframe - len(chunk)):]
+                if len(chunk) == 0:
+                    continue
+        
+            # Apply frame_func to each frame, or to the whole chunk
+            if frame_func == 'invert':
+                chunk = invert_frames(chunk)
+            elif frame_func is not None:
+                processed = None
+                for n_frame, frame in enumerate(chunk):
+                    frame = frame_func(frame)
+                    if processed is None:
+                        processed = np.empty((len(chunk),) + frame.shape, 
+                            dtype=frame.dtype)
+                    processed[n_frame] = frame
+                chunk = processed
+            if chunk_func is not None:
+                chunk = chunk_func(chunk)
+        
+            yield chunk
 
+            if stop_after_frame is not None and nframe >= stop_after_frame:
+                break
+    finally:
+        # Stop a reader like ParallelFFmpegReader, if stopping early
+        chunk_iterator.close()
 
 def write_video_as_chunked_tiffs(input_reader, tiffs_to_trace_directory,
     chunk_size=200, chunk_name_pattern='chunk%08d.tif',
     stop_after_frame=None, monitor_video=None, timestamps_filename=None,
-    monitor_video_kwargs=None):
+    monitor_video_kwargs=None, stream_tiffs=False):
     """Write frames to disk as tiff stacks
     
     input_reader : object providing .iter_frames() method and perhaps
         also a .timestamps attribute. For instance, PFReader, or some
-        FFmpegReader object.
+        FFmpegReader object. If it provides .iter_chunks(), that is used
+        instead to read a whole chunk at a time.
     tiffs_to_trace_directory : where to store the chunked tiffs
     stop_after_frame : to stop early
     monitor_video : if not None, should be a filename to write a movie to
     timestamps_filename : if not None, should be the name to write timestamps
     monitor_video_kwargs : ffmpeg params
+    stream_tiffs : if True, read one frame at a time and stream it to
+        disk with RawTiffWriter, instead of reading whole chunks. This
+        requires grayscale frames.
     
     Returns: ChunkedTiffWriter object    
     """
+    # Streamed tiff stacks can only hold grayscale frames
+    if stream_tiffs and getattr(input_reader, 'pix_fmt', 'gray') != 'gray':
+        raise ValueError("stream_tiffs requires pix_fmt 'gray', not %r" % 
+            input_reader.pix_fmt)
+    
     # Tiff writer
     ctw = WhiskiWrap.ChunkedTiffWriter(tiffs_to_trace_directory,
-        chunk_size=chunk_size, chunk_name_pattern=chunk_name_pattern)
+        chunk_size=chunk_size, chunk_name_pattern=chunk_name_pattern,
+        streaming=stream_tiffs)
 
     # FFmpeg writer is initalized after first frame
     ffw = None
 
-    # Iterate over frames
-    for nframe, frame in enumerate(input_reader.iter_frames()):
-        # Stop early?
-        if stop_after_frame is not None and nframe >= stop_after_frame:
-            break
-        
+    # Iterate over chunks of frames, or single frames if streaming
+    for chunk in iter_chunks_of_frames(input_reader, 
+        1 if stream_tiffs else chunk_size,
+        stop_after_frame=stop_after_frame):
         # Write to chunked tiff
-        ctw.write(frame)
+        if stream_tiffs:
+            ctw.write(chunk[0])
+        else:
+            ctw.write_chunk(chunk)
         
         # Optionally write to monitor video
         if monitor_video is not None:
-            # Initialize ffw after first frame so we know the size
+            # Initialize ffw after first chunk so we know the size
             if ffw is None:
                 ffw = WhiskiWrap.FFmpegWriter(monitor_video, 
-                    frame_width=frame.shape[1], frame_height=frame.shape[0],
+                    frame_width=chunk.shape[2], frame_height=chunk.shape[1],
                     **monitor_video_kwargs)
-            ffw.write(frame)
+            ffw.write(chunk)
 
-    # Finalize writers
+    # Finalize writers, splitting a final chunk that trace would fail on
+    ctw.write_safe_tail()
     ctw.close()
     if ffw is not None:
         ff_stdout, ff_stderr = ffw.close()
@@ -519,19 +1511,31 @@ def write_video_as_chunked_tiffs(input_reader, tiffs_to_trace_directory,
     return ctw
 
 def trace_chunked_tiffs(input_tiff_directory, h5_filename,
-    n_trace_processes=4, expectedrows=1000000,
-    ):
+    n_trace_processes=4, expectedrows=1000000, pixel_layout='vlarray',
+    hdf5_kwargs=None, chunk_timeout=None, max_retries=1, speculate=False):
     """Trace tiffs that have been written to disk in parallel and stitch.
     
     input_tiff_directory : directory containing tiffs
     h5_filename : output HDF5 file
     n_trace_processes : how many simultaneous processes to use for tracing
     expectedrows : used to set up hdf5 file
+    pixel_layout : how to store the pixels, see setup_hdf5
+    hdf5_kwargs : dict of other kwargs to pass to setup_hdf5, like 
+        complib, complevel and chunkshape
+    chunk_timeout, max_retries, speculate : how to handle chunks that 
+        fail or are slow to trace, see interleaved_reading_and_tracing
+    
+    Returns: dict
+        retried_chunks : the chunks that failed, were retried, or were
+            duplicated, see RetryingPool.report
     """
     WhiskiWrap.utils.probe_needed_commands()
     
     # Setup the result file
-    setup_hdf5(h5_filename, expectedrows)
+    if hdf5_kwargs is None:
+        hdf5_kwargs = {}
+    setup_hdf5(h5_filename, expectedrows, pixel_layout=pixel_layout,
+        **hdf5_kwargs)
     
     # The tiffs have been written, figure out which they are
     tif_file_number_strings = my.misc.apply_and_filter_by_regex(
@@ -548,240 +1552,1525 @@ def trace_chunked_tiffs(input_tiff_directory, h5_filename,
 
     # trace each
     print "Tracing"
-    pool = multiprocessing.Pool(n_trace_processes)        
-    trace_res = pool.map(trace_chunk, tif_sorted_filenames)
-    pool.close()
+    trace_res, retried_chunks = map_with_retries(trace_chunk, 
+        [(tif_filename, False, chunk_timeout) 
+            for tif_filename in tif_sorted_filenames], n_trace_processes,
+        max_retries=max_retries, speculate=speculate)
     
-    # stitch
+    # stitch, parsing in parallel
     print "Stitching"
-    for chunk_start, chunk_name in zip(tif_sorted_file_numbers, tif_sorted_filenames):
-        # Append each chunk to the hdf5 file
-        fn = WhiskiWrap.utils.FileNamer.from_tiff_stack(chunk_name)
-        append_whiskers_to_hdf5(
-            whisk_filename=fn.whiskers,
-            h5_filename=h5_filename, 
-            chunk_start=chunk_start)
+    stitch_chunks(h5_filename, tif_sorted_file_numbers,
+        [WhiskiWrap.utils.FileNamer.from_tiff_stack(chunk_name).whiskers
+            for chunk_name in tif_sorted_filenames],
+        n_parse_processes=n_trace_processes)
+    
+    return {'retried_chunks': retried_chunks}
 
 
-def interleaved_read_trace_and_measure(input_reader, tiffs_to_trace_directory,
-    sensitive=False,
+def _call_catching_errors(func, args, kwds):
+    """Run func in a pool worker, catching any error
+    
+    The pool does not call back on errors, so RetryingPool uses this to 
+    hear about every attempt.
+    
+    Returns: (True, result) or (False, the formatted traceback)
+    """
+    try:
+        return True, func(*args, **kwds)
+    except Exception:
+        return False, traceback.format_exc()
+
+class RetryingTask(object):
+    """A task of RetryingPool, which may take several attempts
+    
+    Like multiprocessing's AsyncResult, it has ready, successful, wait, 
+    and get. attempts is a list of dicts, one per attempt, with
+        attempt : the attempt number
+        speculative : True if it was a duplicate of a slow attempt
+        start, stop : when it started running and finished, or None. The 
+            start time is estimated, assuming the pool runs tasks in the
+            order they were submitted.
+        outcome : None while running, then 'ok', 'error', or 'lost' for
+            an attempt that finished after another attempt succeeded
+        error : the traceback of an attempt that failed
+    
+    callback_error is the traceback of the callback, if it raised an
+    error, or None.
+    """
+    def __init__(self, func, args, kwds, callback, name):
+        self.func = func
+        self.args = args
+        self.kwds = kwds
+        self.callback = callback
+        self.name = name
+        self.attempts = []
+        self.speculated = False
+        self.finished = False
+        self.result = None
+        self.error = None
+        self.callback_error = None
+        self._event = threading.Event()
+    
+    def ready(self):
+        return self._event.is_set()
+    
+    def successful(self):
+        if not self.ready():
+            raise ValueError("%r not ready" % self)
+        return self.error is None
+    
+    def wait(self, timeout=None):
+        self._event.wait(timeout)
+    
+    def get(self, timeout=None):
+        """Returns the result of the attempt that succeeded
+        
+        Raises RuntimeError, with the traceback of the last attempt, if
+        every attempt failed, or with the traceback of the callback, if
+        it raised an error.
+        """
+        self.wait(timeout)
+        if not self.ready():
+            raise multiprocessing.TimeoutError
+        if self.error is not None:
+            raise RuntimeError("%s failed after %d attempts:\n%s" % (
+                self.name, len(self.attempts), self.error))
+        if self.callback_error is not None:
+            raise RuntimeError("the callback of %s failed:\n%s" % (
+                self.name, self.callback_error))
+        return self.result
+    
+    def running_attempts(self):
+        return [attempt for attempt in self.attempts 
+            if attempt['outcome'] is None]
+
+class RetryingPool(object):
+    """A process pool that retries failed tasks and duplicates slow ones
+    
+    apply_async, close, and join work like multiprocessing.Pool, so this
+    can be passed to InFlightWindow. The function is called with an 
+    additional keyword argument `attempt`, the number of the attempt, 
+    which it should use to write its output to a file of its own and 
+    rename it when done (see trace_chunk). Per-attempt time limits are up
+    to the function, e.g. the timeout of trace_chunk.
+    
+    A task that raises an error is submitted again, up to max_retries 
+    times. Its callback is only called with the result of the first 
+    attempt that succeeds, and not at all if every attempt fails.
+    
+    If speculate is True, every poll_interval seconds the pool looks for
+    stragglers: attempts that have been running for longer than 
+    speculate_factor times the median duration of the attempts that 
+    succeeded so far, and at least speculate_min_seconds. If workers are
+    idle, the oldest stragglers are submitted again, once per task, and 
+    whichever attempt finishes first wins.
+    
+    Attempts that lost are still running when every task is finished. 
+    join then terminates the pool instead of waiting for them.
+    
+    Errors raised by callbacks are caught, so that they do not kill the
+    thread that calls back, and are raised again by join and by the 
+    task's get.
+    
+    Subclasses can run the attempts elsewhere, like spool.SpoolPool, by
+    overriding _start_workers, _dispatch, and _stop_workers.
+    """
+    def __init__(self, n_processes, max_retries=1, speculate=False, 
+        speculate_factor=2., speculate_min_seconds=10., poll_interval=1.,
+        verbose=True):
+        """Start the pool
+        
+        n_processes : number of worker processes
+        max_retries : how many times to retry a task that fails
+        speculate, speculate_factor, speculate_min_seconds : see above
+        poll_interval : how often to look for stragglers
+        verbose : print when tasks are retried or duplicated
+        """
+        self.n_processes = n_processes
+        self.max_retries = max_retries
+        self.speculate = speculate
+        self.speculate_factor = speculate_factor
+        self.speculate_min_seconds = speculate_min_seconds
+        self.poll_interval = poll_interval
+        self.verbose = verbose
+        
+        self.lock = threading.RLock()
+        self.tasks = []
+        self.unfinished = set()
+        self.closed = False
+        
+        # Attempts submitted to the pool but not yet running, in order
+        self.n_running = 0
+        self.queued = []
+        
+        # Durations of the attempts that succeeded
+        self.durations = []
+        
+        # (task, traceback) of each callback that raised an error
+        self.callback_errors = []
+        
+        self.pool = self._start_workers()
+        
+        self._stop = threading.Event()
+        self._monitor = None
+        if speculate:
+            self._monitor = threading.Thread(target=self._monitor_loop)
+            self._monitor.daemon = True
+            self._monitor.start()
+    
+    def apply_async(self, func, args=(), kwds=None, callback=None, 
+        name=None):
+        """Submit func(*args, attempt=0, **kwds)
+        
+        name : identifies the task in messages and in report. If None, 
+            the first argument.
+        
+        Returns: RetryingTask
+        """
+        if self.closed:
+            raise ValueError("Pool not running")
+        if kwds is None:
+            kwds = {}
+        if name is None and len(args) > 0:
+            name = args[0]
+        task = RetryingTask(func, args, kwds, callback, name)
+        with self.lock:
+            self.tasks.append(task)
+            self.unfinished.add(task)
+            self._submit_attempt(task)
+        return task
+    
+    def _submit_attempt(self, task, speculative=False):
+        """Submit another attempt of task. Call with the lock held."""
+        attempt = {'attempt': len(task.attempts), 'speculative': speculative,
+            'start': None, 'stop': None, 'outcome': None, 'error': None}
+        task.attempts.append(attempt)
+        if self.n_running < self.n_processes:
+            attempt['start'] = time.time()
+            self.n_running += 1
+        else:
+            self.queued.append(attempt)
+        
+        kwds = dict(task.kwds)
+        kwds['attempt'] = attempt['attempt']
+        self._dispatch(task, attempt, kwds)
+    
+    def _start_workers(self):
+        """Returns the pool that runs the attempts"""
+        return multiprocessing.Pool(self.n_processes)
+    
+    def _dispatch(self, task, attempt, kwds):
+        """Run task.func(*task.args, **kwds) for attempt
+        
+        The outcome of _call_catching_errors must be passed to 
+        _finish_attempt when done.
+        """
+        self.pool.apply_async(_call_catching_errors, 
+            args=(task.func, task.args, kwds),
+            callback=lambda outcome: self._finish_attempt(
+                task, attempt, outcome))
+    
+    def _stop_workers(self, terminate):
+        """Shut down the pool, and wait for it
+        
+        terminate : if True, attempts are still running, and should be
+            stopped rather than waited for
+        """
+        if terminate:
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+    
+    def _finish_attempt(self, task, attempt, outcome):
+        """Called back by the pool when an attempt finishes"""
+        success, value = outcome
+        with self.lock:
+            # An attempt that was already given up on
+            if attempt['outcome'] is not None:
+                return
+            
+            # Account for the worker this attempt was using
+            attempt['stop'] = time.time()
+            if attempt['start'] is None:
+                self.queued.remove(attempt)
+                attempt['start'] = attempt['stop']
+            else:
+                self.n_running -= 1
+            while len(self.queued) > 0 and self.n_running < self.n_processes:
+                self.queued.pop(0)['start'] = attempt['stop']
+                self.n_running += 1
+            
+            if task.finished:
+                attempt['outcome'] = 'lost'
+                return
+            
+            if not success:
+                attempt['outcome'] = 'error'
+                attempt['error'] = value
+                n_failed = len([a for a in task.attempts 
+                    if a['outcome'] == 'error'])
+                if self.verbose:
+                    print "%s failed (attempt %d):\n%s" % (
+                        task.name, attempt['attempt'], value)
+                
+                if len(task.running_attempts()) > 0:
+                    # Another attempt may still succeed
+                    return
+                if n_failed <= self.max_retries:
+                    if self.verbose:
+                        print "retrying", task.name
+                    self._submit_attempt(task)
+                    return
+                
+                # Give up
+                task.finished = True
+                task.error = value
+                self.unfinished.discard(task)
+                task._event.set()
+                return
+            
+            attempt['outcome'] = 'ok'
+            self.durations.append(attempt['stop'] - attempt['start'])
+            task.finished = True
+            task.result = value
+            self.unfinished.discard(task)
+        
+        # Like AsyncResult, call back before becoming ready
+        try:
+            if task.callback is not None:
+                task.callback(value)
+        except Exception:
+            task.callback_error = traceback.format_exc()
+            with self.lock:
+                self.callback_errors.append((task, task.callback_error))
+            if self.verbose:
+                print "the callback of %s failed:\n%s" % (task.name, 
+                    task.callback_error)
+        finally:
+            task._event.set()
+    
+    def _monitor_loop(self):
+        while not self._stop.wait(self.poll_interval):
+            self.launch_speculative_attempts()
+    
+    def launch_speculative_attempts(self):
+        """Duplicate the oldest stragglers, if workers are idle
+        
+        Returns: the number of attempts launched
+        """
+        with self.lock:
+            n_idle = self.n_processes - self.n_running - len(self.queued)
+            if n_idle <= 0 or len(self.durations) == 0:
+                return 0
+            threshold = max(self.speculate_min_seconds, 
+                self.speculate_factor * np.median(self.durations))
+            
+            now = time.time()
+            stragglers = []
+            for task in self.unfinished:
+                if task.speculated:
+                    continue
+                running = task.running_attempts()
+                if len(running) == 1 and running[0]['start'] is not None:
+                    if now - running[0]['start'] > threshold:
+                        stragglers.append((running[0]['start'], task))
+            stragglers.sort(key=lambda straggler: straggler[0])
+            
+            for start, task in stragglers[:n_idle]:
+                if self.verbose:
+                    print "%s has run for %0.1f s, launching a duplicate" % (
+                        task.name, now - start)
+                task.speculated = True
+                self._submit_attempt(task, speculative=True)
+            return len(stragglers[:n_idle])
+    
+    def close(self):
+        """Stop accepting new tasks. Retries can still be submitted."""
+        self.closed = True
+    
+    def join(self):
+        """Wait for every task to finish, then shut down the pool
+        
+        close must be called first.
+        
+        Raises RuntimeError if any callback raised an error, with its
+        traceback, once the pool is shut down.
+        """
+        if not self.closed:
+            raise ValueError("Pool is still running")
+        for task in list(self.tasks):
+            task.wait()
+        self._stop.set()
+        if self._monitor is not None:
+            self._monitor.join()
+        
+        # Do not wait for attempts that can no longer win
+        # Their trace or measure processes die with the workers
+        with self.lock:
+            n_losing = self.n_running + len(self.queued)
+        self._stop_workers(n_losing > 0)
+        
+        # Count the attempts that were terminated as lost
+        with self.lock:
+            now = time.time()
+            for task in self.tasks:
+                for attempt in task.running_attempts():
+                    attempt['outcome'] = 'lost'
+                    attempt['stop'] = now
+                    if attempt['start'] is None:
+                        attempt['start'] = now
+            self.n_running = 0
+            self.queued = []
+        
+        if len(self.callback_errors) > 0:
+            task, callback_error = self.callback_errors[0]
+            raise RuntimeError("the callback of %s failed:\n%s" % (
+                task.name, callback_error))
+    
+    def terminate(self):
+        self.closed = True
+        self._stop.set()
+        self._stop_workers(True)
+    
+    def report(self):
+        """Returns the tasks that did not succeed on the first attempt
+        
+        Returns: dict from the name of each task that was retried, 
+            duplicated, or failed, to the list of its attempts
+        """
+        with self.lock:
+            return dict([(task.name, [dict(attempt) 
+                for attempt in task.attempts])
+                for task in self.tasks
+                if len(task.attempts) > 1 or task.error is not None])
+
+def map_with_retries(func, args_list, n_processes, max_retries=1, 
+    speculate=False, verbose=True, pool=None):
+    """Like Pool.map, but with the retries and speculation of RetryingPool
+    
+    func : called as func(*args, attempt=attempt) for args in args_list
+    pool : a RetryingPool to run the tasks in, which is left running,
+        or None to start one of n_processes workers just for them
+    
+    Raises RuntimeError if any task fails on every attempt.
+    
+    Returns: results, retried
+        results : the result of each task, in order
+        retried : RetryingPool.report()
+    """
+    own_pool = pool is None
+    if own_pool:
+        pool = RetryingPool(n_processes, max_retries=max_retries, 
+            speculate=speculate, verbose=verbose)
+    tasks = [pool.apply_async(func, args) for args in args_list]
+    if own_pool:
+        pool.close()
+        pool.join()
+    else:
+        for task in tasks:
+            task.wait()
+    return [task.get() for task in tasks], pool.report()
+
+class InFlightWindow(object):
+    """Limits how many chunks, and how many bytes, are in flight at once
+    
+    A chunk is in flight from when it is reserved, usually as its tiff 
+    stack starts being written, until its trace finishes. Chunks are 
+    dispatched to the pool through apply_async, and their result 
+    callback releases them. wait_for_slot blocks until there is room for
+    another chunk, and is woken by the callback as soon as a chunk
+    finishes, so the next chunk can be read right away.
+    
+    Room is limited by the number of chunks in flight, and optionally by
+    the actual size on disk of their files (tiff stack, .whiskers, and 
+    .measurements), which is also used to track the peak usage. With
+    hold_files, the files of a chunk keep counting after it finishes, 
+    until forget is called, e.g. once the chunk is stitched.
+    
+    A chunk that raises an error never calls back, so the ready state of
+    every in-flight chunk is also checked every poll_interval seconds.
+    """
+    def __init__(self, max_in_flight, poll_interval=1., max_bytes=None,
+        key_files=None, hold_files=False):
+        """Initialize a new window
+        
+        max_in_flight : maximum number of chunks reserved but not 
+            finished
+        poll_interval : how often to check for chunks that failed, and to
+            measure their files
+        max_bytes : maximum size of the files of the chunks in flight, 
+            plus the chunk about to be read, or None for no limit
+        key_files : function that takes the key of a chunk and returns
+            the names of its files. If None, the key is the only file.
+        hold_files : if True, the files of a chunk that finished still 
+            count towards max_bytes, until forget is called
+        """
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.max_bytes = max_bytes
+        if key_files is None:
+            key_files = lambda key: [key]
+        self.key_files = key_files
+        self.hold_files = hold_files
+        self.peak_bytes = 0
+        
+        # Map each key to its AsyncResult, or None until dispatched
+        self.in_flight = {}
+        
+        # Keys of the chunks that finished, whose files still count
+        self.held = set()
+        self.condition = threading.Condition()
+    
+    def reserve(self, key):
+        """Count the chunk as in flight, before it is dispatched"""
+        with self.condition:
+            self.in_flight[key] = None
+    
+    def release(self, key):
+        """Stop counting the chunk, for instance if it cannot be traced"""
+        with self.condition:
+            self.in_flight.pop(key, None)
+            self.condition.notify_all()
+    
+    def _finish(self, key):
+        """Stop counting the chunk as in flight, but hold its files"""
+        with self.condition:
+            self.in_flight.pop(key, None)
+            if self.hold_files:
+                self.held.add(key)
+            self.condition.notify_all()
+    
+    def forget(self, key):
+        """Stop counting the files of a finished chunk"""
+        with self.condition:
+            self.held.discard(key)
+            self.condition.notify_all()
+    
+    def apply_async(self, pool, func, args, key, callback=None):
+        """Dispatch func(*args) to pool, and count it until it finishes
+        
+        key : identifies this chunk, e.g. its tiff filename
+        callback : called with the result, before the chunk is released
+        
+        Returns: the AsyncResult
+        """
+        def on_finish(result):
+            try:
+                if callback is not None:
+                    callback(result)
+            finally:
+                # The .whiskers file is complete now
+                self.measure_bytes_in_flight()
+                self._finish(key)
+        
+        # Hold the lock so on_finish cannot run before the chunk is added
+        with self.condition:
+            async_result = pool.apply_async(func, args=args, 
+                callback=on_finish)
+            self.in_flight[key] = async_result
+        return async_result
+
+    def count_in_flight(self):
+        """Returns the number of chunks that have not finished"""
+        with self.condition:
+            # Forget chunks that are ready but never called back (errors)
+            for key, async_result in self.in_flight.items():
+                if async_result is not None and async_result.ready():
+                    self.in_flight.pop(key)
+            return len(self.in_flight)
+    
+    def measure_bytes_in_flight(self):
+        """Returns the total size of the files of the chunks in flight
+        
+        The files of the chunks held since they finished are included.
+        This also updates peak_bytes.
+        """
+        with self.condition:
+            keys = set(self.in_flight.keys()) | self.held
+        
+        nbytes = 0
+        for key in keys:
+            for filename in self.key_files(key):
+                try:
+                    nbytes += os.path.getsize(filename)
+                except OSError:
+                    # Not written yet, or deleted
+                    pass
+        
+        self.peak_bytes = max(self.peak_bytes, nbytes)
+        return nbytes
+    
+    def has_slot(self, nbytes=0):
+        """Returns True if another chunk of nbytes can be read now
+        
+        A chunk is always allowed when nothing is in flight, even if it
+        is larger than max_bytes.
+        """
+        n_in_flight = self.count_in_flight()
+        if n_in_flight >= self.max_in_flight:
+            return False
+        if self.max_bytes is not None and n_in_flight > 0:
+            if self.measure_bytes_in_flight() + nbytes > self.max_bytes:
+                return False
+        return True
+    
+    def wait_for_slot(self, nbytes=0):
+        """Block until another chunk of nbytes can be read"""
+        with self.condition:
+            while not self.has_slot(nbytes):
+                self.condition.wait(self.poll_interval)
+
+# Name of the manifest in the tiffs_to_trace_directory of a run
+MANIFEST_FILENAME = 'whiskiwrap_manifest.jsonl'
+
+class ChunkSizeTuner(object):
+    """Chooses the size of each chunk from how long the chunks take
+    
+    Each finished chunk is recorded with its number of frames and how 
+    long its worker took, and the durations are fit as
+        duration = overhead + n_frames * seconds_per_frame
+    where overhead is the fixed cost of each chunk, like starting trace
+    and loading its detector banks. The fit weights the chunks by 
+    exponentially less the longer ago they finished, so that it covers
+    about the last `history` chunks, and each fit then only moves the 
+    estimates by the fraction smoothing, because durations are noisy.
+    
+    The chunk size is then the smallest that keeps the overhead at most
+    max_overhead of each chunk's duration. Smaller chunks balance the load
+    better, because the last chunks of a run leave fewer workers idle, and
+    take less scratch space. The size is also limited so that a chunk 
+    takes at most max_chunk_seconds, and its frames take at most 
+    max_chunk_bytes, and it is always between min_chunk_size and 
+    max_chunk_size. The size is kept while it is at least that, and 
+    at most 1 + deadband times that, so that it holds once the overhead
+    is small enough.
+    
+    Sizes are multiples of step, which is also how many frames are read
+    at a time, and change by at most a factor of 2 per chunk finished.
+    
+    The overhead can only be fit to chunks of different sizes, and a fit
+    is only used if the standard error of its overhead is at most 
+    max_overhead_error of the mean duration. Until there is one, chunks
+    of half and twice the first size are alternated. After that, when 
+    the recent chunks are all about the same size, the last good fit of
+    the overhead is kept, and only seconds_per_frame follows the 
+    durations.
+    """
+    def __init__(self, chunk_size=200, min_chunk_size=20, 
+        max_chunk_size=2000, step=10, max_overhead=0.1, 
+        max_chunk_seconds=120., max_chunk_bytes=None, history=20,
+        deadband=0.25, max_overhead_error=0.1, smoothing=0.2):
+        """Initialize a new tuner
+        
+        chunk_size : the size to start with
+        max_chunk_bytes : only applies once frame_nbytes, the size of 
+            each frame, is set. The interleaved pipelines set it from 
+            the first frames read, and set max_chunk_bytes if None from
+            max_scratch_bytes and max_chunks_in_flight.
+        
+        See above for the others.
+        """
+        if min_chunk_size <= max(TRACE_UNSAFE_CHUNK_LENGTHS):
+            raise ValueError("min_chunk_size must be greater than %d" %
+                max(TRACE_UNSAFE_CHUNK_LENGTHS))
+        self.min_chunk_size = self._round(min_chunk_size, step)
+        self.max_chunk_size = max(self._round(max_chunk_size, step),
+            self.min_chunk_size)
+        self.step = step
+        self.max_overhead = max_overhead
+        self.max_chunk_seconds = max_chunk_seconds
+        self.max_chunk_bytes = max_chunk_bytes
+        self.frame_nbytes = None
+        self.history = history
+        self.deadband = deadband
+        self.max_overhead_error = max_overhead_error
+        self.smoothing = smoothing
+        
+        self.chunk_size = self._clip(self._round(chunk_size, step))
+        
+        # The sizes alternated between until the overhead can be fit
+        self.probe_sizes = (self._round(self.chunk_size / 2., step),
+            2 * self.chunk_size)
+        
+        # (n_frames, seconds) of each chunk, and the chunk size chosen
+        # after each one
+        self.observations = []
+        self.chunk_sizes = [self.chunk_size]
+        
+        # Exponentially weighted sums of 1, n_frames, seconds, and their 
+        # squares and product, from which the fit is calculated
+        self.sums = np.zeros(6)
+        
+        # The last good fit, or None
+        self.overhead = None
+        self.seconds_per_frame = None
+        
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def _round(n_frames, step):
+        """Round n_frames up to a multiple of step"""
+        return int(np.ceil(n_frames / float(step))) * step
+    
+    def _clip(self, chunk_size):
+        """Limit chunk_size to the allowed range, in multiples of step"""
+        upper = self.max_chunk_size
+        if self.max_chunk_bytes is not None and self.frame_nbytes:
+            upper = min(upper, int(self.max_chunk_bytes // 
+                self.frame_nbytes) // self.step * self.step)
+        return max(self.min_chunk_size, min(upper, chunk_size))
+    
+    def _smooth(self, estimate, value):
+        """Move estimate towards value by the fraction smoothing"""
+        if estimate is None:
+            return value
+        return estimate + self.smoothing * (value - estimate)
+    
+    def fit(self):
+        """Fit overhead and seconds_per_frame to the weighted chunks
+        
+        Returns: overhead, seconds_per_frame. overhead is None if it 
+            cannot be fit well enough, and then seconds_per_frame is fit
+            with the overhead of the last good fit, or 0 if none.
+        """
+        weight, sum_n, sum_s, sum_nn, sum_ss, sum_ns = self.sums
+        mean_n, mean_s = sum_n / weight, sum_s / weight
+        var_n = max(sum_nn / weight - mean_n ** 2, 0.)
+        
+        # The fit is worth about as much as the last history chunks
+        # A line can only be fit if the sizes differ by about 20%
+        n_effective = min(len(self.observations), self.history)
+        if n_effective >= 4 and np.sqrt(var_n) >= 0.1 * mean_n:
+            seconds_per_frame = (sum_ns / weight - mean_n * mean_s) / var_n
+            overhead = mean_s - seconds_per_frame * mean_n
+            
+            # The standard error of the overhead
+            var_residual = max(sum_ss / weight - mean_s ** 2 - 
+                seconds_per_frame ** 2 * var_n, 0.) * (
+                n_effective / (n_effective - 2.))
+            overhead_error = np.sqrt(var_residual * (sum_nn / weight) / 
+                (n_effective * var_n))
+            if seconds_per_frame > 0 and \
+                overhead_error <= self.max_overhead_error * mean_s:
+                return max(overhead, 0.), seconds_per_frame
+        
+        overhead = self.overhead if self.overhead is not None else 0.
+        seconds_per_frame = (mean_s - overhead) / mean_n
+        if seconds_per_frame <= 0:
+            seconds_per_frame = mean_s / mean_n
+        return None, seconds_per_frame
+    
+    def record(self, n_frames, seconds):
+        """Record that a chunk of n_frames took seconds, and choose anew
+        
+        Returns: the new chunk_size
+        """
+        if n_frames <= 0:
+            return self.chunk_size
+        with self.lock:
+            self.observations.append((n_frames, seconds))
+            self.sums = (self.sums * (1 - 1. / self.history) + 
+                [1., n_frames, seconds, n_frames ** 2, seconds ** 2, 
+                n_frames * seconds])
+            overhead, seconds_per_frame = self.fit()
+            if overhead is not None:
+                self.overhead = self._smooth(self.overhead, overhead)
+            self.seconds_per_frame = self._smooth(self.seconds_per_frame,
+                seconds_per_frame)
+            
+            if self.overhead is None:
+                # Alternate between two sizes, to tell overhead from frames
+                # They are clipped here, once frame_nbytes is known
+                small, large = [self._clip(probe_size) 
+                    for probe_size in self.probe_sizes]
+                if self.chunk_size == small:
+                    self.chunk_size = large
+                else:
+                    self.chunk_size = small
+                self.chunk_sizes.append(self.chunk_size)
+                return self.chunk_size
+            
+            # The smallest size that keeps the overhead small enough
+            target = (self.overhead * (1 - self.max_overhead) / 
+                (self.max_overhead * self.seconds_per_frame))
+            
+            # Limit the duration of each chunk
+            if self.seconds_per_frame > 0:
+                target = min(target, self.max_chunk_seconds / 
+                    self.seconds_per_frame)
+            
+            # Keep the size while it meets the target, unless it is 
+            # much larger than needed
+            if target <= self.chunk_size <= target * (1 + self.deadband):
+                target = self.chunk_size
+            
+            # Change gradually
+            target = max(self.chunk_size / 2., 
+                min(2. * self.chunk_size, target))
+            self.chunk_size = self._clip(self._round(target, self.step))
+            self.chunk_sizes.append(self.chunk_size)
+            return self.chunk_size
+
+def hash_file(filename, block_size=2 ** 20):
+    """Returns the SHA1 hex digest of the contents of filename"""
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as fi:
+        while True:
+            block = fi.read(block_size)
+            if len(block) == 0:
+                break
+            sha1.update(block)
+    return sha1.hexdigest()
+
+class RunManifest(object):
+    """A durable record of the progress of a tracing run
+    
+    Each event is appended to the manifest file as a line of JSON and
+    fsynced, so the file is valid up to the last event if the process 
+    dies. The first line records the parameters of the run. Then each 
+    chunk is recorded as its tiff stack is 'written', as it is 'traced' 
+    (or 'measured', if measure is run too), and as it is 'stitched', 
+    along with its frames, its files, and their sizes and hashes.
+    
+    Loading the file replays the events, so that self.chunks maps the
+    first frame of each chunk to a dict of everything recorded about it,
+    including its latest 'state'. plan_resume uses this to decide what
+    is left to do.
+    """
+    def __init__(self, filename, params=None):
+        """Start a new manifest, or load an existing one
+        
+        filename : the manifest file
+        params : dict of the parameters of the run. If not None, a new
+            manifest is started with them, overwriting filename. 
+            Otherwise filename is loaded.
+        """
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.params = None
+        self.chunks = {}
+        
+        if params is not None:
+            open(filename, 'w').close()
+            self._append({'event': 'start', 'params': params})
+        else:
+            with open(filename, 'r+b') as fi:
+                n_valid_bytes = 0
+                for line in iter(fi.readline, ''):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        record = None
+                    if record is None or not line.endswith('\n'):
+                        # A line that was cut off when the process died
+                        # Remove it, so that new events can be appended
+                        fi.truncate(n_valid_bytes)
+                        break
+                    self._replay(record)
+                    n_valid_bytes = n_valid_bytes + len(line)
+    
+    def _replay(self, record):
+        """Update params and chunks with a record"""
+        if record['event'] == 'start':
+            self.params = record['params']
+            self.chunks = {}
+        elif record['event'] == 'discarded':
+            self.chunks.pop(record['chunk_start'], None)
+        else:
+            chunk = self.chunks.setdefault(record['chunk_start'], {})
+            chunk.update(record)
+            chunk['state'] = record['event']
+    
+    def _append(self, record):
+        """Append a record to the file, and fsync it"""
+        with self.lock:
+            with open(self.filename, 'a') as fi:
+                fi.write(json.dumps(record) + '\n')
+                fi.flush()
+                os.fsync(fi.fileno())
+            self._replay(record)
+    
+    def record_written(self, chunk_start, n_frames, tif_filename):
+        """Record that a tiff stack has been written"""
+        self._append({'event': 'written', 'chunk_start': chunk_start,
+            'n_frames': n_frames, 'tif_filename': tif_filename,
+            'tif_size': os.path.getsize(tif_filename)})
+    
+    def record_traced(self, chunk_start, whisk_filename, 
+        measurements_filename=None):
+        """Record that a chunk has been traced, and maybe measured"""
+        record = {'event': 'traced', 'chunk_start': chunk_start,
+            'whisk_filename': whisk_filename,
+            'whisk_sha1': hash_file(whisk_filename)}
+        if measurements_filename is not None:
+            record['event'] = 'measured'
+            record['measurements_filename'] = measurements_filename
+            record['measurements_sha1'] = hash_file(measurements_filename)
+        self._append(record)
+    
+    def record_stitched(self, chunk_start, summary_nrows, pixels_nrows):
+        """Record that a chunk has been stitched
+        
+        summary_nrows, pixels_nrows : the number of rows of /summary and
+            /pixels_x in the HDF5 file after stitching it
+        """
+        self._append({'event': 'stitched', 'chunk_start': chunk_start,
+            'summary_nrows': summary_nrows, 'pixels_nrows': pixels_nrows})
+    
+    def record_discarded(self, chunk_start):
+        """Forget a chunk, which will be written again"""
+        self._append({'event': 'discarded', 'chunk_start': chunk_start})
+    
+    def _find_file(self, filename, directory, sha1=None, size=None):
+        """Returns where filename is now, or None if it is not valid
+        
+        Files may have been moved from a scratch directory into directory,
+        so that is checked first. The file must have the recorded sha1
+        and size, if they are not None.
+        """
+        for candidate in [
+            os.path.join(directory, os.path.split(filename)[1]), filename]:
+            if not os.path.exists(candidate):
+                continue
+            if size is not None and os.path.getsize(candidate) != size:
+                continue
+            if sha1 is not None and hash_file(candidate) != sha1:
+                continue
+            return candidate
+        return None
+    
+    def plan_resume(self, directory, summary_nrows=0, pixels_nrows=0):
+        """Decide how to resume the run from what was recorded
+        
+        The chunks are taken in order from the first frame, for as long
+        as each one is still usable:
+            stitched : if its rows are still in the HDF5 file, which holds
+                summary_nrows and pixels_nrows rows, and every earlier 
+                chunk is also stitched there
+            to_stitch : if its whiskers (and measurements) files are 
+                intact
+            to_trace : if its tiff stack is intact
+        Everything from the first unusable chunk on is read again.
+        
+        directory : where the files of the run are
+        
+        Returns: dict
+            resume_frame : first frame to read again
+            stitched : first frames of the chunks already stitched
+            summary_nrows, pixels_nrows : rows of the HDF5 file to keep
+            to_stitch : list of (chunk_start, whisk_filename, 
+                measurements_filename) to stitch without tracing
+            to_trace : list of (chunk_start, n_frames, tif_filename)
+        """
+        plan = {'resume_frame': 0, 'stitched': [], 'summary_nrows': 0,
+            'pixels_nrows': 0, 'to_stitch': [], 'to_trace': []}
+        
+        for chunk_start in sorted(self.chunks.keys()):
+            chunk = self.chunks[chunk_start]
+            if chunk_start != plan['resume_frame']:
+                break
+            
+            # Already in the HDF5 file
+            if (chunk['state'] == 'stitched' and 
+                len(plan['to_stitch']) == 0 and 
+                len(plan['to_trace']) == 0 and
+                chunk['summary_nrows'] <= summary_nrows and
+                chunk['pixels_nrows'] <= pixels_nrows):
+                plan['stitched'].append(chunk_start)
+                plan['summary_nrows'] = chunk['summary_nrows']
+                plan['pixels_nrows'] = chunk['pixels_nrows']
+                plan['resume_frame'] = chunk_start + chunk['n_frames']
+                continue
+            
+            # Traced, so only needs stitching
+            if chunk['state'] in ['traced', 'measured', 'stitched']:
+                whisk_filename = self._find_file(chunk['whisk_filename'],
+                    directory, sha1=chunk['whisk_sha1'])
+                if 'measurements_filename' in chunk:
+                    measurements_filename = self._find_file(
+                        chunk['measurements_filename'], directory,
+                        sha1=chunk['measurements_sha1'])
+                    measurements_ok = measurements_filename is not None
+                else:
+                    measurements_filename = None
+                    measurements_ok = True
+                if whisk_filename is not None and measurements_ok:
+                    plan['to_stitch'].append((chunk_start, whisk_filename,
+                        measurements_filename))
+                    plan['resume_frame'] = chunk_start + chunk['n_frames']
+                    continue
+            
+            # Written, so only needs tracing
+            tif_filename = self._find_file(chunk['tif_filename'], 
+                directory, size=chunk['tif_size'])
+            if tif_filename is not None:
+                plan['to_trace'].append((chunk_start, chunk['n_frames'],
+                    tif_filename))
+                plan['resume_frame'] = chunk_start + chunk['n_frames']
+                continue
+            
+            break
+        
+        return plan
+
+def _count_hdf5_rows(h5_filename):
+    """Returns the number of rows of /summary and /pixels_x
+    
+    Returns None if the file does not exist or cannot be read, for 
+    instance because the process writing it died.
+    """
+    if not os.path.exists(h5_filename):
+        return None
+    try:
+        with tables.open_file(h5_filename) as h5file:
+            return (h5file.get_node('/summary').nrows, 
+                h5file.get_node('/pixels_x').nrows)
+    except Exception as error:
+        print "cannot read %s: %s" % (h5_filename, error)
+        return None
+
+def _truncate_hdf5(h5_filename, summary_nrows, pixels_nrows):
+    """Remove the rows stitched into an HDF5 file after a checkpoint"""
+    with tables.open_file(h5_filename, mode='a') as h5file:
+        h5file.get_node('/summary').truncate(summary_nrows)
+        h5file.get_node('/pixels_x').truncate(pixels_nrows)
+        h5file.get_node('/pixels_y').truncate(pixels_nrows)
+
+def _interleaved_trace_pipeline(input_reader, tiffs_to_trace_directory,
+    measure=False, face='right', sensitive=False,
     chunk_size=200, chunk_name_pattern='chunk%08d.tif',
     stop_after_frame=None, delete_tiffs=True,
     timestamps_filename=None, monitor_video=None, 
     monitor_video_kwargs=None, write_monitor_ffmpeg_stderr_to_screen=False,
     h5_filename=None, frame_func=None,
     n_trace_processes=4, expectedrows=1000000,    
-    verbose=True, skip_stitch=False, face='right'
-    ):
-    """Read, write, and trace each chunk, one at a time.
+    verbose=True, skip_stitch=False, max_chunks_in_flight=None,
+    n_tiff_write_buffers=2, stream_tiffs=False, ram_scratch_bytes=0,
+    max_scratch_bytes=None, flush_interval=100000, pixel_layout='vlarray',
+    hdf5_kwargs=None, resume=False, chunk_timeout=None, max_retries=1,
+    speculate=False, adaptive_chunk_size=False, trace_pool=None, 
+    on_reading_done=None, chunk_func=None):
+    """Read, write, and trace (and optionally measure) each chunk
     
-    This is an alternative to first calling:
-        write_video_as_chunked_tiffs
-    And then calling
-        trace_chunked_tiffs
+    This implements interleaved_reading_and_tracing (measure=False) and 
+    interleaved_read_trace_and_measure (measure=True). See those
+    functions for documentation of the arguments.
     
-    input_reader : Typically a PFReader or FFmpegReader
-    tiffs_to_trace_directory : Location to write the tiffs
-    sensitive: if False, use default. If True, lower MIN_SIGNAL
-    chunk_size : frames per chunk
-    chunk_name_pattern : how to name them
-    stop_after_frame : break early, for debugging
-    delete_tiffs : whether to delete tiffs after done tracing
-    timestamps_filename : Where to store the timestamps
-        Only vallid for PFReader input_reader
-    monitor_video : filename for a monitor video
-        If None, no monitor video will be written
-    monitor_video_kwargs : kwargs to pass to FFmpegWriter for monitor
-    write_monitor_ffmpeg_stderr_to_screen : whether to display
-        output from ffmpeg writing instance
-    h5_filename : hdf5 file to stitch whiskers information into
-    frame_func : function to apply to each frame
-        If 'invert', will apply 255 - frame
-    n_trace_processes : number of simultaneous trace processes
-    expectedrows : how to set up hdf5 file
-    verbose : verbose
-    skip_stitch : skip the stitching phase
-    
-    Returns: dict
-        trace_pool_results : result of each call to trace
-        monitor_ff_stderr, monitor_ff_stdout : results from monitor
-            video ffmpeg instance
+    on_reading_done : function called without arguments once every 
+        frame has been read and written, or None. This is used by 
+        interleaved_batch_tracing.
     """
     ## Set up kwargs
     if monitor_video_kwargs is None:
         monitor_video_kwargs = {}
     
-    if frame_func == 'invert':
-        frame_func = lambda frame: 255 - frame
+    if max_chunks_in_flight is None:
+        max_chunks_in_flight = 2 * n_trace_processes
+    
+    # Streamed tiff stacks can only hold grayscale frames
+    if stream_tiffs and getattr(input_reader, 'pix_fmt', 'gray') != 'gray':
+        raise ValueError("stream_tiffs requires pix_fmt 'gray', not %r" % 
+            input_reader.pix_fmt)
+    
+    # Chunks read into a ring are queued for the tiff writer, and 
+    # partial chunks are buffered until the next read, without being 
+    # copied, so the ring must not come back around to them first
+    ring_size = getattr(input_reader, 'ring_size', None)
+    if ring_size is not None and not stream_tiffs and \
+        not adaptive_chunk_size and ring_size < n_tiff_write_buffers + 2:
+        raise ValueError("the reader's ring_size is %d, but writing with "
+            "n_tiff_write_buffers=%d requires a ring_size of at least %d" % (
+            ring_size, n_tiff_write_buffers, n_tiff_write_buffers + 2))
+    
+    # Choose the size of each chunk as they are traced
+    if adaptive_chunk_size is True:
+        tuner = ChunkSizeTuner(chunk_size)
+    elif adaptive_chunk_size:
+        tuner = adaptive_chunk_size
+    else:
+        tuner = None
     
     # Check commands
     WhiskiWrap.utils.probe_needed_commands()
     
+    ## Load the manifest of the previous run, or start a new one
+    manifest_filename = os.path.join(tiffs_to_trace_directory, 
+        MANIFEST_FILENAME)
+    params = {'chunk_size': chunk_size, 
+        'chunk_name_pattern': chunk_name_pattern, 'measure': measure,
+        'skip_stitch': skip_stitch, 'pixel_layout': pixel_layout}
+    if tuner is not None:
+        params['adaptive_chunk_size'] = True
+    
+    # The frames must be cropped the same way, or the chunks already 
+    # traced would not line up with the rest. The lists match the JSON
+    # read back from the manifest. No offset is stored as None.
+    crop = getattr(input_reader, 'crop', None)
+    roi_offset = getattr(input_reader, 'roi_offset', None)
+    params['crop'] = None if crop is None else map(int, crop)
+    params['roi_offset'] = (None if roi_offset is None or 
+        tuple(roi_offset) == (0, 0) else map(int, roi_offset))
+    plan = None
+    if resume and os.path.exists(manifest_filename):
+        manifest = RunManifest(manifest_filename)
+        for key, value in params.items():
+            if manifest.params.get(key) != value:
+                raise ValueError("cannot resume with %s=%r, the run used %r"
+                    % (key, value, manifest.params.get(key)))
+        
+        # Find what is left to do, given what survived in the HDF5 file
+        with HDF5_LOCK:
+            nrows = None if skip_stitch else _count_hdf5_rows(h5_filename)
+        if nrows is None:
+            nrows = (0, 0)
+        plan = manifest.plan_resume(tiffs_to_trace_directory, *nrows)
+        
+        # Everything after that will be written again
+        for chunk_start in sorted(manifest.chunks.keys()):
+            if chunk_start >= plan['resume_frame']:
+                manifest.record_discarded(chunk_start)
+        if verbose:
+            print "resuming at frame %d: %d chunks stitched, %d to stitch, "\
+                "%d to trace" % (plan['resume_frame'], len(plan['stitched']),
+                len(plan['to_stitch']), len(plan['to_trace']))
+    else:
+        if resume:
+            print "no manifest in %s, starting from the beginning" % (
+                tiffs_to_trace_directory)
+        manifest = RunManifest(manifest_filename, params=params)
+    resume_frame = 0 if plan is None else plan['resume_frame']
+    
+    # Start reading after the frames that are done
+    # This restarts ffmpeg, so do it before the HDF5 file is opened
+    # If the reader cannot seek, they are read and discarded instead
+    skip_frames = 0
+    if resume_frame > 0:
+        try:
+            input_reader.seek(resume_frame)
+        except (AttributeError, ValueError):
+            skip_frames = resume_frame
+        else:
+            if stop_after_frame is not None:
+                stop_after_frame = max(stop_after_frame - resume_frame, 0)
+    
     ## Initialize readers and writers
     if verbose:
         print "initalizing readers and writers"
-    # Tiff writer
-    ctw = WhiskiWrap.ChunkedTiffWriter(tiffs_to_trace_directory,
-        chunk_size=chunk_size, chunk_name_pattern=chunk_name_pattern)
+    # Scratch space in RAM, which also copies the parameters files
+    if ram_scratch_bytes > 0:
+        scratch = ScratchManager(tiffs_to_trace_directory, 
+            ram_budget=ram_scratch_bytes, sensitive=sensitive)
+    else:
+        scratch = None
+        copy_parameters_files(tiffs_to_trace_directory, sensitive=sensitive)
+    
+    ctw = None
+    stitcher = None
+    own_trace_pool = False
+    finished = False
+    
+    # Set if this run failed, so that a shared pool stops calling back
+    aborted = threading.Event()
+    try:
+        ## Set up the worker pool
+        # Pool of trace workers, which retries failed chunks and duplicates
+        # slow ones. It is started before the HDF5 file is opened and the
+        # writer and stitcher threads start, so that the workers do not 
+        # inherit them
+        own_trace_pool = trace_pool is None
+        if own_trace_pool:
+            trace_pool = RetryingPool(n_trace_processes, 
+                max_retries=max_retries, speculate=speculate, verbose=verbose)
+        
+        # Tiff writer
+        ctw = WhiskiWrap.ChunkedTiffWriter(tiffs_to_trace_directory,
+            chunk_size=chunk_size if tuner is None else tuner.chunk_size, 
+            chunk_name_pattern=chunk_name_pattern,
+            n_buffers=n_tiff_write_buffers, streaming=stream_tiffs,
+            scratch=scratch, first_frame=resume_frame)
 
-    # FFmpeg writer is initalized after first frame
-    ffw = None
+        # FFmpeg writer is initalized after first frame
+        ffw = None
 
-    # Setup the result file
-    if not skip_stitch:
-        setup_hdf5(h5_filename, expectedrows, measure=True)
+        # Setup the result file, and stitch each chunk when traced
+        if hdf5_kwargs is None:
+            hdf5_kwargs = {}
+        if not skip_stitch:
+            # When resuming, keep what was stitched
+            with HDF5_LOCK:
+                if plan is not None and len(plan['stitched']) > 0:
+                    _truncate_hdf5(h5_filename, plan['summary_nrows'], 
+                        plan['pixels_nrows'])
+                else:
+                    setup_hdf5(h5_filename, expectedrows, measure=measure,
+                        pixel_layout=pixel_layout, **hdf5_kwargs)
+        
+            # Once stitched, the whiskers can leave RAM
+            def on_stitched(chunk_start, whisk_filename, 
+                measurements_filename):
+                if scratch is not None:
+                    scratch.move_to_disk(whisk_filename)
+                    if measurements_filename is not None:
+                        scratch.move_to_disk(measurements_filename)
+                manifest.record_stitched(chunk_start, stitcher.summary_nrows,
+                    stitcher.pixels_nrows)
+                
+                # Its files no longer count towards max_scratch_bytes
+                window.forget(window_keys.pop(chunk_start, None))
+        
+            stitcher = HDF5Stitcher(h5_filename, 
+                roi_offset=getattr(input_reader, 'roi_offset', None),
+                flush_interval=flush_interval, on_stitched=on_stitched)
+        else:
+            stitcher = None
     
-    # Copy the parameters files
-    copy_parameters_files(tiffs_to_trace_directory, sensitive=sensitive)
+        # Limit the number and size of chunks waiting to be traced
+        def chunk_files(tif_filename):
+            fn = WhiskiWrap.utils.FileNamer.from_tiff_stack(tif_filename)
+            return [fn.tiff_stack, fn.whiskers, fn.measurements]
+        # The files of each chunk count until it is stitched, if it is
+        window = InFlightWindow(max_chunks_in_flight, 
+            max_bytes=max_scratch_bytes, key_files=chunk_files,
+            hold_files=stitcher is not None)
+        
+        # The window key of each chunk, by its first frame
+        window_keys = {}
     
-    ## Set up the worker pool
-    # Pool of trace workers
-    trace_pool = multiprocessing.Pool(n_trace_processes)        
+        # Keep track of results, and of the tasks, whose callbacks may 
+        # have failed
+        trace_pool_results = []
+        trace_tasks = []
     
-    # Keep track of results
-    trace_pool_results = []
-    deleted_tiffs = []
-    def log_result(result):
-        trace_pool_results.append(result)
+        # Register each chunk as it is created
+        def reserve(chunk_write):
+            window.reserve(chunk_write.filename)
+            window_keys[chunk_write.first_frame] = chunk_write.filename
+            if stitcher is not None:
+                stitcher.expect(chunk_write.first_frame)
     
-    ## Iterate over chunks
-    out_of_frames = False
-    nframe = 0
+        # Start trace on each chunk once it is completely written
+        # This is called by the tiff writer thread, unless writing is 
+        # synchronous. Failed writes are raised by ctw.close()
+        def start_trace(chunk_write):
+            if chunk_write.error is not None or aborted.is_set():
+                window.release(chunk_write.filename)
+                return
+            manifest.record_written(chunk_write.first_frame, 
+                chunk_write.n_frames, chunk_write.filename)
+        
+            # Log the result, and queue the chunk for stitching
+            # The tiff is deleted here rather than by the worker, because 
+            # another attempt at the chunk may still need it
+            def log_result(result):
+                if aborted.is_set():
+                    return
+                parsed = result.pop('parsed', None)
+                trace_pool_results.append(result)
+                if delete_tiffs:
+                    os.remove(chunk_write.filename)
+                if tuner is not None and 'duration' in result:
+                    tuner.record(chunk_write.n_frames, result['duration'])
+                fn = WhiskiWrap.utils.FileNamer.from_tiff_stack(
+                    chunk_write.filename)
+                manifest.record_traced(chunk_write.first_frame, fn.whiskers,
+                    fn.measurements if measure else None)
+                if stitcher is not None:
+                    stitcher.add_chunk(chunk_write.first_frame, fn.whiskers,
+                        fn.measurements if measure else None, parsed=parsed)
+        
+            # The workers also parse the result, unless it is not stitched
+            if stitcher is not None:
+                trace_task = window.apply_async(trace_pool, 
+                    trace_and_parse_chunk, 
+                    args=(chunk_write.filename, False, measure, face, 
+                        chunk_timeout, chunk_write.first_frame, 
+                        stitcher.dtype, stitcher.roi_offset), 
+                    key=chunk_write.filename, callback=log_result)
+            elif measure:
+                trace_task = window.apply_async(trace_pool, 
+                    trace_and_measure_chunk, 
+                    args=(chunk_write.filename, False, face, chunk_timeout), 
+                    key=chunk_write.filename, callback=log_result)
+            else:
+                trace_task = window.apply_async(trace_pool, trace_chunk, 
+                    args=(chunk_write.filename, False, chunk_timeout), 
+                    key=chunk_write.filename, callback=log_result)
+            trace_tasks.append(trace_task)
     
-    # Init the iterator outside of the loop so that it persists
-    iter_obj = input_reader.iter_frames()
+        ## Finish the chunks left by the previous run
+        resumed_filenames = []
+        if plan is not None:
+            if stitcher is not None:
+                for chunk_start, whisk_filename, measurements_filename in \
+                    plan['to_stitch']:
+                    stitcher.expect(chunk_start)
+                    stitcher.add_chunk(chunk_start, whisk_filename, 
+                        measurements_filename)
+            for chunk_start, n_frames, tif_filename in plan['to_trace']:
+                chunk_write = ChunkWrite(tif_filename, chunk_start, n_frames)
+                chunk_write._finish()
+                resumed_filenames.append(tif_filename)
+                reserve(chunk_write)
+                start_trace(chunk_write)
     
-    while not out_of_frames:
-        # Get a chunk of frames
-        if verbose:
-            print "loading chunk of frames starting with ", nframe
-        chunk_of_frames = []
-        for frame in iter_obj:
-            if frame_func is not None:
-                frame = frame_func(frame)
-            chunk_of_frames.append(frame)
-            nframe = nframe + 1
-            if stop_after_frame is not None and nframe >= stop_after_frame:
-                break
-            if len(chunk_of_frames) == chunk_size:
-                break
+        ## Iterate over chunks
+        nframe = resume_frame
     
-        # Check if we ran out
-        if len(chunk_of_frames) != chunk_size:
-            out_of_frames = True
+        # Each chunk is read as a single array
+        # When streaming, each frame is read as an array of one frame instead
+        # When tuning, frames are read tuner.step at a time, and the writer
+        # collects them into chunks of the size chosen by the tuner
+        if stream_tiffs:
+            read_size = 1
+        elif tuner is not None:
+            read_size = tuner.step
+        else:
+            read_size = chunk_size
+        chunk_iterator = iter_chunks_of_frames(input_reader, read_size,
+            frame_func=frame_func, stop_after_frame=stop_after_frame,
+            skip_frames=skip_frames, chunk_func=chunk_func)
+    
+        try:
+            for chunk_of_frames in chunk_iterator:
+                if verbose and nframe % chunk_size == 0:
+                    print "loaded chunk of frames starting with ", nframe
+                nframe = nframe + len(chunk_of_frames)
                 
-        ## Write tiffs
-        # We do this synchronously to ensure that it happens before
-        # the trace starts
-        for frame in chunk_of_frames:
-            ctw.write(frame)        
-        
-        # Make sure the chunk was written, in case this is the last one
-        # and we didn't reach chunk_size yet
-        if len(chunk_of_frames) != chunk_size:
-            ctw._write_chunk()
-        assert ctw.count_unwritten_frames() == 0
-
-        # Figure out which tiff file was just generated
-        tif_filename = ctw.chunknames_written[-1]
-        
-        ## Start trace
-        trace_pool.apply_async(trace_and_measure_chunk, args=(tif_filename, delete_tiffs, face),
-            callback=log_result)
-        
-        ## Determine whether we can delete any tiffs
-        #~ if delete_tiffs:
-            #~ tiffs_to_delete = [
-                #~ tpres['video_filename'] for tpres in trace_pool_results
-                #~ if tpres['video_filename'] not in deleted_tiffs]
-            #~ for filename in tiffs_to_delete:
-                #~ if verbose:
-                    #~ print "deleting", filename
-                #~ os.remove(filename)
+                ## Write tiffs, and start trace when written
+                # With n_tiff_write_buffers > 0 this happens in the 
+                # background, while the next chunk is read
+                if stream_tiffs:
+                    chunk_writes = [ctw.write(chunk_of_frames[0])]
+                elif tuner is not None:
+                    # The frames wait in the writer's buffer, so copy them in
+                    # case the reader reuses its buffers
+                    chunk_writes = ctw.write_chunk(np.array(chunk_of_frames))
+                else:
+                    chunk_writes = ctw.write_chunk(chunk_of_frames)
+                chunk_started = False
+                for chunk_write in chunk_writes:
+                    if chunk_write is not None:
+                        reserve(chunk_write)
+                        chunk_write.add_done_callback(start_trace)
+                        chunk_started = True
+        
+                # Start the next chunk at the size the tuner chose
+                if tuner is not None:
+                    if tuner.frame_nbytes is None:
+                        tuner.frame_nbytes = chunk_of_frames[0].nbytes
+                        if tuner.max_chunk_bytes is None and \
+                            max_scratch_bytes is not None:
+                            tuner.max_chunk_bytes = (max_scratch_bytes / 
+                                float(max_chunks_in_flight))
+                    if ctw.count_unwritten_frames() == 0:
+                        ctw.chunk_size = tuner.chunk_size
     
-        ## Start monitor encode
-        # This is also synchronous, otherwise the input buffer might fill up
-        if monitor_video is not None:        
-            if ffw is None:
-                ffw = WhiskiWrap.FFmpegWriter(monitor_video, 
-                    frame_width=frame.shape[1], frame_height=frame.shape[0],
-                    write_stderr_to_screen=write_monitor_ffmpeg_stderr_to_screen,
-                    **monitor_video_kwargs)
-            for frame in chunk_of_frames:
-                ffw.write(frame)        
+                ## Start monitor encode
+                # This is also synchronous, otherwise the input buffer might
+                # fill up
+                if monitor_video is not None:        
+                    if ffw is None:
+                        ffw = WhiskiWrap.FFmpegWriter(monitor_video, 
+                            frame_width=chunk_of_frames.shape[2],
+                            frame_height=chunk_of_frames.shape[1],
+                            write_stderr_to_screen=(
+                                write_monitor_ffmpeg_stderr_to_screen),
+                            **monitor_video_kwargs)
+                    ffw.write(chunk_of_frames)
         
-        ## Determine if we should pause
-        while len(ctw.chunknames_written) > len(trace_pool_results) + 2 * n_trace_processes:
-            print "waiting for tracing to catch up"
-            time.sleep(30)
+                ## Determine if we should pause
+                # Only starting a chunk fills the window, so it is only 
+                # checked then, rather than measuring the files in flight
+                # after every read
+                # This returns as soon as a chunk finishes tracing
+                if chunk_started:
+                    chunk_nbytes = chunk_of_frames[0].nbytes * ctw.chunk_size
+                    if not window.has_slot(chunk_nbytes):
+                        if verbose:
+                            print "waiting for tracing to catch up"
+                        window.wait_for_slot(chunk_nbytes)
+        finally:
+            # Stop the reader, in case this stopped early
+            chunk_iterator.close()
     
-    ## Wait for trace to complete
-    if verbose:
-        print "done with reading and writing, just waiting for tracing"
-    # Tell it no more jobs, so close when done
-    trace_pool.close()
+        ## Wait for the tiffs to be written, which starts the last traces
+        # A final partial chunk that trace would fail on is split in two
+        for chunk_write in ctw.write_safe_tail():
+            reserve(chunk_write)
+            chunk_write.add_done_callback(start_trace)
+    
+        # This writes any other final partial chunk
+        final_chunk_write = ctw.close()
+        if final_chunk_write is not None:
+            reserve(final_chunk_write)
+            final_chunk_write.add_done_callback(start_trace)
+        if on_reading_done is not None:
+            on_reading_done()
+    
+        ## Wait for trace to complete
+        if verbose:
+            print "done with reading and writing, just waiting for tracing"
+        # Tell it no more jobs, so close when done
+        # A shared pool keeps running for the other sessions
+        if own_trace_pool:
+            trace_pool.close()
+    
+        # Wait for everything to finish, measuring the files meanwhile
+        while window.count_in_flight() > 0:
+            window.measure_bytes_in_flight()
+            time.sleep(window.poll_interval)
+        if own_trace_pool:
+            trace_pool.join()
+        
+        # Raise the first error of logging or stitching a result, which a
+        # shared pool does not raise
+        for trace_task in trace_tasks:
+            if getattr(trace_task, 'callback_error', None) is not None:
+                trace_task.get()
+    
+        if verbose:
+            print "peak scratch usage: %d bytes" % window.peak_bytes
+    
+        # Finish stitching, which has been running all along
+        # This closes the file even if some chunks were not traced
+        if stitcher is not None:
+            if verbose:
+                print "finishing stitching"
+            stitcher.close()
     
-    # Wait for everything to finish
-    trace_pool.join()
+        ## Error check the tifs that were processed
+        # Get the tifs we wrote, and the tifs we trace
+        written_chunks = sorted(ctw.chunknames_written + resumed_filenames)
+        traced_filenames = sorted([
+            res['video_filename'] for res in trace_pool_results])
     
-    ## Error check the tifs that were processed
-    # Get the tifs we wrote, and the tifs we trace
-    written_chunks = sorted(ctw.chunknames_written)
-    traced_filenames = sorted([
-        res['video_filename'] for res in trace_pool_results])
+        # Check that they are the same
+        if written_chunks != traced_filenames:
+            raise ValueError("not all chunks were traced")
     
-    # Check that they are the same
-    if not np.all(np.array(written_chunks) == np.array(traced_filenames)):
-        raise ValueError("not all chunks were traced")
+        # Report the chunks that needed more than one attempt
+        retried_chunks = dict([(filename, attempts) 
+            for filename, attempts in trace_pool.report().items()
+            if filename in written_chunks])
+        if verbose and len(retried_chunks) > 0:
+            print "chunks that were retried or duplicated: %s" % (
+                ', '.join(sorted(retried_chunks.keys())))
 
-    ## Extract the chunk numbers from the filenames
-    # The tiffs have been written, figure out which they are
-    split_traced_filenames = [os.path.split(fn)[1] for fn in traced_filenames]
-    tif_file_number_strings = my.misc.apply_and_filter_by_regex(
-        '^chunk(\d+).tif$', split_traced_filenames, sort=False)
-    tif_full_filenames = [
-        os.path.join(tiffs_to_trace_directory, 'chunk%s.tif' % fns)
-        for fns in tif_file_number_strings]
-    tif_file_numbers = map(int, tif_file_number_strings)
-    tif_ordering = np.argsort(tif_file_numbers)
-    tif_sorted_filenames = np.array(tif_full_filenames)[
-        tif_ordering]
-    tif_sorted_file_numbers = np.array(tif_file_numbers)[
-        tif_ordering]
+        ## Extract the chunk numbers from the filenames
+        # The tiffs have been written, figure out which they are
+        split_traced_filenames = [os.path.split(fn)[1] 
+            for fn in traced_filenames]
+        tif_file_number_strings = my.misc.apply_and_filter_by_regex(
+            '^chunk(\d+).tif$', split_traced_filenames, sort=False)
     
-    # stitch
-    if not skip_stitch:
-        print "Stitching"
-        zobj = zip(tif_sorted_file_numbers, tif_sorted_filenames)
-        for chunk_start, chunk_name in zobj:
-            # Append each chunk to the hdf5 file
-            fn = WhiskiWrap.utils.FileNamer.from_tiff_stack(chunk_name)
-            append_whiskers_to_hdf5(
-                whisk_filename=fn.whiskers,
-		measurements_filename = fn.measurements,
-                h5_filename=h5_filename, 
-                chunk_start=chunk_start)
+        # They can be in the RAM scratch directory or on disk
+        split_to_full_filename = dict(zip(split_traced_filenames, 
+            traced_filenames))
+        tif_full_filenames = [split_to_full_filename['chunk%s.tif' % fns]
+            for fns in tif_file_number_strings]
+        tif_file_numbers = map(int, tif_file_number_strings)
+        tif_ordering = np.argsort(tif_file_numbers)
+        tif_sorted_filenames = np.array(tif_full_filenames)[
+            tif_ordering]
+        tif_sorted_file_numbers = np.array(tif_file_numbers)[
+            tif_ordering]
 
-    # Finalize writers
-    ctw.close()
-    if ffw is not None:
-        ff_stdout, ff_stderr = ffw.close()
-    else:
-        ff_stdout, ff_stderr = None, None
+        # Finalize writers
+        if ffw is not None:
+            ff_stdout, ff_stderr = ffw.close()
+        else:
+            ff_stdout, ff_stderr = None, None
 
-    # Also write timestamps as numpy file
-    if hasattr(input_reader, 'timestamps') and timestamps_filename is not None:
-        timestamps = np.concatenate(input_reader.timestamps)
-        assert len(timestamps) >= ctw.frames_written
-        np.save(timestamps_filename, timestamps[:ctw.frames_written])
+        # Also write timestamps as numpy file
+        if hasattr(input_reader, 'timestamps') and \
+            timestamps_filename is not None:
+            timestamps = np.concatenate(input_reader.timestamps)
+            assert len(timestamps) >= ctw.frames_written
+            np.save(timestamps_filename, timestamps[:ctw.frames_written])
 
-    return {'trace_pool_results': trace_pool_results,
-        'monitor_ff_stdout': ff_stdout,
-        'monitor_ff_stderr': ff_stderr,
-        'tif_sorted_file_numbers': tif_sorted_file_numbers,
-        'tif_sorted_filenames': tif_sorted_filenames,
-        }
+        result = {'trace_pool_results': trace_pool_results,
+            'monitor_ff_stdout': ff_stdout,
+            'monitor_ff_stderr': ff_stderr,
+            'tif_sorted_file_numbers': tif_sorted_file_numbers,
+            'tif_sorted_filenames': tif_sorted_filenames,
+            'peak_scratch_bytes': window.peak_bytes,
+            'resume_frame': resume_frame,
+            'retried_chunks': retried_chunks,
+            'chunk_size_tuner': tuner,
+            }
+        finished = True
+        return result
+    finally:
+        # On an error, stop tracing, and close the HDF5 file with the 
+        # chunks stitched so far, so that the run can be resumed
+        # A shared pool keeps running for the other sessions
+        if not finished:
+            aborted.set()
+            if own_trace_pool and trace_pool is not None:
+                trace_pool.terminate()
+            
+            # Stop the writer thread. The chunks it still writes are not 
+            # traced
+            if ctw is not None:
+                try:
+                    ctw.close()
+                except Exception as error:
+                    print "error closing the tiff writer: %r" % error
+            if stitcher is not None:
+                try:
+                    stitcher.close()
+                except Exception as error:
+                    print "error closing %s: %r" % (h5_filename, error)
+        
+        # Move the whiskers out of RAM, and remove the RAM directory, even
+        # if something failed
+        if scratch is not None:
+            scratch.close()
 
+def interleaved_read_trace_and_measure(input_reader, tiffs_to_trace_directory,
+    sensitive=False,
+    chunk_size=200, chunk_name_pattern='chunk%08d.tif',
+    stop_after_frame=None, delete_tiffs=True,
+    timestamps_filename=None, monitor_video=None, 
+    monitor_video_kwargs=None, write_monitor_ffmpeg_stderr_to_screen=False,
+    h5_filename=None, frame_func=None,
+    n_trace_processes=4, expectedrows=1000000,    
+    verbose=True, skip_stitch=False, face='right', max_chunks_in_flight=None,
+    n_tiff_write_buffers=2, stream_tiffs=False, ram_scratch_bytes=0,
+    max_scratch_bytes=None, flush_interval=100000, pixel_layout='vlarray',
+    hdf5_kwargs=None, resume=False, chunk_timeout=None, max_retries=1,
+    speculate=False, adaptive_chunk_size=False, trace_pool=None,
+    chunk_func=None):
+    """Read, write, trace, and measure each chunk, one at a time.
+    
+    This is the same as interleaved_reading_and_tracing, except that
+    measure is also run on each chunk, and the measurements are stitched 
+    into the HDF5 file along with the whiskers.
+    
+    face : which side of the frame the face is on, sent to measure
+    
+    See interleaved_reading_and_tracing for the other arguments and the
+    return value.
+    """
+    return _interleaved_trace_pipeline(input_reader, tiffs_to_trace_directory,
+        measure=True, face=face, sensitive=sensitive,
+        chunk_size=chunk_size, chunk_name_pattern=chunk_name_pattern,
+        stop_after_frame=stop_after_frame, delete_tiffs=delete_tiffs,
+        timestamps_filename=timestamps_filename, monitor_video=monitor_video,
+        monitor_video_kwargs=monitor_video_kwargs, 
+        write_monitor_ffmpeg_stderr_to_screen=write_monitor_ffmpeg_stderr_to_screen,
+        h5_filename=h5_filename, frame_func=frame_func,
+        n_trace_processes=n_trace_processes, expectedrows=expectedrows,
+        verbose=verbose, skip_stitch=skip_stitch, 
+        max_chunks_in_flight=max_chunks_in_flight,
+        n_tiff_write_buffers=n_tiff_write_buffers, stream_tiffs=stream_tiffs,
+        ram_scratch_bytes=ram_scratch_bytes, 
+        max_scratch_bytes=max_scratch_bytes, flush_interval=flush_interval,
+        pixel_layout=pixel_layout, hdf5_kwargs=hdf5_kwargs, resume=resume,
+        chunk_timeout=chunk_timeout, max_retries=max_retries, 
+        speculate=speculate, adaptive_chunk_size=adaptive_chunk_size,
+        trace_pool=trace_pool, chunk_func=chunk_func)
 
 def interleaved_reading_and_tracing(input_reader, tiffs_to_trace_directory,
     sensitive=False,
@@ -791,8 +3080,12 @@ def interleaved_reading_and_tracing(input_reader, tiffs_to_trace_directory,
     monitor_video_kwargs=None, write_monitor_ffmpeg_stderr_to_screen=False,
     h5_filename=None, frame_func=None,
     n_trace_processes=4, expectedrows=1000000,    
-    verbose=True, skip_stitch=False,
-    ):
+    verbose=True, skip_stitch=False, max_chunks_in_flight=None,
+    n_tiff_write_buffers=2, stream_tiffs=False, ram_scratch_bytes=0,
+    max_scratch_bytes=None, flush_interval=100000, pixel_layout='vlarray',
+    hdf5_kwargs=None, resume=False, chunk_timeout=None, max_retries=1,
+    speculate=False, adaptive_chunk_size=False, trace_pool=None,
+    chunk_func=None):
     """Read, write, and trace each chunk, one at a time.
     
     This is an alternative to first calling:
@@ -801,9 +3094,14 @@ def interleaved_reading_and_tracing(input_reader, tiffs_to_trace_directory,
         trace_chunked_tiffs
     
     input_reader : Typically a PFReader or FFmpegReader
+        If it has a roi_offset attribute, as an FFmpegReader with a crop
+        does, the stitched coordinates are shifted back into the full
+        frame.
     tiffs_to_trace_directory : Location to write the tiffs
     sensitive: if False, use default. If True, lower MIN_SIGNAL
     chunk_size : frames per chunk
+        A final partial chunk of 3 or 4 frames, which trace cannot 
+        handle, is split into two shorter chunks.
     chunk_name_pattern : how to name them
     stop_after_frame : break early, for debugging
     delete_tiffs : whether to delete tiffs after done tracing
@@ -815,191 +3113,228 @@ def interleaved_reading_and_tracing(input_reader, tiffs_to_trace_directory,
     write_monitor_ffmpeg_stderr_to_screen : whether to display
         output from ffmpeg writing instance
     h5_filename : hdf5 file to stitch whiskers information into
+        Each chunk is stitched as soon as it and all earlier chunks are
+        traced, while later chunks are still being traced.
     frame_func : function to apply to each frame
-        If 'invert', will apply 255 - frame
+        If 'invert', will apply 255 - frame, to each whole chunk at once
+    chunk_func : function to apply to each whole chunk of frames, or None
+        Use this instead of frame_func for functions that work on arrays
+        of frames, which avoids calling them once per frame. See 
+        iter_chunks_of_frames.
     n_trace_processes : number of simultaneous trace processes
     expectedrows : how to set up hdf5 file
     verbose : verbose
     skip_stitch : skip the stitching phase
+    max_chunks_in_flight : maximum number of chunks that have been 
+        written but not yet traced. Reading pauses when this many are 
+        waiting, and resumes as soon as one of them finishes.
+        If None, 2 * n_trace_processes.
+    n_tiff_write_buffers : number of chunks that can be queued for the
+        background tiff writer, so that reading continues while they are
+        written. Each chunk is traced once it is written and fsynced.
+        If 0, each chunk is written before the next is read.
+        With an FFmpegReader in ring mode, its ring_size must be at least
+        n_tiff_write_buffers + 2, or ValueError is raised.
+    stream_tiffs : if True, frames are read one at a time and streamed 
+        straight into the tiff stacks with RawTiffWriter, so that no 
+        chunk of frames is held in memory. This allows much larger 
+        chunk_size and max_chunks_in_flight. This requires grayscale 
+        frames, so ValueError is raised if the reader's pix_fmt is not 
+        'gray'.
+        If False, each chunk is read as a single array and written with
+        tifffile.
+    ram_scratch_bytes : if greater than 0, chunks are written to a
+        ScratchManager directory in /dev/shm while the files there take
+        up less than this many bytes, and to tiffs_to_trace_directory
+        otherwise. After stitching, the files left in /dev/shm, like the
+        .whiskers files, are moved to tiffs_to_trace_directory.
+    max_scratch_bytes : maximum number of bytes of scratch files, or None
+        for no limit. Reading pauses while the tiff stacks, .whiskers, and
+        .measurements files of the chunks that are written but not yet
+        stitched (or traced, if skip_stitch), plus the next chunk, would
+        take up more than this. Their actual sizes on disk are used, 
+        including tiffs kept by delete_tiffs=False. The .whiskers files 
+        keep growing after a chunk is admitted, so leave some headroom.
+    flush_interval : flush the HDF5 file after stitching this many 
+        whisker segments
+    pixel_layout : how to store the pixels of each whisker in the HDF5
+        file, 'vlarray' or 'flat'. See setup_hdf5.
+    hdf5_kwargs : dict of other kwargs to pass to setup_hdf5, like 
+        complib, complevel and chunkshape
+    resume : if True, continue a run that was interrupted, using the
+        RunManifest it left in tiffs_to_trace_directory. The HDF5 file
+        is kept up to the last chunk stitched, chunks that were traced 
+        or written are stitched or traced without being read again, and 
+        reading starts at the first frame after them. input_reader must
+        be a fresh reader of the same input, with the same crop, or
+        ValueError is raised. If it can seek, like an FFmpegReader with
+        a frame_index, it seeks there; otherwise the frames before are 
+        read and discarded. The monitor video and the timestamps only 
+        include the frames read after resuming.
+        If there is no manifest, the run starts from the beginning.
+        Every run writes a manifest, so that it can be resumed.
+    chunk_timeout : if not None, trace (and measure) are killed after 
+        running for this many seconds on a chunk, which counts as a 
+        failure
+    max_retries : how many times to trace a chunk again after it fails
+    speculate : if True, when trace workers are idle, chunks that are 
+        taking much longer than usual are traced again in parallel, and 
+        whichever finishes first is used. See RetryingPool.
+    adaptive_chunk_size : if True, chunk_size is only the size of the 
+        first chunks. The size of later chunks is chosen by a 
+        ChunkSizeTuner, from how long the chunks before took to trace,
+        to keep the overhead of each chunk small while balancing the 
+        load and limiting memory. Frames are read ChunkSizeTuner.step 
+        at a time. This can also be a ChunkSizeTuner, to choose its 
+        limits.
+    trace_pool : where to trace the chunks. If None, a RetryingPool of 
+        n_trace_processes local workers is created for this run. 
+        Otherwise a RetryingPool shared with other runs, or a 
+        spool.SpoolPool to trace on other computers. It is not closed, 
+        and its own max_retries and speculate apply.
     
     Returns: dict
         trace_pool_results : result of each call to trace
         monitor_ff_stderr, monitor_ff_stdout : results from monitor
             video ffmpeg instance
+        peak_scratch_bytes : the largest total size of the scratch files
+            of the chunks in flight that was measured
+        resume_frame : the frame reading started at, which is 0 unless
+            resuming
+        retried_chunks : dict from the tiff filename of each chunk that
+            failed, was retried, or was duplicated, to its attempts. See
+            RetryingPool.report.
+        chunk_size_tuner : the ChunkSizeTuner, with the size it chose 
+            after each chunk, or None
     """
-    ## Set up kwargs
-    if monitor_video_kwargs is None:
-        monitor_video_kwargs = {}
-    
-    if frame_func == 'invert':
-        frame_func = lambda frame: 255 - frame
-    
-    # Check commands
-    WhiskiWrap.utils.probe_needed_commands()
-    
-    ## Initialize readers and writers
-    if verbose:
-        print "initalizing readers and writers"
-    # Tiff writer
-    ctw = WhiskiWrap.ChunkedTiffWriter(tiffs_to_trace_directory,
-        chunk_size=chunk_size, chunk_name_pattern=chunk_name_pattern)
+    return _interleaved_trace_pipeline(input_reader, tiffs_to_trace_directory,
+        measure=False, sensitive=sensitive,
+        chunk_size=chunk_size, chunk_name_pattern=chunk_name_pattern,
+        stop_after_frame=stop_after_frame, delete_tiffs=delete_tiffs,
+        timestamps_filename=timestamps_filename, monitor_video=monitor_video,
+        monitor_video_kwargs=monitor_video_kwargs, 
+        write_monitor_ffmpeg_stderr_to_screen=write_monitor_ffmpeg_stderr_to_screen,
+        h5_filename=h5_filename, frame_func=frame_func,
+        n_trace_processes=n_trace_processes, expectedrows=expectedrows,
+        verbose=verbose, skip_stitch=skip_stitch, 
+        max_chunks_in_flight=max_chunks_in_flight,
+        n_tiff_write_buffers=n_tiff_write_buffers, stream_tiffs=stream_tiffs,
+        ram_scratch_bytes=ram_scratch_bytes, 
+        max_scratch_bytes=max_scratch_bytes, flush_interval=flush_interval,
+        pixel_layout=pixel_layout, hdf5_kwargs=hdf5_kwargs, resume=resume,
+        chunk_timeout=chunk_timeout, max_retries=max_retries, 
+        speculate=speculate, adaptive_chunk_size=adaptive_chunk_size,
+        trace_pool=trace_pool, chunk_func=chunk_func)
 
-    # FFmpeg writer is initalized after first frame
-    ffw = None
-
-    # Setup the result file
-    if not skip_stitch:
-        setup_hdf5(h5_filename, expectedrows)
+def interleaved_batch_tracing(jobs, n_trace_processes=4, 
+    max_reading_sessions=2, measure=False, max_retries=1, speculate=False,
+    verbose=True, trace_pool=None, **kwargs):
+    """Trace several sessions at once, sharing one pool of trace workers
     
-    # Copy the parameters files
-    copy_parameters_files(tiffs_to_trace_directory, sensitive=sensitive)
+    Each session is run by interleaved_reading_and_tracing (or 
+    interleaved_read_trace_and_measure) in its own thread, but the chunks
+    of every session are traced by a single RetryingPool of 
+    n_trace_processes workers, in the order they are written. Each 
+    session still has its own HDF5 file, stitched in order by its own 
+    HDF5Stitcher, and its own manifest, so it can be resumed by itself.
     
-    ## Set up the worker pool
-    # Pool of trace workers
-    trace_pool = multiprocessing.Pool(n_trace_processes)        
+    Up to max_reading_sessions sessions read their input at once. As soon
+    as a session has read all of its frames, and is only waiting for its
+    last chunks to be traced, the next session starts reading. So the 
+    workers stay busy until the last session is done, instead of idling
+    at the end of every session.
     
-    # Keep track of results
-    trace_pool_results = []
-    deleted_tiffs = []
-    def log_result(result):
-        trace_pool_results.append(result)
+    jobs : list of sessions. Each is either a tuple (input_reader, 
+        tiffs_to_trace_directory, h5_filename), or a dict of arguments to
+        interleaved_reading_and_tracing that includes those three. The 
+        arguments in a dict override kwargs for that session.
+    n_trace_processes : number of trace workers shared by all sessions
+    max_reading_sessions : how many sessions can read at once
+    measure : if True, measure is also run on each chunk, and face can be
+        passed as an argument
+    max_retries, speculate : see interleaved_reading_and_tracing. They
+        apply to the shared pool.
+    verbose : verbose
+    trace_pool : if not None, the chunks are traced by this instead, 
+        like a spool.SpoolPool, and it is not closed
+    kwargs : other arguments to interleaved_reading_and_tracing, for 
+        every session, like chunk_size or chunk_timeout
     
-    ## Iterate over chunks
-    out_of_frames = False
-    nframe = 0
+    Returns: list with, for each job, the dict returned by 
+        interleaved_reading_and_tracing, or the exception it raised. An
+        error in one session does not stop the others.
+    """
+    # Every session's arguments
+    session_kwargs_l = []
+    for job in jobs:
+        session_kwargs = dict(kwargs)
+        if isinstance(job, dict):
+            session_kwargs.update(job)
+        else:
+            session_kwargs['input_reader'], \
+                session_kwargs['tiffs_to_trace_directory'], \
+                session_kwargs['h5_filename'] = job
+        session_kwargs['n_trace_processes'] = n_trace_processes
+        session_kwargs['measure'] = measure
+        session_kwargs.setdefault('verbose', verbose)
+        session_kwargs_l.append(session_kwargs)
     
-    # Init the iterator outside of the loop so that it persists
-    iter_obj = input_reader.iter_frames()
+    # Start the workers before any file is opened, so they inherit none
+    own_trace_pool = trace_pool is None
+    if own_trace_pool:
+        trace_pool = RetryingPool(n_trace_processes, 
+            max_retries=max_retries, speculate=speculate, verbose=verbose)
     
-    while not out_of_frames:
-        # Get a chunk of frames
-        if verbose:
-            print "loading chunk of frames starting with ", nframe
-        chunk_of_frames = []
-        for frame in iter_obj:
-            if frame_func is not None:
-                frame = frame_func(frame)
-            chunk_of_frames.append(frame)
-            nframe = nframe + 1
-            if stop_after_frame is not None and nframe >= stop_after_frame:
-                break
-            if len(chunk_of_frames) == chunk_size:
-                break
+    # Run each session in its own thread, once there is room to read
+    reading_slots = threading.Semaphore(max_reading_sessions)
+    results = [None] * len(session_kwargs_l)
     
-        # Check if we ran out
-        if len(chunk_of_frames) != chunk_size:
-            out_of_frames = True
-                
-        ## Write tiffs
-        # We do this synchronously to ensure that it happens before
-        # the trace starts
-        for frame in chunk_of_frames:
-            ctw.write(frame)        
-        
-        # Make sure the chunk was written, in case this is the last one
-        # and we didn't reach chunk_size yet
-        if len(chunk_of_frames) != chunk_size:
-            ctw._write_chunk()
-        assert ctw.count_unwritten_frames() == 0
-
-        # Figure out which tiff file was just generated
-        tif_filename = ctw.chunknames_written[-1]
-        
-        ## Start trace
-        trace_pool.apply_async(trace_chunk, args=(tif_filename, delete_tiffs),
-            callback=log_result)
-        
-        ## Determine whether we can delete any tiffs
-        #~ if delete_tiffs:
-            #~ tiffs_to_delete = [
-                #~ tpres['video_filename'] for tpres in trace_pool_results
-                #~ if tpres['video_filename'] not in deleted_tiffs]
-            #~ for filename in tiffs_to_delete:
-                #~ if verbose:
-                    #~ print "deleting", filename
-                #~ os.remove(filename)
-    
-        ## Start monitor encode
-        # This is also synchronous, otherwise the input buffer might fill up
-        if monitor_video is not None:        
-            if ffw is None:
-                ffw = WhiskiWrap.FFmpegWriter(monitor_video, 
-                    frame_width=frame.shape[1], frame_height=frame.shape[0],
-                    write_stderr_to_screen=write_monitor_ffmpeg_stderr_to_screen,
-                    **monitor_video_kwargs)
-            for frame in chunk_of_frames:
-                ffw.write(frame)        
+    def run_session(n_session, session_kwargs):
+        # Release the reading slot once, when reading is done or fails
+        released = []
+        def on_reading_done():
+            if len(released) == 0:
+                released.append(True)
+                reading_slots.release()
         
-        ## Determine if we should pause
-        while len(ctw.chunknames_written) > len(trace_pool_results) + 2 * n_trace_processes:
-            print "waiting for tracing to catch up"
-            time.sleep(30)
-    
-    ## Wait for trace to complete
-    if verbose:
-        print "done with reading and writing, just waiting for tracing"
-    # Tell it no more jobs, so close when done
-    trace_pool.close()
+        try:
+            results[n_session] = _interleaved_trace_pipeline(
+                trace_pool=trace_pool, on_reading_done=on_reading_done,
+                **session_kwargs)
+        except Exception as error:
+            print "session %d failed:\n%s" % (n_session, 
+                traceback.format_exc())
+            results[n_session] = error
+        finally:
+            on_reading_done()
     
-    # Wait for everything to finish
-    trace_pool.join()
-    
-    ## Error check the tifs that were processed
-    # Get the tifs we wrote, and the tifs we trace
-    written_chunks = sorted(ctw.chunknames_written)
-    traced_filenames = sorted([
-        res['video_filename'] for res in trace_pool_results])
-    
-    # Check that they are the same
-    if not np.all(np.array(written_chunks) == np.array(traced_filenames)):
-        raise ValueError("not all chunks were traced")
-
-    ## Extract the chunk numbers from the filenames
-    # The tiffs have been written, figure out which they are
-    split_traced_filenames = [os.path.split(fn)[1] for fn in traced_filenames]
-    tif_file_number_strings = my.misc.apply_and_filter_by_regex(
-        '^chunk(\d+).tif$', split_traced_filenames, sort=False)
-    tif_full_filenames = [
-        os.path.join(tiffs_to_trace_directory, 'chunk%s.tif' % fns)
-        for fns in tif_file_number_strings]
-    tif_file_numbers = map(int, tif_file_number_strings)
-    tif_ordering = np.argsort(tif_file_numbers)
-    tif_sorted_filenames = np.array(tif_full_filenames)[
-        tif_ordering]
-    tif_sorted_file_numbers = np.array(tif_file_numbers)[
-        tif_ordering]
+    threads = []
+    try:
+        for n_session, session_kwargs in enumerate(session_kwargs_l):
+            reading_slots.acquire()
+            if verbose:
+                print "starting session %d of %d: %s" % (n_session + 1,
+                    len(session_kwargs_l), session_kwargs['h5_filename'])
+            thread = threading.Thread(target=run_session, 
+                args=(n_session, session_kwargs))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        
+        # Wait for every session to finish
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(1.)
+    except:
+        # Interrupted, so do not wait for the chunks in flight
+        if own_trace_pool:
+            trace_pool.terminate()
+        raise
     
-    # stitch
-    if not skip_stitch:
-        print "Stitching"
-        zobj = zip(tif_sorted_file_numbers, tif_sorted_filenames)
-        for chunk_start, chunk_name in zobj:
-            # Append each chunk to the hdf5 file
-            fn = WhiskiWrap.utils.FileNamer.from_tiff_stack(chunk_name)
-            append_whiskers_to_hdf5(
-                whisk_filename=fn.whiskers,
-                h5_filename=h5_filename, 
-                chunk_start=chunk_start)
-
-    # Finalize writers
-    ctw.close()
-    if ffw is not None:
-        ff_stdout, ff_stderr = ffw.close()
-    else:
-        ff_stdout, ff_stderr = None, None
-
-    # Also write timestamps as numpy file
-    if hasattr(input_reader, 'timestamps') and timestamps_filename is not None:
-        timestamps = np.concatenate(input_reader.timestamps)
-        assert len(timestamps) >= ctw.frames_written
-        np.save(timestamps_filename, timestamps[:ctw.frames_written])
-
-    return {'trace_pool_results': trace_pool_results,
-        'monitor_ff_stdout': ff_stdout,
-        'monitor_ff_stderr': ff_stderr,
-        'tif_sorted_file_numbers': tif_sorted_file_numbers,
-        'tif_sorted_filenames': tif_sorted_filenames,
-        }
+    if own_trace_pool:
+        trace_pool.close()
+        trace_pool.join()
+    return results
 
 def compress_pf_to_video(input_reader, chunk_size=200, stop_after_frame=None,
     timestamps_filename=None, monitor_video=None, monitor_video_kwargs=None, 
@@ -1268,77 +3603,664 @@ class PFReader:
                 
                 yield demodulated_frame
         
-        if self.verbose:
-            print "iterator is empty"
+        if self.verbose:
+            print "iterator is empty"
+    
+    def close(self):
+        """Currently does nothing"""
+        pass
+    
+    def isclosed(self):
+        return True
+
+class RawTiffWriter(object):
+    """Streams frames to disk as a minimal uncompressed multi-page tiff
+    
+    Each frame is written as soon as it arrives, so only one frame is
+    ever held in memory. Every page is an 8-bit grayscale image stored in 
+    a single strip, directly after its own IFD:
+        header | IFD 0 | frame 0 | IFD 1 | frame 1 | ...
+    Because the frame size is fixed, the offset of every IFD is known in 
+    advance, so each IFD points to the next one when it is written. On 
+    close, the pointer in the last IFD is set to 0 to end the file.
+    
+    This is a classic tiff, so the file cannot be larger than 4 GB.
+    """
+    # IFD entries, sorted by tag as the tiff spec requires:
+    # ImageWidth, ImageLength, BitsPerSample, Compression, 
+    # PhotometricInterpretation, StripOffsets, SamplesPerPixel, 
+    # RowsPerStrip, StripByteCounts
+    # (tag, type) where type 3 is SHORT and 4 is LONG
+    IFD_TAGS = [(256, 4), (257, 4), (258, 3), (259, 3), (262, 3), 
+        (273, 4), (277, 3), (278, 4), (279, 4)]
+    IFD_SIZE = 2 + 12 * len(IFD_TAGS) + 4
+    HEADER_SIZE = 8
+    
+    def __init__(self, filename, frame_shape=None):
+        """Initialize a new writer
+        
+        filename : tiff file to create
+        frame_shape : (height, width) of every frame
+            If None, taken from the first frame written
+        """
+        self.filename = filename
+        self.frame_shape = None
+        self.n_frames = 0
+        self.fi = open(filename, 'wb')
+        
+        # Little-endian header, pointing to the first IFD
+        self.fi.write(struct.pack('<2sHI', 'II', 42, self.HEADER_SIZE))
+        
+        if frame_shape is not None:
+            self._set_frame_shape(frame_shape)
+    
+    def _set_frame_shape(self, frame_shape):
+        """Store the frame shape and the size of each page"""
+        if len(frame_shape) != 2:
+            raise ValueError("RawTiffWriter can only write grayscale frames "
+                "of shape (height, width), not %r" % (tuple(frame_shape),))
+        self.frame_shape = tuple(frame_shape)
+        self.frame_height, self.frame_width = self.frame_shape
+        self.frame_bytes = self.frame_height * self.frame_width
+        self.page_size = self.IFD_SIZE + self.frame_bytes
+    
+    def page_offset(self, n_frame):
+        """Returns the offset of the IFD of frame n_frame in the file"""
+        return self.HEADER_SIZE + n_frame * self.page_size
+    
+    def _pack_ifd(self, n_frame):
+        """Returns the IFD of frame n_frame, pointing to the next IFD"""
+        values = [self.frame_width, self.frame_height, 8, 1, 1,
+            self.page_offset(n_frame) + self.IFD_SIZE, 1, 
+            self.frame_height, self.frame_bytes]
+        
+        ifd = [struct.pack('<H', len(self.IFD_TAGS))]
+        for (tag, tag_type), value in zip(self.IFD_TAGS, values):
+            if tag_type == 3:
+                ifd.append(struct.pack('<HHIH2x', tag, tag_type, 1, value))
+            else:
+                ifd.append(struct.pack('<HHII', tag, tag_type, 1, value))
+        ifd.append(struct.pack('<I', self.page_offset(n_frame + 1)))
+        return ''.join(ifd)
+    
+    def write(self, frame):
+        """Write a uint8 frame of shape (height, width) as the next page"""
+        if frame.dtype != np.uint8:
+            raise ValueError("frames must be uint8, not %s" % frame.dtype)
+        if self.frame_shape is None:
+            self._set_frame_shape(frame.shape)
+        elif frame.shape != self.frame_shape:
+            raise ValueError("frame shape %r does not match %r" % (
+                frame.shape, self.frame_shape))
+        if self.page_offset(self.n_frames + 1) >= 2 ** 32:
+            raise ValueError("tiff file would be larger than 4 GB")
+        
+        self.fi.write(self._pack_ifd(self.n_frames))
+        self.fi.write(np.ascontiguousarray(frame).data)
+        self.n_frames += 1
+    
+    def close(self, fsync=True):
+        """End the file at the last frame written, and close it
+        
+        fsync : if True, the file is fsynced before it is closed, so it
+            is complete on disk when traced
+        """
+        if self.fi is None:
+            return
+        try:
+            if self.n_frames > 0:
+                # Offset of the next-IFD pointer of the last IFD
+                self.fi.seek(self.page_offset(self.n_frames) - 
+                    self.frame_bytes - 4)
+                self.fi.write(struct.pack('<I', 0))
+            if fsync:
+                self.fi.flush()
+                os.fsync(self.fi.fileno())
+        finally:
+            self.fi.close()
+            self.fi = None
+    
+    def read_frames(self):
+        """Returns the frames written, read back from the closed file
+        
+        Returns: array of shape (n_frames, height, width)
+        """
+        if self.fi is not None:
+            raise ValueError("close before reading back")
+        frames = np.zeros((self.n_frames,) + tuple(self.frame_shape or ()),
+            dtype=np.uint8)
+        with open(self.filename, 'rb') as fi:
+            for n_frame in range(self.n_frames):
+                fi.seek(self.page_offset(n_frame) + self.IFD_SIZE)
+                frames[n_frame] = np.fromstring(fi.read(self.frame_bytes),
+                    dtype=np.uint8).reshape(self.frame_shape)
+        return frames
+
+class ScratchManager(object):
+    """Places chunk files in RAM when there is room, otherwise on disk
+    
+    Chunk tiffs, and the .whiskers and .measurements files that trace and
+    measure write next to them, are throwaway files that are written and
+    read once. This places each new chunk in a RAM-backed directory,
+    usually on /dev/shm, as long as the chunk files already there plus 
+    the new chunk fit within ram_budget bytes. Otherwise the chunk spills to the
+    on-disk directory.
+    
+    The parameters files are copied into both directories, so trace and
+    measure work in either one. Because the .whiskers files of a chunk 
+    are written after it is placed, the budget should leave some room 
+    for them. A chunk placed in RAM is counted at its full size from when
+    it is placed until release is called, once it is written, so chunks
+    still queued for writing are counted too.
+    
+    Call close() when done, which moves the remaining chunk files, such 
+    as .whiskers and .measurements files and any tiffs not deleted, to 
+    the disk directory, and removes the RAM directory if it was created 
+    here.
+    """
+    # Files copied by copy_parameters_files, which are not counted
+    PARAMETERS_FILENAMES = ['default.parameters', 
+        'halfspace.detectorbank', 'line.detectorbank']
+    
+    def __init__(self, disk_directory, ram_budget=2 * 1024 ** 3, 
+        ram_directory=None, sensitive=False):
+        """Initialize a new scratch manager
+        
+        disk_directory : on-disk directory for chunks that do not fit
+        ram_budget : maximum number of bytes of files in ram_directory
+        ram_directory : RAM-backed directory to use
+            If None, a new directory is created in /dev/shm, and removed
+            on close. If /dev/shm does not exist, only disk is used.
+        sensitive : passed to copy_parameters_files
+        """
+        self.disk_directory = disk_directory
+        self.ram_budget = ram_budget
+        self.created_ram_directory = False
+        
+        # Map the name of each chunk placed in RAM but not yet released
+        # to its size. Chunks are placed by the reading thread and 
+        # released by the writer thread
+        self.reserved = {}
+        self._lock = threading.Lock()
+        
+        if ram_directory is None and os.path.isdir('/dev/shm'):
+            ram_directory = tempfile.mkdtemp(prefix='WhiskiWrap', 
+                dir='/dev/shm')
+            self.created_ram_directory = True
+        self.ram_directory = ram_directory
+        
+        # Copy the parameters files to every location
+        for directory in self.directories:
+            copy_parameters_files(directory, sensitive=sensitive)
+    
+    @property
+    def directories(self):
+        """Returns the directories in use"""
+        if self.ram_directory is None:
+            return [self.disk_directory]
+        return [self.ram_directory, self.disk_directory]
+    
+    def _ram_usage(self):
+        """Returns the bytes used in ram_directory, and those yet to write
+        
+        The first is the total size of the chunk files, counting each 
+        reserved chunk at its full size even if it is not written yet.
+        The second is how much the reserved chunks will still grow.
+        The parameters files are not counted.
+        """
+        if self.ram_directory is None:
+            return 0, 0
+        with self._lock:
+            reserved = dict(self.reserved)
+        nbytes = 0
+        for filename in os.listdir(self.ram_directory):
+            if filename in self.PARAMETERS_FILENAMES:
+                continue
+            try:
+                file_nbytes = os.path.getsize(
+                    os.path.join(self.ram_directory, filename))
+            except OSError:
+                # It was deleted in the meantime
+                continue
+            nbytes += file_nbytes
+            if filename in reserved:
+                reserved[filename] -= file_nbytes
+        nbytes_to_write = sum([max(reserved_nbytes, 0) 
+            for reserved_nbytes in reserved.values()])
+        return nbytes + nbytes_to_write, nbytes_to_write
+    
+    def ram_bytes_used(self):
+        """Returns the total size of the chunk files in ram_directory
+        
+        Chunks that were placed there but not yet released count at 
+        their full size, even while they are queued or being written.
+        The parameters files are not counted.
+        """
+        return self._ram_usage()[0]
+    
+    def directory_for(self, nbytes, filename=None):
+        """Returns the directory where a chunk of nbytes should go
+        
+        filename : name the chunk will have in that directory, or None
+            If provided and the chunk goes in RAM, nbytes are reserved
+            for it until release(filename) is called.
+        """
+        if self.ram_directory is None:
+            return self.disk_directory
+        
+        # Check the budget, and the space actually free, counting the 
+        # chunks that are reserved but not written yet
+        bytes_used, bytes_to_write = self._ram_usage()
+        stat = os.statvfs(self.ram_directory)
+        ram_bytes_free = stat.f_bavail * stat.f_frsize - bytes_to_write
+        if (bytes_used + nbytes <= self.ram_budget and
+            nbytes < ram_bytes_free):
+            if filename is not None:
+                with self._lock:
+                    self.reserved[filename] = nbytes
+            return self.ram_directory
+        return self.disk_directory
+    
+    def release(self, filename):
+        """Stop reserving space for filename, once it is written
+        
+        From then on it is counted at its actual size, if it is in RAM.
+        """
+        with self._lock:
+            self.reserved.pop(os.path.basename(filename), None)
+    
+    def is_in_ram(self, filename):
+        """Returns True if filename is in ram_directory"""
+        if self.ram_directory is None:
+            return False
+        return (os.path.dirname(os.path.abspath(filename)) == 
+            os.path.abspath(self.ram_directory))
+    
+    def move_to_disk(self, filename):
+        """Move filename to disk_directory, if it is in RAM
+        
+        Returns: the new filename
+        """
+        if not self.is_in_ram(filename):
+            return filename
+        new_filename = os.path.join(self.disk_directory, 
+            os.path.basename(filename))
+        shutil.move(filename, new_filename)
+        return new_filename
     
     def close(self):
-        """Currently does nothing"""
-        pass
+        """Move results to disk, and remove the RAM directory if created
+        
+        Whiskers and measurements left by attempts that failed, or that
+        finished after another attempt's results were moved to disk, are
+        removed instead of moved.
+        """
+        if self.ram_directory is None:
+            return
+        for filename in sorted(os.listdir(self.ram_directory)):
+            if filename in self.PARAMETERS_FILENAMES:
+                continue
+            ram_filename = os.path.join(self.ram_directory, filename)
+            if os.path.splitext(filename)[1] in ('.whiskers', 
+                '.measurements') and ('.attempt' in filename or 
+                os.path.exists(os.path.join(self.disk_directory, filename))):
+                os.remove(ram_filename)
+            else:
+                self.move_to_disk(ram_filename)
+        if self.created_ram_directory:
+            shutil.rmtree(self.ram_directory)
+            self.ram_directory = None
+
+class ChunkWrite(object):
+    """The write of one chunk by a ChunkedTiffWriter
     
-    def isclosed(self):
-        return True
+    This is returned as soon as the chunk is handed to the writer. In
+    background mode the chunk is written later by the writer thread, so
+    wait() or add_done_callback() must be used before the file is read.
+    
+    filename : the tiff stack being written
+    first_frame : number of the first frame in the chunk, counting all of
+        the frames written by the ChunkedTiffWriter
+    n_frames : number of frames in the chunk
+    error : the exception raised while writing, or None
+    """
+    def __init__(self, filename, first_frame, n_frames):
+        self.filename = filename
+        self.first_frame = first_frame
+        self.n_frames = n_frames
+        self.error = None
+        self._done_event = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+    
+    def done(self):
+        """Returns True if the chunk has been written, or failed"""
+        return self._done_event.is_set()
+    
+    def wait(self, timeout=None):
+        """Block until the chunk is written, and return its filename
+        
+        Raises the error from writing, if any.
+        """
+        self._done_event.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.filename
+    
+    def add_done_callback(self, func):
+        """Call func(self) once the chunk is written, or failed
+        
+        If this is already done, func is called immediately. Otherwise it
+        is called by the writer thread.
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(func)
+                return
+        func(self)
+    
+    def _finish(self, error=None):
+        """Mark as done, and call the callbacks"""
+        with self._lock:
+            self.error = error
+            self._done_event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for func in callbacks:
+            func(self)
 
 class ChunkedTiffWriter:
     """Writes frames to a series of tiff stacks"""
     def __init__(self, output_directory, chunk_size=200,
-        chunk_name_pattern='chunk%08d.tif'):
+        chunk_name_pattern='chunk%08d.tif', n_buffers=0, streaming=False,
+        scratch=None, first_frame=0):
         """Initialize a new chunked tiff writer.
         
         output_directory : where to write the chunks
-        chunk_size : frames per chunk
+        chunk_size : frames per chunk. This can be changed between 
+            chunks, i.e. whenever count_unwritten_frames() is 0, as the 
+            interleaved pipelines do with a ChunkSizeTuner.
         chunk_name_pattern : how to name the chunk, using the number of
             the first frame in it
+        n_buffers : if 0, each chunk is written in the calling thread
+            before write or write_chunk returns.
+            Otherwise, chunks are written and fsynced by a background 
+            thread, so that reading the next chunk overlaps with writing
+            this one. Up to n_buffers chunks are queued for writing, in
+            addition to the one being written; after that, writing blocks 
+            until one finishes. Each write returns a ChunkWrite, which 
+            should be waited on before the tiff stack is traced.
+            
+            The queued chunks are not copied, so they must not be 
+            modified until written. With an FFmpegReader in ring mode,
+            this requires ring_size >= n_buffers + 2.
+        streaming : if False, frames passed to write are buffered until a
+            chunk is complete, and each chunk is written with tifffile.
+            If True, every tiff stack is written with RawTiffWriter, and 
+            frames passed to write are streamed straight to the open 
+            stack in the calling thread, so no chunk of frames is ever 
+            held in memory. Chunks passed to write_chunk are still queued
+            for the writer thread if n_buffers > 0.
+        scratch : ScratchManager, or None
+            If not None, each chunk is written to the directory chosen by
+            scratch, instead of output_directory.
+        first_frame : number of the first frame that will be written, 
+            used to name the chunks. This is not 0 when resuming a run.
         """
         self.output_directory = output_directory
         self.chunk_size = chunk_size
         self.chunk_name_pattern = chunk_name_pattern
+        self.n_buffers = n_buffers
+        self.streaming = streaming
+        self.scratch = scratch
+        
+        # The RawTiffWriter that frames are being streamed to
+        self.stream = None
         
         # Initialize counters so we know what frame and chunk we're on
-        self.frames_written = 0
+        # frames_written counts frames handed to the writer, which are
+        # not yet on disk in background mode.
+        self.frames_written = first_frame
         self.frame_buffer = []
         self.chunknames_written = []
+        
+        # Errors raised by the writer thread, raised again by close
+        self.errors = []
+        
+        # Start the writer thread
+        if self.n_buffers > 0:
+            self.write_queue = Queue.Queue(maxsize=self.n_buffers)
+            self.writer_thread = threading.Thread(target=self._writer_loop)
+            self.writer_thread.daemon = True
+            self.writer_thread.start()
+        else:
+            self.write_queue = None
+            self.writer_thread = None
     
     def write(self, frame):
-        """Buffered write frame to tiff stacks"""
+        """Buffered write frame to tiff stacks
+        
+        Returns: ChunkWrite if this frame completed a chunk, else None
+        """
+        if self.streaming:
+            # Write the frame to the open stack
+            if self.stream is None:
+                self.stream = RawTiffWriter(self._next_chunkname(
+                    self.chunk_size * frame.nbytes))
+            self.stream.write(frame)
+            
+            # Close the stack if it is full
+            if self.stream.n_frames == self.chunk_size:
+                return self._close_stream()
+            return None
+        
         # Append to buffer
         self.frame_buffer.append(frame)
         
         # Write chunk if buffer is full
         if len(self.frame_buffer) == self.chunk_size:
-            self._write_chunk()
+            return self._write_chunk()
+    
+    def write_chunk(self, chunk):
+        """Write an array of frames, such as from FFmpegReader.iter_chunks
+        
+        If no frames are currently buffered and `chunk` has exactly 
+        chunk_size frames, it is written immediately as its own tiff 
+        stack, without passing through the frame buffer. This is the case 
+        when every chunk is read with the same chunk_size as this writer.
+        
+        Otherwise each frame is buffered as in `write`, and a final short
+        chunk is written by close.
+        
+        Returns: list of ChunkWrite, one for each tiff stack started
+        """
+        if (self.count_unwritten_frames() == 0 and 
+            len(chunk) == self.chunk_size):
+            chunk_writes = [self._write_chunk(chunk)]
+        else:
+            chunk_writes = [self.write(frame) for frame in chunk]
+        return [chunk_write for chunk_write in chunk_writes 
+            if chunk_write is not None]
 
-    def _write_chunk(self):
-        if len(self.frame_buffer) != 0:
+    def _write_chunk(self, chunk=None):
+        """Write `chunk`, or the buffered frames if None, to a tiff stack
+        
+        Returns: ChunkWrite, or None if there was nothing to write
+        """
+        if chunk is None and self.streaming:
+            return self._close_stream()
+        
+        if chunk is None:
             # Form the chunk
+            if len(self.frame_buffer) == 0:
+                return None
             chunk = np.array(self.frame_buffer)
-            
-            # Name it
-            chunkname = os.path.join(self.output_directory,
-                self.chunk_name_pattern % self.frames_written)
-            
-            # Write it
-            tifffile.imsave(chunkname, chunk, compress=0)
-            
-            # Update the counter
-            self.frames_written += len(self.frame_buffer)
             self.frame_buffer = []        
-            
-            # Update the list of written chunks
+        elif len(chunk) == 0:
+            return None
+        
+        # Name it
+        chunkname = self._next_chunkname(chunk.nbytes)
+        chunk_write = ChunkWrite(chunkname, self.frames_written, len(chunk))
+        
+        # Update the counter
+        self.frames_written += len(chunk)
+        
+        # Write it, or queue it for the writer thread
+        if self.writer_thread is None:
+            try:
+                self._save_chunk(chunkname, chunk)
+            finally:
+                self._release_scratch(chunkname)
             self.chunknames_written.append(chunkname)
+            chunk_write._finish()
+        else:
+            self.write_queue.put((chunk_write, chunk))
+        
+        return chunk_write
+    
+    def _next_chunkname(self, nbytes):
+        """Returns the name of the chunk starting after frames_written
+        
+        nbytes : size of the chunk, used to choose a scratch directory
+            It is reserved there until _release_scratch is called.
+        """
+        chunkname = self.chunk_name_pattern % self.frames_written
+        if self.scratch is None:
+            directory = self.output_directory
+        else:
+            directory = self.scratch.directory_for(nbytes, chunkname)
+        return os.path.join(directory, chunkname)
+    
+    def _release_scratch(self, chunkname):
+        """Count chunkname at its actual size, now that it is written"""
+        if self.scratch is not None:
+            self.scratch.release(chunkname)
+    
+    def _save_chunk(self, chunkname, chunk, fsync=False):
+        """Write an array of frames to the tiff stack `chunkname`"""
+        if self.streaming:
+            raw_tiff_writer = RawTiffWriter(chunkname, chunk.shape[1:])
+            try:
+                for frame in chunk:
+                    raw_tiff_writer.write(frame)
+                raw_tiff_writer.close(fsync=fsync)
+            finally:
+                raw_tiff_writer.close(fsync=False)
+        else:
+            with open(chunkname, 'wb') as fi:
+                tifffile.imsave(fi, chunk, compress=0)
+                if fsync:
+                    fi.flush()
+                    os.fsync(fi.fileno())
+    
+    def _close_stream(self):
+        """Close the stack that frames are being streamed to
+        
+        Returns: ChunkWrite, or None if no stack is open
+        """
+        if self.stream is None:
+            return None
+        chunkname = self.stream.filename
+        n_frames = self.stream.n_frames
+        try:
+            self.stream.close()
+        finally:
+            self._release_scratch(chunkname)
+        self.stream = None
+        
+        chunk_write = ChunkWrite(chunkname, self.frames_written, n_frames)
+        self.frames_written += n_frames
+        self.chunknames_written.append(chunkname)
+        chunk_write._finish()
+        return chunk_write
+    
+    def _writer_loop(self):
+        """Write and fsync queued chunks until None is queued"""
+        while True:
+            item = self.write_queue.get()
+            if item is None:
+                return
+            chunk_write, chunk = item
+            
+            # Write and fsync, so the file is complete when traced
+            try:
+                self._save_chunk(chunk_write.filename, chunk, fsync=True)
+            except Exception as error:
+                self.errors.append(error)
+            else:
+                error = None
+                self.chunknames_written.append(chunk_write.filename)
+            self._release_scratch(chunk_write.filename)
+            
+            # Call the callbacks, without letting them kill this thread
+            try:
+                chunk_write._finish(error)
+            except Exception as callback_error:
+                self.errors.append(callback_error)
+    
+    def write_safe_tail(self):
+        """Write the buffered frames as stacks that trace can handle
+        
+        If the number of buffered frames is in TRACE_UNSAFE_CHUNK_LENGTHS,
+        they are written as two shorter stacks, of 1 and 2 or of 2 and 2
+        frames. Otherwise nothing is done, and close writes them as usual.
+        This is meant to be called on the final frames, just before close.
+        
+        Returns: list of ChunkWrite
+        """
+        n_frames = self.count_unwritten_frames()
+        if n_frames not in TRACE_UNSAFE_CHUNK_LENGTHS:
+            return []
+        
+        # Take back the buffered frames
+        if self.streaming:
+            self.stream.close()
+            frames = self.stream.read_frames()
+            os.remove(self.stream.filename)
+            self.stream = None
+        else:
+            frames = np.array(self.frame_buffer)
+            self.frame_buffer = []
+        
+        n_first = n_frames // 2
+        return [self._write_chunk(frames[:n_first]), 
+            self._write_chunk(frames[n_first:])]
     
     def count_unwritten_frames(self):
-        """Returns the number of buffered, unwritten frames"""
+        """Returns the number of buffered, unwritten frames
+        
+        In streaming mode, these are the frames in the open stack.
+        """
+        if self.stream is not None:
+            return self.stream.n_frames
         return len(self.frame_buffer)
     
     def close(self):
-        """Finish writing any final unfinished chunk"""
-        self._write_chunk()
+        """Finish writing any final unfinished chunk
+        
+        In background mode, this waits for every queued chunk to be
+        written, and raises the first error from the writer thread.
+        
+        Returns: ChunkWrite for the final chunk, or None
+        """
+        chunk_write = self._write_chunk()
+        
+        if self.writer_thread is not None:
+            self.write_queue.put(None)
+            self.writer_thread.join()
+            self.writer_thread = None
+        
+        if len(self.errors) > 0:
+            raise self.errors[0]
+        
+        return chunk_write
 
 class FFmpegReader:
     """Reads frames from a video file using ffmpeg process"""
     def __init__(self, input_filename, pix_fmt='gray', bufsize=10**9,
         duration=None, start_frame_time=None, start_frame_number=None,
-        write_stderr_to_screen=False, vsync='drop'):
+        write_stderr_to_screen=False, vsync='drop', ring_size=None,
+        frame_index=None, crop=None):
         """Initialize a new reader
         
         input_filename : name of file
@@ -1347,15 +4269,66 @@ class FFmpegReader:
         bufsize : probably not necessary because we read one frame at a time
         duration : duration of video to read (-t parameter)
         start_frame_time, start_frame_number : -ss parameter
-            Parsed using my.video.ffmpeg_frame_string
+            Parsed using my.video.ffmpeg_frame_string, unless frame_index
+            is provided
+        frame_index : video_utils.FrameIndex of this video, or True to
+            load it from its sidecar file (building it if necessary), or 
+            None. If provided, start_frame_number is converted to an exact 
+            seek time using the index, and the exact number of frames is
+            available as self.frame_index.n_frames.
         write_stderr_to_screen : if True, writes to screen, otherwise to
             /dev/null
+        ring_size : if None, every frame or chunk is a newly allocated
+            array. Otherwise, iter_frames and iter_chunks read the pipe
+            directly into a ring of `ring_size` preallocated buffers and
+            yield views of them, which avoids allocating and copying
+            anything per frame.
+            
+            Ownership contract: a view yielded in ring mode stays valid
+            while up to `ring_size - 1` further frames (or chunks) are
+            requested from the iterator. Requesting the next one after
+            that overwrites it in place. So with ring_size=1 the consumer
+            must be done with each view before asking for the next one.
+            Copy the view if it needs to live longer.
+        crop : region of interest to keep, or None to keep the whole frame
+            (x, y, width, height) : crop to this region, in pixels from
+                the top left corner
+            'auto' : choose the region with video_utils.detect_whisker_roi
+            Cropping is done by ffmpeg before the frames are sent through
+            the pipe, so frame_width and frame_height are the size of the 
+            cropped frames. The crop is stored as self.crop and the offset
+            of the cropped frames in the full frame as self.roi_offset, 
+            which is used to map traced coordinates back to the full frame.
         """
         self.input_filename = input_filename
+        self.ring_size = ring_size
+        self.pix_fmt = pix_fmt
+        self.bufsize = bufsize
+        self.duration = duration
+        self.start_frame_time = start_frame_time
+        self.start_frame_number = start_frame_number
+        self.write_stderr_to_screen = write_stderr_to_screen
+        self.vsync = vsync
     
         # Get params
         self.frame_width, self.frame_height, self.frame_rate = \
-            my.video.get_video_params(input_filename)
+            video_utils.get_video_params_cached(input_filename)
+        
+        # Load the index
+        if frame_index is True:
+            frame_index = video_utils.FrameIndex.load_or_build(input_filename)
+        self.frame_index = frame_index
+        
+        # Set up the crop
+        if crop == 'auto':
+            crop = video_utils.detect_whisker_roi(input_filename,
+                frame_index=frame_index)
+        self.crop = crop
+        if crop is not None:
+            self.frame_width, self.frame_height = crop[2], crop[3]
+            self.roi_offset = (crop[0], crop[1])
+        else:
+            self.roi_offset = (0, 0)
         
         # Set up pix_fmt
         if pix_fmt == 'gray':
@@ -1367,36 +4340,54 @@ class FFmpegReader:
         self.read_size_per_frame = self.bytes_per_pixel * \
             self.frame_width * self.frame_height
         
+        # To store result
+        self.n_frames_read = 0
+        
+        self._start_ffmpeg()
+    
+    def _start_ffmpeg(self):
+        """Start the ffmpeg process, from the current start frame"""
         # Create the command
         command = ['ffmpeg']
         
         # Add ss string
-        if start_frame_time is not None or start_frame_number is not None:
-            ss_string = my.video.ffmpeg_frame_string(input_filename,
-                frame_time=start_frame_time, frame_number=start_frame_number)
+        if self.start_frame_number is not None and \
+            self.frame_index is not None:
+            ss_string = '%0.6f' % self.frame_index.seek_time(
+                self.start_frame_number)
+            command += [
+                '-ss', ss_string]
+        elif self.start_frame_time is not None or \
+            self.start_frame_number is not None:
+            ss_string = my.video.ffmpeg_frame_string(self.input_filename,
+                frame_time=self.start_frame_time, 
+                frame_number=self.start_frame_number)
             command += [
                 '-ss', ss_string]
         
         command += [
-            '-i', input_filename,
-            '-vsync', vsync,
+            '-i', self.input_filename,
+            '-vsync', self.vsync]
+        
+        # Add crop filter
+        if self.crop is not None:
+            command += video_utils.crop_filter_args(self.crop, self.pix_fmt)
+        
+        command += [
             '-f', 'image2pipe',
-            '-pix_fmt', pix_fmt]
+            '-pix_fmt', self.pix_fmt]
         
         # Add duration string
-        if duration is not None:
+        if self.duration is not None:
             command += [
-                '-t', str(duration),]
+                '-t', str(self.duration),]
         
         # Add vcodec for pipe
         command += [
             '-vcodec', 'rawvideo', '-']
         
-        # To store result
-        self.n_frames_read = 0
-
         # stderr
-        if write_stderr_to_screen:
+        if self.write_stderr_to_screen:
             stderr = None
         else:
             stderr = open(os.devnull, 'w')
@@ -1404,10 +4395,45 @@ class FFmpegReader:
         # Init the pipe
         # We set stderr to null so it doesn't fill up screen or buffers
         # And we set stdin to PIPE to keep it from breaking our STDIN
+        # And we close the other files, like open HDF5 files, which it
+        # would otherwise keep open (and locked) until it exits
         self.ffmpeg_proc = subprocess.Popen(command, 
             stdin=subprocess.PIPE,
             stdout=subprocess.PIPE, stderr=stderr, 
-            bufsize=bufsize)
+            bufsize=self.bufsize, close_fds=True)
+    
+    def seek(self, n_frames):
+        """Skip the next n_frames frames without decoding them
+        
+        ffmpeg is restarted at the first frame after them. This is only
+        exact with a frame_index, so it requires one, and it can only be
+        done before any frames are read.
+        
+        Raises ValueError if this reader cannot seek.
+        """
+        if self.frame_index is None or self.start_frame_time is not None:
+            raise ValueError("seeking requires a frame_index and "
+                "start_frame_number")
+        if self.n_frames_read > 0:
+            raise ValueError("cannot seek after reading")
+        if n_frames == 0:
+            return
+        
+        self.close()
+        if self.start_frame_number is None:
+            self.start_frame_number = 0
+        self.start_frame_number = self.start_frame_number + n_frames
+        if self.duration is not None:
+            self.duration = self.duration - n_frames / float(self.frame_rate)
+        self._start_ffmpeg()
+
+    @property
+    def frame_shape(self):
+        """Shape of each frame returned by this reader"""
+        if self.bytes_per_pixel == 1:
+            return (self.frame_height, self.frame_width)
+        else:
+            return (self.frame_height, self.frame_width, self.bytes_per_pixel)
 
     def iter_frames(self):
         """Yields one frame at a time
@@ -1415,9 +4441,16 @@ class FFmpegReader:
         When done: terminates ffmpeg process, and stores any remaining
         results in self.leftover_bytes and self.stdout and self.stderr
         
-        It might be worth writing this as a chunked reader if this is too
-        slow. Also we need to be able to seek through the file.
+        See iter_chunks for a faster way to read many frames at once.
+        
+        If self.ring_size is not None, each frame is a view into a ring
+        buffer and is only valid as described in __init__.
         """
+        if self.ring_size is not None:
+            for chunk in self._iter_into_ring(1):
+                yield chunk[0]
+            return
+        
         # Read this_chunk, or as much as we can
         while(True):
             raw_image = self.ffmpeg_proc.stdout.read(self.read_size_per_frame)
@@ -1430,12 +4463,7 @@ class FFmpegReader:
         
             # Convert to array
             flattened_im = np.fromstring(raw_image, dtype='uint8')
-            if self.bytes_per_pixel == 1:
-                frame = flattened_im.reshape(
-                    (self.frame_height, self.frame_width))
-            else:
-                frame = flattened_im.reshape(
-                    (self.frame_height, self.frame_width, self.bytes_per_pixel))
+            frame = flattened_im.reshape(self.frame_shape)
 
             # Update
             self.n_frames_read = self.n_frames_read + 1
@@ -1443,6 +4471,88 @@ class FFmpegReader:
             # Yield
             yield frame
     
+    def iter_chunks(self, n_frames):
+        """Yields chunks of up to `n_frames` frames at a time
+        
+        Each chunk is read from the pipe in a single call and yielded as
+        one contiguous uint8 array of shape (n, frame_height, frame_width),
+        with a trailing dimension of 3 for rgb24. Only the last chunk can
+        be shorter than `n_frames`. The array wraps the bytes read from 
+        the pipe without copying them, so it is read-only.
+        
+        The chunks can be passed directly to ChunkedTiffWriter.write_chunk
+        and FFmpegWriter.write.
+        
+        If self.ring_size is not None, each chunk is instead a writeable
+        view into a ring buffer and is only valid as described in __init__.
+        
+        When done: terminates ffmpeg process, and stores any remaining
+        results in self.leftover_bytes and self.stdout and self.stderr
+        """
+        if self.ring_size is not None:
+            for chunk in self._iter_into_ring(n_frames):
+                yield chunk
+            return
+        
+        read_size_per_chunk = self.read_size_per_frame * n_frames
+        while(True):
+            raw_chunk = self.ffmpeg_proc.stdout.read(read_size_per_chunk)
+            
+            # Keep only complete frames
+            n_complete_frames = len(raw_chunk) // self.read_size_per_frame
+            n_complete_bytes = n_complete_frames * self.read_size_per_frame
+            
+            if n_complete_frames > 0:
+                # Convert to array without copying
+                chunk = np.frombuffer(raw_chunk, dtype='uint8',
+                    count=n_complete_bytes).reshape(
+                    (n_complete_frames,) + self.frame_shape)
+                
+                # Update
+                self.n_frames_read = self.n_frames_read + n_complete_frames
+                
+                # Yield
+                yield chunk
+            
+            # check if we ran out of frames
+            if n_complete_frames != n_frames:
+                self.leftover_bytes = raw_chunk[n_complete_bytes:]
+                self.close()
+                return
+    
+    def _iter_into_ring(self, n_frames):
+        """Yields views of up to `n_frames` frames read into the ring
+        
+        The ring of self.ring_size buffers, each large enough for n_frames
+        frames, is allocated once. Every read fills the next buffer in
+        the ring in place, overwriting whatever view was handed out from
+        it self.ring_size reads ago.
+        """
+        ring = [np.empty((n_frames,) + self.frame_shape, dtype=np.uint8)
+            for n_buffer in range(self.ring_size)]
+        
+        n_read = 0
+        while(True):
+            ring_buffer = ring[n_read % self.ring_size]
+            n_read = n_read + 1
+            
+            # Read this chunk, or as much as we can
+            n_bytes = video_utils.readinto_array(self.ffmpeg_proc.stdout,
+                ring_buffer)
+            n_complete_frames = n_bytes // self.read_size_per_frame
+            
+            if n_complete_frames > 0:
+                self.n_frames_read = self.n_frames_read + n_complete_frames
+                yield ring_buffer[:n_complete_frames]
+            
+            # check if we ran out of frames
+            if n_complete_frames != n_frames:
+                self.leftover_bytes = ring_buffer.reshape(-1)[
+                    n_complete_frames * self.read_size_per_frame:n_bytes
+                    ].tostring()
+                self.close()
+                return
+    
     def close(self):
         """Closes the process"""
         # Need to terminate in case there is more data but we don't
@@ -1463,6 +4573,269 @@ class FFmpegReader:
             # Never even ran? I guess this counts as closed.
             return True
 
+class ParallelFFmpegReader:
+    """Reads frames from a video file using several ffmpeg processes
+    
+    The requested frame range is split into segments that begin on
+    keyframes, so every decoder can seek to its segment without decoding
+    what comes before it. Up to n_decoders segments are decoded at the
+    same time, each by its own FFmpegReader, and their frames are merged
+    back into a single stream numbered in order. This can be used in
+    place of FFmpegReader, e.g. in interleaved_reading_and_tracing.
+    
+    Each decoder can run ahead of the consumer by up to 
+    max_buffered_chunks chunks, so at most about 
+    n_decoders * max_buffered_chunks chunks are held in memory.
+    """
+    def __init__(self, input_filename, n_decoders=4, segment_frames=5000,
+        frame_start=0, frame_stop=None, pix_fmt='gray', 
+        max_buffered_chunks=4, write_stderr_to_screen=False, verbose=False,
+        frame_index=None, crop=None):
+        """Initialize a new parallel reader
+        
+        input_filename : name of file
+        n_decoders : number of ffmpeg processes to run at once
+        segment_frames : minimum number of frames per segment. Each 
+            segment extends to the first keyframe after this many frames.
+        frame_start, frame_stop : range of frames to read
+            If frame_stop is None, read to the end of the video.
+        pix_fmt : sent to each FFmpegReader
+        max_buffered_chunks : how many chunks each decoder can read 
+            ahead of the consumer
+        write_stderr_to_screen : sent to each FFmpegReader
+        verbose : print each segment as its decoder starts
+        frame_index : video_utils.FrameIndex of this video
+            If None, it is loaded from its sidecar file, or built and 
+            saved there if necessary.
+        crop : sent to each FFmpegReader. If 'auto', the region is
+            detected once here and the same region is used by every 
+            decoder.
+        """
+        self.input_filename = input_filename
+        self.n_decoders = n_decoders
+        self.pix_fmt = pix_fmt
+        self.max_buffered_chunks = max_buffered_chunks
+        self.write_stderr_to_screen = write_stderr_to_screen
+        self.verbose = verbose
+        
+        # Get params
+        self.frame_width, self.frame_height, self.frame_rate = \
+            video_utils.get_video_params_cached(input_filename)
+        
+        # Find the keyframes and the exact number of frames
+        if frame_index is None:
+            frame_index = video_utils.FrameIndex.load_or_build(input_filename)
+        self.frame_index = frame_index
+        self.total_frames = frame_index.n_frames
+        keyframes = frame_index.keyframes
+        
+        # Set up the crop, as in FFmpegReader
+        if crop == 'auto':
+            crop = video_utils.detect_whisker_roi(input_filename,
+                frame_index=frame_index)
+        self.crop = crop
+        if crop is not None:
+            self.frame_width, self.frame_height = crop[2], crop[3]
+            self.roi_offset = (crop[0], crop[1])
+        else:
+            self.roi_offset = (0, 0)
+        
+        # Frame range
+        if frame_stop is None or frame_stop > self.total_frames:
+            frame_stop = self.total_frames
+        self.frame_start = frame_start
+        self.frame_stop = frame_stop
+        
+        # Split into segments that begin on keyframes
+        self.segments = self._plan_segments(keyframes, frame_start, 
+            frame_stop, segment_frames)
+        
+        # To store result
+        self.n_frames_read = 0
+        self.decoders = []
+        self.threads = []
+        self._stop_event = threading.Event()
+    
+    def _plan_segments(self, keyframes, frame_start, frame_stop, 
+        segment_frames):
+        """Returns a list of (start, stop) frame numbers of each segment
+        
+        The first segment begins at frame_start and every other segment
+        begins on a keyframe at least segment_frames after the previous 
+        one.
+        """
+        boundaries = [frame_start]
+        for keyframe in keyframes:
+            if keyframe >= frame_stop:
+                break
+            if keyframe >= boundaries[-1] + segment_frames:
+                boundaries.append(keyframe)
+        boundaries.append(frame_stop)
+        
+        return [(start, stop) for start, stop in 
+            zip(boundaries[:-1], boundaries[1:]) if stop > start]
+
+    def _put(self, queue, item):
+        """Put item on the queue, giving up if the reader is closed"""
+        while not self._stop_event.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+    
+    def _start_decoder(self, segment_start, segment_stop):
+        """Returns an FFmpegReader of the frames of one segment
+        
+        It is added to self.decoders, so that close stops it.
+        """
+        # Ask for a little extra time in case of rounding, and stop 
+        # reading after the right number of frames
+        n_frames = segment_stop - segment_start
+        reader = FFmpegReader(self.input_filename, pix_fmt=self.pix_fmt,
+            start_frame_number=(segment_start if segment_start > 0 
+                else None),
+            duration=(n_frames + 5) / float(self.frame_rate),
+            write_stderr_to_screen=self.write_stderr_to_screen,
+            frame_index=self.frame_index, crop=self.crop)
+        self.decoders.append(reader)
+        return reader
+    
+    def _decode_segment(self, reader, segment_start, segment_stop, read_size,
+        queue):
+        """Decode one segment into queue, in chunks of read_size frames
+        
+        Runs in its own thread, reading from reader, which it closes when
+        done. Ends by putting None on the queue, or the exception if 
+        something went wrong.
+        """
+        try:
+            n_frames = segment_stop - segment_start
+            n_read = 0
+            for chunk in reader.iter_chunks(read_size):
+                chunk = chunk[:n_frames - n_read]
+                n_read = n_read + len(chunk)
+                self._put(queue, chunk)
+                if n_read == n_frames or self._stop_event.is_set():
+                    break
+            
+            if n_read != n_frames and not self._stop_event.is_set():
+                raise IOError("decoded %d frames instead of %d from %d" % (
+                    n_read, n_frames, segment_start))
+            
+            self._put(queue, None)
+        except Exception as e:
+            self._put(queue, e)
+        finally:
+            reader.close()
+    
+    def _iter_segment_chunks(self, read_size):
+        """Yields chunks from every segment in order
+        
+        Starts a decoding thread for each segment, keeping up to 
+        n_decoders of them running ahead of the segment being consumed.
+        The chunks are at most read_size frames and do not cross
+        segment boundaries.
+        
+        Everything is stopped by close when this is exhausted, closed,
+        or garbage collected, even if the consumer stops early.
+        """
+        queues = [Queue.Queue(maxsize=self.max_buffered_chunks)
+            for segment in self.segments]
+        n_started = 0
+        
+        try:
+            for n_segment in range(len(self.segments)):
+                # Keep n_decoders running
+                while (n_started < len(self.segments) and 
+                    n_started < n_segment + self.n_decoders):
+                    segment_start, segment_stop = self.segments[n_started]
+                    if self.verbose:
+                        print "decoding frames %d - %d" % (
+                            segment_start, segment_stop)
+                    reader = self._start_decoder(segment_start, 
+                        segment_stop)
+                    thread = threading.Thread(target=self._decode_segment,
+                        args=(reader, segment_start, segment_stop, 
+                            read_size, queues[n_started]))
+                    thread.daemon = True
+                    self.threads.append(thread)
+                    thread.start()
+                    n_started = n_started + 1
+                
+                # Consume this segment
+                while True:
+                    item = queues[n_segment].get()
+                    if item is None:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+                    yield item
+        finally:
+            self.close()
+    
+    def iter_chunks(self, n_frames):
+        """Yields chunks of `n_frames` frames at a time, in order
+        
+        Like FFmpegReader.iter_chunks, only the last chunk can be shorter.
+        Chunks that span two segments are concatenated from both.
+        
+        The decoders are stopped when this is exhausted, closed, or 
+        garbage collected, even if the consumer stops early.
+        """
+        pending = []
+        n_pending = 0
+        segment_chunks = self._iter_segment_chunks(n_frames)
+        try:
+            for piece in segment_chunks:
+                pending.append(piece)
+                n_pending = n_pending + len(piece)
+                
+                # Yield every complete chunk
+                while n_pending >= n_frames:
+                    if len(pending) == 1:
+                        joined = pending[0]
+                    else:
+                        joined = np.concatenate(pending)
+                    chunk = joined[:n_frames]
+                    pending = [joined[n_frames:]]
+                    n_pending = len(pending[0])
+                    
+                    self.n_frames_read = self.n_frames_read + len(chunk)
+                    yield chunk
+            
+            # The last, shorter chunk
+            if n_pending > 0:
+                chunk = np.concatenate(pending)
+                self.n_frames_read = self.n_frames_read + len(chunk)
+                yield chunk
+        finally:
+            segment_chunks.close()
+            self.close()
+    
+    def iter_frames(self):
+        """Yields one frame at a time, in order"""
+        for chunk in self.iter_chunks(200):
+            for frame in chunk:
+                yield frame
+    
+    def close(self):
+        """Stops all decoding threads and ffmpeg processes
+        
+        Each thread closes its own FFmpegReader once the terminated
+        process stops sending data. This can be called more than once.
+        """
+        self._stop_event.set()
+        for reader in self.decoders:
+            if reader.ffmpeg_proc.poll() is None:
+                reader.ffmpeg_proc.terminate()
+        for thread in self.threads:
+            if thread.ident is not None:
+                thread.join()
+    
+    def isclosed(self):
+        return all([reader.isclosed() for reader in self.decoders])
+
 class FFmpegWriter:
     """Writes frames to an ffmpeg compression process"""
     def __init__(self, output_filename, frame_width, frame_height,
@@ -1505,13 +4878,18 @@ class FFmpegWriter:
         
         if write_stderr_to_screen:
             self.ffmpeg_proc = subprocess.Popen(cmdstring, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE)
+                stdout=subprocess.PIPE, close_fds=True)
         else:
             self.ffmpeg_proc = subprocess.Popen(cmdstring, stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE, stderr=open('/dev/null', 'w'))       
+                stdout=subprocess.PIPE, stderr=open('/dev/null', 'w'),
+                close_fds=True)
     
     def write(self, frame):
-        """Write a frame to the ffmpeg process"""
+        """Write a frame to the ffmpeg process
+        
+        `frame` can also be an array of frames, such as a chunk from
+        FFmpegReader.iter_chunks, which is written in a single call.
+        """
         self.ffmpeg_proc.stdin.write(frame.tostring())
     
     def write_bytes(self, bytestring):
@@ -1527,8 +4905,284 @@ def measure_chunk_star(args):
 
 
 def read_whiskers_hdf5_summary(filename):
-    """Reads and returns the `summary` table in an HDF5 file"""
+    """Reads and returns the `summary` table in an HDF5 file
+    
+    To read only some frames or whiskers, use query_whiskers_hdf5_summary.
+    """
     with tables.open_file(filename) as fi:
         summary = pandas.DataFrame.from_records(fi.root.summary.read())
     
     return summary
+
+def query_whiskers_hdf5_summary(filename, frame_start=None, frame_stop=None,
+    whisker_ids=None, columns=None, compact=False):
+    """Reads the rows of the `summary` table for some frames and whiskers
+    
+    filename : HDF5 file written by the stitching functions
+    frame_start, frame_stop : read frames from frame_start up to but not
+        including frame_stop. None means the first or last frame.
+    whisker_ids : list of whisker ids to read, or None for all
+    columns : list of columns to read, or None for all
+    compact : if True, each integer column is converted to the smallest
+        integer type that holds its values
+    
+    If the file has a frame_row_offsets array (see index_hdf5), only the
+    rows of the requested frames are read. Otherwise the condition is 
+    evaluated by PyTables, using the indexes on time and id if they exist.
+    
+    Returns: DataFrame, indexed by row of the summary table
+        The index can be passed to read_pixels.
+    """
+    with tables.open_file(filename) as h5file:
+        table = h5file.get_node('/summary')
+        frame_row_offsets = get_frame_row_offsets(h5file)
+        
+        if frame_row_offsets is not None:
+            # Look up the rows of the frames
+            if frame_start is None:
+                frame_start = 0
+            if frame_stop is None:
+                frame_stop = len(frame_row_offsets) - 1
+            frame_start = int(np.clip(frame_start, 0, 
+                len(frame_row_offsets) - 1))
+            frame_stop = int(np.clip(frame_stop, frame_start, 
+                len(frame_row_offsets) - 1))
+            start_row = frame_row_offsets[frame_start]
+            stop_row = frame_row_offsets[frame_stop]
+            rows = table.read(start_row, stop_row)
+            row_numbers = np.arange(start_row, stop_row)
+            
+            if whisker_ids is not None:
+                mask = np.in1d(rows['id'], whisker_ids)
+                rows = rows[mask]
+                row_numbers = row_numbers[mask]
+        else:
+            # Let PyTables find them
+            conditions = []
+            if frame_start is not None:
+                conditions.append('(time >= %d)' % frame_start)
+            if frame_stop is not None:
+                conditions.append('(time < %d)' % frame_stop)
+            if whisker_ids is not None:
+                conditions.append('(%s)' % ' | '.join(
+                    ['(id == %d)' % whisker_id 
+                    for whisker_id in whisker_ids] or ['(id < 0)']))
+            
+            if len(conditions) == 0:
+                row_numbers = np.arange(table.nrows)
+                rows = table.read()
+            else:
+                row_numbers = table.get_where_list(' & '.join(conditions))
+                rows = table.read_coordinates(row_numbers)
+    
+    # Choose the columns
+    if columns is None:
+        columns = list(rows.dtype.names)
+    data = {}
+    for column in columns:
+        values = rows[column]
+        if compact and values.dtype.kind in 'iu' and len(values) > 0:
+            values = values.astype(np.result_type(
+                np.min_scalar_type(values.min()), 
+                np.min_scalar_type(values.max())))
+        data[column] = values
+    
+    return pandas.DataFrame(data, columns=columns, 
+        index=pandas.Index(row_numbers, name='row'))
+
+class WhiskersHDF5Reader(object):
+    """Reads traced whiskers and their contours from an HDF5 file lazily
+    
+    The file is read a block of frames_per_block frames at a time, with
+    one contiguous read of /summary and one of each pixel array per 
+    block. With prefetch, the next block is read in a background thread 
+    while the current one is used. So at most about three blocks are in
+    memory at once, however long the session is.
+    
+    Example:
+        reader = WhiskersHDF5Reader('traced_whiskers.hdf5')
+        for frame, summary, pixels_x, pixels_y in reader.iter_frames():
+            ...
+        reader.close()
+    """
+    def __init__(self, h5_filename, frames_per_block=1000, prefetch=True):
+        """Initialize a new reader
+        
+        h5_filename : HDF5 file written by the stitching functions, with
+            either pixel layout. Its rows must be in order of frame, as
+            they are after stitching.
+        frames_per_block : how many frames to read at once
+        prefetch : whether to read the next block in the background
+        """
+        self.h5_filename = h5_filename
+        self.frames_per_block = frames_per_block
+        self.prefetch = prefetch
+        
+        self.h5file = tables.open_file(h5_filename)
+        self.table = self.h5file.get_node('/summary')
+        self.xpixels = self.h5file.get_node('/pixels_x')
+        self.ypixels = self.h5file.get_node('/pixels_y')
+        self.pixel_layout = get_pixel_layout(self.h5file)
+        
+        # The first row of each frame
+        # This is calculated from the time column if not indexed
+        self.frame_row_offsets = get_frame_row_offsets(self.h5file)
+        if self.frame_row_offsets is None:
+            times = self.table.col('time').astype(np.int64)
+            if np.any(np.diff(times) < 0):
+                self.close()
+                raise ValueError("%s is not sorted by frame" % h5_filename)
+            n_frames = times[-1] + 1 if len(times) > 0 else 0
+            self.frame_row_offsets = np.searchsorted(times, 
+                np.arange(n_frames + 1))
+        self.n_frames = len(self.frame_row_offsets) - 1
+        
+        # The prefetching thread of each running iter_blocks, and the
+        # event that stops it
+        self.threads = []
+        self._stop_events = []
+    
+    def read_block(self, frame_start, frame_stop):
+        """Read the whiskers in frames frame_start up to frame_stop
+        
+        Returns: summary, pixels_x, pixels_y
+            summary : DataFrame of the rows of /summary, indexed by row
+            pixels_x, pixels_y : lists of arrays, with the coordinates of 
+                each row of summary
+        """
+        frame_start = int(np.clip(frame_start, 0, self.n_frames))
+        frame_stop = int(np.clip(frame_stop, frame_start, self.n_frames))
+        start_row = int(self.frame_row_offsets[frame_start])
+        stop_row = int(self.frame_row_offsets[frame_stop])
+        rows = self.table.read(start_row, stop_row)
+        
+        if self.pixel_layout == 'vlarray':
+            pixels_x = self.xpixels.read(start_row, stop_row)
+            pixels_y = self.ypixels.read(start_row, stop_row)
+        elif len(rows) == 0:
+            pixels_x, pixels_y = [], []
+        else:
+            # Read the span of pixels of these rows at once
+            offsets = rows['pixel_offset'].astype(np.int64)
+            pixlens = rows['pixlen'].astype(np.int64)
+            pixel_start = offsets.min()
+            pixel_stop = (offsets + pixlens).max()
+            block_x = self.xpixels.read(pixel_start, pixel_stop)
+            block_y = self.ypixels.read(pixel_start, pixel_stop)
+            starts = offsets - pixel_start
+            pixels_x = [block_x[start:start + pixlen] 
+                for start, pixlen in zip(starts, pixlens)]
+            pixels_y = [block_y[start:start + pixlen] 
+                for start, pixlen in zip(starts, pixlens)]
+        
+        summary = pandas.DataFrame.from_records(rows, 
+            index=pandas.Index(np.arange(start_row, stop_row), name='row'))
+        return summary, pixels_x, pixels_y
+    
+    def _put(self, queue, item, stop_event):
+        """Put item on the queue, giving up once stop_event is set"""
+        while not stop_event.is_set():
+            try:
+                queue.put(item, timeout=1)
+                return
+            except Queue.Full:
+                pass
+    
+    def _prefetch_blocks(self, block_starts, frame_stop, queue, stop_event):
+        """Read each block into queue, ending with None or the exception
+        
+        Runs in its own thread, until stop_event is set. The file is only
+        read while holding HDF5_LOCK, in case several iterators are 
+        running at once.
+        """
+        try:
+            for block_start in block_starts:
+                if stop_event.is_set():
+                    return
+                block_stop = min(block_start + self.frames_per_block, 
+                    frame_stop)
+                with HDF5_LOCK:
+                    block = self.read_block(block_start, block_stop)
+                self._put(queue, (block_start, block_stop) + block, 
+                    stop_event)
+            self._put(queue, None, stop_event)
+        except Exception as e:
+            self._put(queue, e, stop_event)
+    
+    def iter_blocks(self, frame_start=0, frame_stop=None):
+        """Yields each block of frames in order
+        
+        frame_start, frame_stop : range of frames to read
+            If frame_stop is None, read to the last frame.
+        
+        Yields: block_start, block_stop, summary, pixels_x, pixels_y
+            See read_block.
+        """
+        if frame_stop is None or frame_stop > self.n_frames:
+            frame_stop = self.n_frames
+        block_starts = range(frame_start, frame_stop, self.frames_per_block)
+        
+        if not self.prefetch:
+            for block_start in block_starts:
+                block_stop = min(block_start + self.frames_per_block, 
+                    frame_stop)
+                yield (block_start, block_stop) + self.read_block(
+                    block_start, block_stop)
+            return
+        
+        # Read one block ahead, in the background
+        # Each iterator has its own thread and stop event, so that 
+        # stopping one does not stop the others
+        queue = Queue.Queue(maxsize=1)
+        stop_event = threading.Event()
+        thread = threading.Thread(target=self._prefetch_blocks,
+            args=(block_starts, frame_stop, queue, stop_event))
+        thread.daemon = True
+        self.threads.append(thread)
+        self._stop_events.append(stop_event)
+        thread.start()
+        
+        try:
+            while True:
+                item = queue.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            # Also stops the thread if the caller stops early
+            stop_event.set()
+            thread.join()
+            self.threads.remove(thread)
+            self._stop_events.remove(stop_event)
+    
+    def iter_frames(self, frame_start=0, frame_stop=None):
+        """Yields the whiskers of each frame in order
+        
+        Every frame is yielded, even if no whiskers were found in it.
+        
+        Yields: frame, summary, pixels_x, pixels_y
+            As for read_block, but for a single frame
+        """
+        for block in self.iter_blocks(frame_start, frame_stop):
+            block_start, block_stop, summary, pixels_x, pixels_y = block
+            
+            # Rows of each frame within the block
+            frame_offsets = (self.frame_row_offsets[block_start:block_stop + 1]
+                - self.frame_row_offsets[block_start])
+            for frame, start, stop in zip(range(block_start, block_stop),
+                frame_offsets[:-1], frame_offsets[1:]):
+                yield (frame, summary.iloc[start:stop], 
+                    pixels_x[start:stop], pixels_y[start:stop])
+    
+    def close(self):
+        """Stops reading, and closes the file"""
+        for stop_event in list(self._stop_events):
+            stop_event.set()
+        for thread in list(self.threads):
+            thread.join()
+        self.h5file.close()
+    
+    def isclosed(self):
+        return not self.h5file.isopen
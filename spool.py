@@ -0,0 +1,429 @@
+"""Tracing chunks on other computers, through a shared spool directory
+
+SpoolPool : a RetryingPool that, instead of running its tasks in local
+    processes, writes them as job files to a spool directory on a shared
+    filesystem. It can be passed as trace_pool to the interleaved
+    pipelines and to interleaved_batch_tracing.
+run_spool_worker : the worker daemon, which takes jobs from the spool
+    directory one at a time, runs them, and writes back the results.
+    Run one for each core of every computer that should trace.
+LocalSpoolWorkers : runs spool workers as local processes, to stand in
+    for the workers on other computers.
+
+The spool directory holds
+    jobs/ : the jobs waiting to be run, as pickled dicts of func, args,
+        and kwds, one file per attempt
+    claimed/ : the jobs being run. A worker claims a job by renaming it
+        from jobs/, which only one worker can do, and touches it every
+        heartbeat_interval seconds while running it.
+    results/ : the pickled outcome of each job, written by the worker
+Every file is written under a temporary name and then renamed, so a file
+is never read while it is being written.
+
+The workers run trace and measure where the tiff stacks are, and write the
+.whiskers and .measurements files next to them, so the directory of the
+tiff stacks must be on the shared filesystem too, at the same path on
+every computer, and chunks cannot be written to RAM scratch space. The
+whiskers are also parsed by the workers, and the parsed arrays are
+returned with the result, so only stitching is left for the computer
+that runs the pipeline.
+
+If a worker stops touching its job for lease_seconds, for instance
+because its computer was turned off, the job counts as failed and is
+retried like any other failure.
+
+A SpoolPool removes its files from jobs/ and results/ when it stops, and
+touches its jobs while they wait to be claimed. The files left by a pool
+that died are removed by the workers once they are max_file_age seconds
+old, which must be longer than the lease_seconds of every pool.
+"""
+import os
+import time
+import socket
+import threading
+import multiprocessing
+import traceback
+import cPickle as pickle
+from WhiskiWrap import base
+
+def _spool_directories(spool_directory):
+    """Returns the jobs, claimed, and results directories, creating them"""
+    directories = [os.path.join(spool_directory, name)
+        for name in ['jobs', 'claimed', 'results']]
+    for directory in directories:
+        if not os.path.exists(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another worker meanwhile
+                if not os.path.isdir(directory):
+                    raise
+    return directories
+
+def _write_atomically(filename, obj):
+    """Pickle obj to a temporary file, and rename it to filename"""
+    directory, name = os.path.split(filename)
+    temporary_filename = os.path.join(directory, '.%s.%s-%d.tmp' % (
+        name, socket.gethostname(), os.getpid()))
+    with open(temporary_filename, 'wb') as fi:
+        pickle.dump(obj, fi, pickle.HIGHEST_PROTOCOL)
+        fi.flush()
+        os.fsync(fi.fileno())
+    os.rename(temporary_filename, filename)
+
+def _read_pickle(filename):
+    with open(filename, 'rb') as fi:
+        return pickle.load(fi)
+
+def _remove_old_files(directories, max_age):
+    """Remove the files in directories last modified over max_age s ago
+    
+    Claimed jobs that are still running are touched every heartbeat, so
+    only the files of pools and workers that died are this old.
+    
+    Returns: the number of files removed
+    """
+    n_removed = 0
+    now = time.time()
+    for directory in directories:
+        for filename in os.listdir(directory):
+            full_filename = os.path.join(directory, filename)
+            try:
+                if now - os.path.getmtime(full_filename) > max_age:
+                    os.remove(full_filename)
+                    n_removed += 1
+            except OSError:
+                # Claimed, collected, or removed by another worker
+                pass
+    return n_removed
+
+class SpoolPool(base.RetryingPool):
+    """A RetryingPool whose attempts are run by workers on other computers
+
+    Each attempt is written as a job file to the spool directory, and run
+    by whichever run_spool_worker claims it first. A background thread
+    collects the results every poll_interval seconds, and calls back as
+    RetryingPool does. Jobs whose worker stops heartbeating for
+    lease_seconds count as failed, and are retried up to max_retries
+    times in all.
+
+    The function and its arguments are pickled, so the function must be
+    importable by the workers, like WhiskiWrap.trace_and_parse_chunk.
+
+    Each attempt also records the worker that ran it, as 'worker'.
+
+    join waits until every task is finished, so at least one worker must
+    be running. Stragglers are not duplicated, because the number of idle
+    workers is not known.
+    """
+    def __init__(self, spool_directory, max_retries=1, lease_seconds=60.,
+        poll_interval=.5, verbose=True):
+        """Start collecting results from the spool directory
+
+        spool_directory : directory on a filesystem shared with the
+            workers. Several pools and workers can share it.
+        max_retries : how many times to retry a job that fails or whose
+            worker is lost
+        lease_seconds : how long a worker can go without touching the job
+            it claimed before it is presumed lost. This must be longer
+            than the heartbeat_interval of the workers.
+        poll_interval : how often to look for results
+        verbose : print when jobs are retried
+        """
+        self.spool_directory = spool_directory
+        self.lease_seconds = lease_seconds
+
+        # Identifies the jobs of this pool
+        self.run_id = '%s-%d-%d' % (socket.gethostname(), os.getpid(),
+            int(time.time() * 1000))
+        self.n_jobs = 0
+
+        # Map each job that has no result yet to (task, attempt)
+        self.jobs = {}
+
+        # Map each claimed job to the last change of its mtime, as
+        # (mtime, time first seen). The times of this computer are used
+        # to time the lease, in case the clocks differ
+        self.leases = {}
+
+        # The number of workers is unknown, so every attempt counts as
+        # running from when it is submitted until it is claimed
+        base.RetryingPool.__init__(self, float('inf'),
+            max_retries=max_retries, speculate=False,
+            poll_interval=poll_interval, verbose=verbose)
+
+    def _start_workers(self):
+        """Create the spool directories, and start collecting results"""
+        self.jobs_directory, self.claimed_directory, \
+            self.results_directory = _spool_directories(
+            self.spool_directory)
+        self._stop_polling = threading.Event()
+        self._poll_thread = threading.Thread(target=self._poll_loop)
+        self._poll_thread.daemon = True
+        self._poll_thread.start()
+        return None
+
+    def _dispatch(self, task, attempt, kwds):
+        """Write the attempt as a job file"""
+        job_id = '%s_%06d_%02d' % (self.run_id, self.n_jobs,
+            attempt['attempt'])
+        self.n_jobs += 1
+        self.jobs[job_id] = (task, attempt)
+        _write_atomically(os.path.join(self.jobs_directory, job_id + '.job'),
+            {'func': task.func, 'args': task.args, 'kwds': kwds})
+
+    def _list_own(self, directory, extension):
+        """Returns the ids of the jobs of this pool in directory"""
+        return [filename[:-len(extension)]
+            for filename in os.listdir(directory)
+            if filename.startswith(self.run_id) and
+            filename.endswith(extension)]
+
+    def _poll_loop(self):
+        while not self._stop_polling.wait(self.poll_interval):
+            try:
+                self.poll()
+            except Exception as error:
+                # Try again next time, e.g. if the filesystem hiccupped
+                print "error polling %s: %r" % (self.spool_directory, error)
+
+    def poll(self):
+        """Collect the results, and give up on jobs whose worker is lost
+
+        This is called every poll_interval seconds by a background thread.
+        """
+        # Collect the results
+        # Results of jobs that were given up on are discarded
+        # A result that cannot be read, for instance because it was 
+        # corrupted on the shared filesystem, counts as a failed attempt,
+        # so that the job is retried rather than read again forever
+        for job_id in self._list_own(self.results_directory, '.result'):
+            result_filename = os.path.join(self.results_directory,
+                job_id + '.result')
+            try:
+                outcome = _read_pickle(result_filename)
+            except Exception:
+                outcome = {'success': False, 'worker': None, 
+                    'value': "cannot read the result of %s:\n%s" % (
+                    job_id, traceback.format_exc())}
+            os.remove(result_filename)
+            with self.lock:
+                task_and_attempt = self.jobs.pop(job_id, None)
+                self.leases.pop(job_id, None)
+            if task_and_attempt is None:
+                continue
+            task, attempt = task_and_attempt
+            attempt['worker'] = outcome['worker']
+            self._finish_attempt(task, attempt,
+                (outcome['success'], outcome['value']))
+
+        # Touch the jobs still waiting to be claimed every lease_seconds,
+        # so that workers do not remove them as left by a dead pool
+        now = time.time()
+        for job_id in self._list_own(self.jobs_directory, '.job'):
+            job_filename = os.path.join(self.jobs_directory, job_id + '.job')
+            try:
+                if now - os.path.getmtime(job_filename) > self.lease_seconds:
+                    os.utime(job_filename, None)
+            except OSError:
+                # Just claimed
+                pass
+
+        # Check that the workers are still working on the claimed jobs
+        for job_id in self._list_own(self.claimed_directory, '.job'):
+            claimed_filename = os.path.join(self.claimed_directory,
+                job_id + '.job')
+            try:
+                mtime = os.path.getmtime(claimed_filename)
+            except OSError:
+                # Just finished
+                continue
+
+            with self.lock:
+                if job_id not in self.jobs:
+                    continue
+                task, attempt = self.jobs[job_id]
+                if job_id not in self.leases:
+                    # Just claimed, so it started running now
+                    attempt['start'] = now
+                if job_id not in self.leases or \
+                    self.leases[job_id][0] != mtime:
+                    self.leases[job_id] = (mtime, now)
+                    continue
+                if now - self.leases[job_id][1] < self.lease_seconds:
+                    continue
+
+                # The worker is lost
+                self.jobs.pop(job_id)
+                self.leases.pop(job_id)
+            try:
+                os.remove(claimed_filename)
+            except OSError:
+                pass
+            self._finish_attempt(task, attempt, (False,
+                "the worker running %s stopped renewing its lease" % job_id))
+
+    def _stop_workers(self, terminate):
+        """Stop collecting results, and remove the files of this pool
+
+        The jobs of this pool that were not claimed yet are removed, so
+        that no worker runs them, and so are the results that were not
+        collected, like those of jobs that were given up on.
+
+        terminate : ignored, because the jobs being run cannot be stopped
+            from here. Their results are removed by the workers once they
+            are max_file_age old.
+        """
+        self._stop_polling.set()
+        self._poll_thread.join()
+        for directory, extension in [(self.jobs_directory, '.job'),
+            (self.results_directory, '.result')]:
+            for job_id in self._list_own(directory, extension):
+                try:
+                    os.remove(os.path.join(directory, job_id + extension))
+                except OSError:
+                    # Claimed meanwhile
+                    pass
+
+def _claim_job(jobs_directory, claimed_directory):
+    """Claim the oldest job that no other worker has claimed
+
+    Returns: the job id, or None if there are no jobs
+    """
+    job_filenames = sorted(filename for filename in os.listdir(jobs_directory)
+        if filename.endswith('.job') and not filename.startswith('.'))
+    for job_filename in job_filenames:
+        try:
+            os.rename(os.path.join(jobs_directory, job_filename),
+                os.path.join(claimed_directory, job_filename))
+        except OSError:
+            # Another worker claimed it first
+            continue
+        return job_filename[:-len('.job')]
+    return None
+
+def run_spool_worker(spool_directory, poll_interval=1.,
+    heartbeat_interval=10., max_idle_seconds=None, stop_event=None,
+    max_file_age=24 * 3600., verbose=True):
+    """Run the jobs of SpoolPools one at a time, until stopped
+
+    On each computer that should trace, start one of these for each core,
+    for instance with
+        python -c "import WhiskiWrap;
+            WhiskiWrap.spool.run_spool_worker('/shared/spool')"
+    or start LocalSpoolWorkers.
+
+    spool_directory : the spool directory of the SpoolPool
+    poll_interval : how often to look for jobs when there are none
+    heartbeat_interval : how often to touch the job being run, to show
+        that it is still running. Must be shorter than the lease_seconds
+        of the SpoolPool.
+    max_idle_seconds : stop after there have been no jobs for this long,
+        or None to keep going
+    stop_event : stop when this multiprocessing.Event is set, or None
+    max_file_age : while idle, remove the files in the spool directory 
+        that were last modified this many seconds ago, which were left
+        by pools or workers that died. None to keep them.
+    verbose : print each job
+
+    Returns: the number of jobs run
+    """
+    jobs_directory, claimed_directory, results_directory = \
+        _spool_directories(spool_directory)
+    worker = '%s-%d' % (socket.gethostname(), os.getpid())
+
+    n_jobs = 0
+    idle_since = time.time()
+    last_cleanup = None
+    while stop_event is None or not stop_event.is_set():
+        job_id = _claim_job(jobs_directory, claimed_directory)
+        if job_id is None:
+            if max_idle_seconds is not None and \
+                time.time() - idle_since > max_idle_seconds:
+                break
+            
+            # Clean up at most about once per hundredth of max_file_age
+            if max_file_age is not None and (last_cleanup is None or 
+                time.time() - last_cleanup > max_file_age / 100.):
+                last_cleanup = time.time()
+                n_removed = _remove_old_files([jobs_directory, 
+                    claimed_directory, results_directory], max_file_age)
+                if verbose and n_removed > 0:
+                    print "%s removed %d old files from %s" % (worker, 
+                        n_removed, spool_directory)
+            time.sleep(poll_interval)
+            continue
+        claimed_filename = os.path.join(claimed_directory, job_id + '.job')
+        if verbose:
+            print "%s running %s" % (worker, job_id)
+
+        # Touch the claimed job while it runs
+        done = threading.Event()
+        def heartbeat():
+            while not done.wait(heartbeat_interval):
+                try:
+                    os.utime(claimed_filename, None)
+                except OSError:
+                    # The pool gave up on this job
+                    pass
+        heartbeat_thread = threading.Thread(target=heartbeat)
+        heartbeat_thread.daemon = True
+        heartbeat_thread.start()
+
+        # Run it, catching any error
+        try:
+            job = _read_pickle(claimed_filename)
+            success, value = base._call_catching_errors(job['func'],
+                job['args'], job['kwds'])
+        except Exception:
+            success, value = False, traceback.format_exc()
+        finally:
+            done.set()
+            heartbeat_thread.join()
+
+        # Return the result, then release the claim
+        result_filename = os.path.join(results_directory, job_id + '.result')
+        try:
+            _write_atomically(result_filename,
+                {'success': success, 'value': value, 'worker': worker})
+        except Exception:
+            _write_atomically(result_filename, {'success': False,
+                'value': traceback.format_exc(), 'worker': worker})
+        try:
+            os.remove(claimed_filename)
+        except OSError:
+            pass
+
+        n_jobs += 1
+        idle_since = time.time()
+
+    return n_jobs
+
+class LocalSpoolWorkers(object):
+    """Runs run_spool_worker in local processes
+
+    This stands in for the workers on other computers, for testing a
+    SpoolPool, and can also be used to start the workers of a computer.
+    Start it before opening any HDF5 file, so the processes do not
+    inherit it.
+    """
+    def __init__(self, spool_directory, n_workers=4, **kwargs):
+        """Start n_workers worker processes
+
+        kwargs : passed to run_spool_worker
+        """
+        self.spool_directory = spool_directory
+        self.stop_event = multiprocessing.Event()
+        kwargs['stop_event'] = self.stop_event
+        self.processes = [multiprocessing.Process(target=run_spool_worker,
+            args=(spool_directory,), kwargs=kwargs)
+            for n_worker in range(n_workers)]
+        for process in self.processes:
+            process.daemon = True
+            process.start()
+
+    def close(self):
+        """Wait for the jobs being run to finish, and stop the workers"""
+        self.stop_event.set()
+        for process in self.processes:
+            process.join()
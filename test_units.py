@@ -0,0 +1,588 @@
+"""Small tests that need neither whisk nor any video
+
+They cover the parts of WhiskiWrap that can be checked on their own:
+reading whisk's binary files, stitching them into HDF5, RetryingPool and
+SpoolPool, resuming from a RunManifest, ChunkSizeTuner, and merging the 
+segments decoded by ParallelFFmpegReader. Run them with
+    python -m unittest WhiskiWrap.test_units
+The benchmarks that trace real videos are in tests.
+"""
+import os
+import time
+import shutil
+import struct
+import tempfile
+import threading
+import unittest
+import collections
+import numpy as np
+import WhiskiWrap
+from WhiskiWrap import base
+from WhiskiWrap import spool
+from WhiskiWrap import whisker_io
+
+
+## Functions run by the pools
+# They are module-level so that they can be pickled
+def _double(value, attempt=0):
+    return 2 * value
+
+def _fail_first_attempt(value, attempt=0):
+    if attempt == 0:
+        raise ValueError("first attempt at %r" % value)
+    return 2 * value
+
+def _always_fail(value, attempt=0):
+    raise ValueError("always fails on %r" % value)
+
+def _sleep_on_first_attempt(seconds, attempt=0):
+    if attempt == 0:
+        time.sleep(seconds)
+    return attempt
+
+def _die_on_first_attempt(value, attempt=0):
+    """Kill the worker running the first attempt, like a lost computer"""
+    if attempt == 0:
+        os._exit(1)
+    return 2 * value
+
+
+## Writing whisk's binary files
+def write_whiskbin1(filename, segments):
+    """Write segments, a list of (id, time, x, y), as whiskbin1"""
+    with open(filename, 'wb') as fi:
+        fi.write(whisker_io.WHISKBIN1_HEADER)
+        for wid, frame, x, y in segments:
+            fi.write(struct.pack('<iii', wid, frame, len(x)))
+            for values in [x, y, np.ones(len(x)), np.zeros(len(x))]:
+                fi.write(np.asarray(values, dtype='<f4').tostring())
+        fi.write(struct.pack('<i', len(segments)))
+
+def write_measv3(filename, rows):
+    """Write rows, a list of (fid, wid, data), as measv3"""
+    n_measures = len(rows[0][2]) if len(rows) > 0 else 8
+    with open(filename, 'wb') as fi:
+        fi.write(whisker_io.MEASV3_HEADER)
+        fi.write(struct.pack('<ii', len(rows), n_measures))
+        for n_row, (fid, wid, data) in reversed(list(enumerate(rows))):
+            fi.write(struct.pack('<10i', n_row, fid, wid, 1, 0, 0, 0, 0, 0,
+                n_measures))
+            fi.write('x')
+            fi.write(np.asarray(data, dtype='<f8').tostring())
+            fi.write(np.zeros(n_measures, dtype='<f8').tostring())
+
+
+class TemporaryDirectoryTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+
+class WhiskerIOTest(TemporaryDirectoryTest):
+    segments = [
+        (1, 3, [5., 6., 7.], [1., 2., 3.]),
+        (0, 3, [10., 11.], [12., 13.]),
+        (0, 1, [20.], [21.]),
+        ]
+
+    def test_read_whiskers(self):
+        filename = os.path.join(self.directory, 'chunk.whiskers')
+        write_whiskbin1(filename, self.segments)
+        segments = whisker_io.read_whiskers(filename)
+
+        # Sorted by time and then id
+        self.assertEqual(list(segments.time), [1, 3, 3])
+        self.assertEqual(list(segments.id), [0, 0, 1])
+        self.assertEqual(list(segments.pixlen), [1, 2, 3])
+        x, y = segments.segment_pixels(2)
+        self.assertEqual(list(x), [5., 6., 7.])
+        self.assertEqual(list(y), [1., 2., 3.])
+        self.assertEqual(list(segments.thick), [1.] * 6)
+
+    def test_read_empty_whiskers(self):
+        filename = os.path.join(self.directory, 'chunk.whiskers')
+        write_whiskbin1(filename, [])
+        self.assertEqual(len(whisker_io.read_whiskers(filename)), 0)
+
+    def test_truncated_whiskers(self):
+        filename = os.path.join(self.directory, 'chunk.whiskers')
+        write_whiskbin1(filename, self.segments)
+        with open(filename, 'r+b') as fi:
+            fi.truncate(os.path.getsize(filename) - 10)
+        with self.assertRaises(IOError) as context:
+            whisker_io.read_whiskers(filename)
+        self.assertNotIsInstance(context.exception, whisker_io.FormatError)
+
+    def test_other_format(self):
+        filename = os.path.join(self.directory, 'chunk.whiskers')
+        with open(filename, 'w') as fi:
+            fi.write('a text file')
+        with self.assertRaises(whisker_io.FormatError):
+            whisker_io.read_whiskers(filename)
+        with self.assertRaises(whisker_io.FormatError):
+            whisker_io.read_measurements(filename)
+
+    def test_read_measurements(self):
+        filename = os.path.join(self.directory, 'chunk.measurements')
+        write_measv3(filename, [(3, 1, np.arange(8) + 10.),
+            (1, 0, np.arange(8)), (3, 0, np.arange(8) + 20.)])
+        measurements = whisker_io.read_measurements(filename)
+
+        self.assertEqual(list(measurements['fid']), [1, 3, 3])
+        self.assertEqual(list(measurements['wid']), [0, 0, 1])
+        self.assertEqual(list(measurements['length']), [0., 20., 10.])
+        self.assertEqual(list(measurements['tip_y']), [7., 27., 17.])
+
+    def test_truncated_measurements(self):
+        filename = os.path.join(self.directory, 'chunk.measurements')
+        write_measv3(filename, [(1, 0, np.arange(8))])
+        with open(filename, 'r+b') as fi:
+            fi.truncate(os.path.getsize(filename) - 1)
+        with self.assertRaises(IOError) as context:
+            whisker_io.read_measurements(filename)
+        self.assertNotIsInstance(context.exception, whisker_io.FormatError)
+
+    def test_join_measurements(self):
+        segments = whisker_io.WhiskerSegments(time=[1, 3, 3], id=[0, 0, 1],
+            pixlen=[0, 0, 0], x=[], y=[])
+        measurements = np.zeros(4, dtype=whisker_io.MEASUREMENTS_DTYPE)
+        measurements['fid'] = [3, 3, 1, 2]
+        measurements['wid'] = [1, 0, 0, 0]
+        measurements['length'] = [31, 30, 10, 20]
+
+        joined = whisker_io.join_measurements(segments, measurements)
+        self.assertEqual(list(joined['length']), [10, 30, 31])
+
+        # A segment without measurements
+        with self.assertRaises(ValueError):
+            whisker_io.join_measurements(segments, measurements[:2])
+
+
+class HDF5StitcherTest(TemporaryDirectoryTest):
+    def test_stitch_in_order(self):
+        h5_filename = os.path.join(self.directory, 'out.h5')
+        base.setup_hdf5(h5_filename, 100, pixel_layout='flat')
+        whisk_filenames = []
+        for chunk_start in [0, 10]:
+            whisk_filename = os.path.join(self.directory, 
+                'chunk%08d.whiskers' % chunk_start)
+            write_whiskbin1(whisk_filename, [
+                (0, 1, [1., 2.], [3., 4.]), 
+                (1, 2, [chunk_start + 5.], [6.])])
+            whisk_filenames.append(whisk_filename)
+        
+        stitcher = base.HDF5Stitcher(h5_filename, roi_offset=(100, 200))
+        stitcher.expect(0)
+        stitcher.expect(10)
+        
+        # The later chunk is parsed by the caller, and the earlier one by
+        # the stitcher, which must still write it first
+        parsed = base.parse_chunk_to_arrays(whisk_filenames[1], 10, 
+            stitcher.dtype, roi_offset=stitcher.roi_offset)
+        stitcher.add_chunk(10, whisk_filenames[1], parsed=parsed)
+        stitcher.add_chunk(0, whisk_filenames[0])
+        stitcher.close()
+        self.assertEqual(stitcher.chunk_starts_stitched, [0, 10])
+        
+        with base.tables.open_file(h5_filename) as h5file:
+            summary = h5file.root.summary.read()
+        self.assertEqual(list(summary['time']), [1, 2, 11, 12])
+        self.assertEqual(list(summary['fol_x']), [101, 105, 101, 115])
+        pixels_x, pixels_y = base.read_pixels(h5_filename)
+        self.assertEqual(list(pixels_x[3]), [115.])
+        self.assertEqual(list(pixels_y[2]), [203., 204.])
+
+
+class RetryingPoolTest(unittest.TestCase):
+    def test_retry(self):
+        pool = base.RetryingPool(2, max_retries=1, verbose=False)
+        results = []
+        tasks = [pool.apply_async(func, (value,), callback=results.append)
+            for func, value in [(_double, 1), (_fail_first_attempt, 2),
+            (_always_fail, 3)]]
+        pool.close()
+        pool.join()
+
+        self.assertEqual(tasks[0].get(), 2)
+        self.assertEqual(tasks[1].get(), 4)
+        self.assertRaises(RuntimeError, tasks[2].get)
+
+        # Only the attempts that succeeded are called back
+        self.assertEqual(sorted(results), [2, 4])
+
+        # The tasks that took more than one attempt are reported
+        report = pool.report()
+        self.assertEqual(sorted(report.keys()), [2, 3])
+        self.assertEqual([attempt['outcome'] for attempt in report[2]],
+            ['error', 'ok'])
+        self.assertEqual([attempt['outcome'] for attempt in report[3]],
+            ['error', 'error'])
+
+    def test_callback_error(self):
+        # The pool keeps calling back after a callback fails, and join
+        # raises the error once every task is done
+        pool = base.RetryingPool(2, verbose=False)
+        results = []
+        def callback(result):
+            if result == 2:
+                raise ValueError("callback failed")
+            results.append(result)
+        tasks = [pool.apply_async(_double, (value,), callback=callback)
+            for value in range(4)]
+        pool.close()
+        with self.assertRaises(RuntimeError) as context:
+            pool.join()
+        self.assertIn('callback failed', str(context.exception))
+        self.assertEqual(sorted(results), [0, 4, 6])
+        self.assertRaises(RuntimeError, tasks[1].get)
+        self.assertEqual(tasks[2].get(), 4)
+
+    def test_speculate(self):
+        pool = base.RetryingPool(2, speculate=True, speculate_factor=2.,
+            speculate_min_seconds=.5, poll_interval=.05, verbose=False)
+        pool.apply_async(_double, (1,)).get(timeout=10)
+
+        # The duplicate of the straggler wins, and the straggler is
+        # terminated instead of waited for
+        start_time = time.time()
+        task = pool.apply_async(_sleep_on_first_attempt, (60,))
+        self.assertEqual(task.get(timeout=10), 1)
+        pool.close()
+        pool.join()
+        self.assertLess(time.time() - start_time, 30)
+        self.assertEqual([attempt['outcome'] for attempt in task.attempts],
+            ['lost', 'ok'])
+        self.assertTrue(task.attempts[1]['speculative'])
+
+    def test_map_with_retries(self):
+        results, retried = base.map_with_retries(_fail_first_attempt,
+            [(1,), (2,)], 2, verbose=False)
+        self.assertEqual(results, [2, 4])
+        self.assertEqual(sorted(retried.keys()), [1, 2])
+
+
+class SpoolPoolTest(TemporaryDirectoryTest):
+    def setUp(self):
+        TemporaryDirectoryTest.setUp(self)
+        self.workers = spool.LocalSpoolWorkers(self.directory, n_workers=2,
+            poll_interval=.05, heartbeat_interval=.1, verbose=False)
+
+    def tearDown(self):
+        self.workers.close()
+        TemporaryDirectoryTest.tearDown(self)
+
+    def run_pool(self, func, values, **kwargs):
+        """Run func on each value in a SpoolPool, and return the tasks"""
+        pool = spool.SpoolPool(self.directory, poll_interval=.05,
+            verbose=False, **kwargs)
+        tasks = [pool.apply_async(func, (value,)) for value in values]
+        pool.close()
+        pool.join()
+
+        # The pool removes its files when it stops
+        self.assertEqual(pool._list_own(pool.jobs_directory, '.job'), [])
+        self.assertEqual(pool._list_own(pool.results_directory, '.result'),
+            [])
+        return tasks
+
+    def test_run(self):
+        tasks = self.run_pool(_double, range(5))
+        self.assertEqual([task.get() for task in tasks], range(0, 10, 2))
+        for task in tasks:
+            self.assertIn('worker', task.attempts[0])
+
+    def test_retry(self):
+        tasks = self.run_pool(_fail_first_attempt, [1, 2])
+        self.assertEqual([task.get() for task in tasks], [2, 4])
+        self.assertEqual([attempt['outcome']
+            for attempt in tasks[0].attempts], ['error', 'ok'])
+
+    def test_unreadable_result(self):
+        # Corrupt the first result before the pool reads it
+        read_pickle = spool._read_pickle
+        corrupted = []
+        def read_corrupted_pickle(filename):
+            if filename.endswith('.result') and len(corrupted) == 0:
+                with open(filename, 'wb') as fi:
+                    fi.write('garbage')
+                corrupted.append(filename)
+            return read_pickle(filename)
+        spool._read_pickle = read_corrupted_pickle
+        try:
+            tasks = self.run_pool(_double, [1])
+        finally:
+            spool._read_pickle = read_pickle
+
+        # It counts as a failed attempt, and is retried
+        self.assertEqual(tasks[0].get(), 2)
+        self.assertEqual([attempt['outcome']
+            for attempt in tasks[0].attempts], ['error', 'ok'])
+        self.assertFalse(os.path.exists(corrupted[0]))
+
+    def test_lease_expiry(self):
+        # Both workers die, so start two more for the retries
+        more_workers = spool.LocalSpoolWorkers(self.directory, n_workers=2,
+            poll_interval=.05, heartbeat_interval=.1, verbose=False)
+        try:
+            tasks = self.run_pool(_die_on_first_attempt, [1],
+                lease_seconds=1.)
+        finally:
+            more_workers.close()
+        self.assertEqual(tasks[0].get(), 2)
+        attempts = tasks[0].attempts
+        self.assertEqual([attempt['outcome'] for attempt in attempts],
+            ['error', 'ok'])
+        self.assertIn('stopped renewing its lease', attempts[0]['error'])
+
+    def test_remove_old_files(self):
+        old_filename = os.path.join(self.directory, 'results', 'old.result')
+        new_filename = os.path.join(self.directory, 'results', 'new.result')
+        for filename in [old_filename, new_filename]:
+            open(filename, 'w').close()
+        two_days_ago = time.time() - 2 * 24 * 3600
+        os.utime(old_filename, (two_days_ago, two_days_ago))
+
+        n_removed = spool._remove_old_files(
+            [os.path.join(self.directory, 'results')], 24 * 3600)
+        self.assertEqual(n_removed, 1)
+        self.assertFalse(os.path.exists(old_filename))
+        self.assertTrue(os.path.exists(new_filename))
+
+
+class StubProcess(object):
+    def poll(self):
+        return 0
+
+    def terminate(self):
+        pass
+
+
+class StubReader(object):
+    """Stands in for the FFmpegReader of one segment
+
+    Each frame is filled with its frame number. n_missing frames are
+    left off the end, like a decoder that stopped early.
+    """
+    def __init__(self, segment_start, segment_stop, n_missing=0):
+        self.frames = np.arange(segment_start, segment_stop - n_missing,
+            dtype=np.uint8)[:, None, None] * np.ones((1, 2, 3), np.uint8)
+        self.ffmpeg_proc = StubProcess()
+        self.closed = False
+
+    def iter_chunks(self, n_frames):
+        for start in range(0, len(self.frames), n_frames):
+            yield self.frames[start:start + n_frames]
+
+    def close(self):
+        self.closed = True
+
+    def isclosed(self):
+        return self.closed
+
+
+class StubParallelReader(base.ParallelFFmpegReader):
+    """A ParallelFFmpegReader of StubReaders, without any video"""
+    def __init__(self, segments, n_decoders=2, n_missing=0):
+        self.segments = segments
+        self.n_decoders = n_decoders
+        self.n_missing = n_missing
+        self.max_buffered_chunks = 2
+        self.verbose = False
+        self.n_frames_read = 0
+        self.decoders = []
+        self.threads = []
+        self._stop_event = threading.Event()
+
+    def _start_decoder(self, segment_start, segment_stop):
+        reader = StubReader(segment_start, segment_stop, self.n_missing)
+        self.decoders.append(reader)
+        return reader
+
+
+class ParallelFFmpegReaderTest(unittest.TestCase):
+    segments = [(0, 25), (25, 40), (40, 100)]
+
+    def consume(self, func, timeout=10):
+        """Returns func(), failing rather than hanging if it does not end"""
+        outcome = []
+        def target():
+            try:
+                outcome.append((True, func()))
+            except Exception as error:
+                outcome.append((False, error))
+        thread = threading.Thread(target=target)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), "the reader hung")
+        success, value = outcome[0]
+        if not success:
+            raise value
+        return value
+
+    def test_iter_chunks(self):
+        reader = StubParallelReader(self.segments)
+        chunks = self.consume(lambda: list(reader.iter_chunks(30)))
+        self.assertEqual([len(chunk) for chunk in chunks], [30, 30, 30, 10])
+        self.assertEqual(list(np.concatenate(chunks)[:, 0, 0]), range(100))
+        self.assertEqual(reader.n_frames_read, 100)
+        self.assertTrue(reader.isclosed())
+        self.assertFalse(any(thread.is_alive() for thread in reader.threads))
+
+    def test_stop_early(self):
+        reader = StubParallelReader(self.segments, n_decoders=3)
+        def read_one():
+            chunks = reader.iter_chunks(5)
+            chunk = next(chunks)
+            chunks.close()
+            return chunk
+        self.assertEqual(list(self.consume(read_one)[:, 0, 0]), range(5))
+        self.assertTrue(reader.isclosed())
+        self.assertFalse(any(thread.is_alive() for thread in reader.threads))
+
+    def test_missing_frames(self):
+        reader = StubParallelReader(self.segments, n_missing=3)
+        with self.assertRaises(IOError):
+            self.consume(lambda: list(reader.iter_chunks(30)))
+        self.assertTrue(reader.isclosed())
+
+
+class RunManifestTest(TemporaryDirectoryTest):
+    def write_file(self, name, contents):
+        filename = os.path.join(self.directory, name)
+        with open(filename, 'w') as fi:
+            fi.write(contents)
+        return filename
+
+    def record_run(self):
+        """Record a run of four chunks of 100 frames
+
+        0 is stitched, 100 traced, 200 written, and 300 written but its
+        tiff stack is lost.
+        """
+        manifest = base.RunManifest(self.manifest_filename, {'chunk_size': 100})
+        for chunk_start in [0, 100, 200, 300]:
+            tif_filename = self.write_file('chunk%03d.tif' % chunk_start,
+                'frames %d' % chunk_start)
+            manifest.record_written(chunk_start, 100, tif_filename)
+        for chunk_start in [0, 100]:
+            manifest.record_traced(chunk_start, self.write_file(
+                'chunk%03d.whiskers' % chunk_start,
+                'whiskers %d' % chunk_start))
+        manifest.record_stitched(0, 10, 50)
+        os.remove(os.path.join(self.directory, 'chunk300.tif'))
+        return manifest
+
+    def setUp(self):
+        TemporaryDirectoryTest.setUp(self)
+        self.manifest_filename = os.path.join(self.directory,
+            'manifest.jsonl')
+
+    def test_plan_resume(self):
+        self.record_run()
+        plan = base.RunManifest(self.manifest_filename).plan_resume(
+            self.directory, summary_nrows=10, pixels_nrows=50)
+
+        self.assertEqual(plan['stitched'], [0])
+        self.assertEqual((plan['summary_nrows'], plan['pixels_nrows']),
+            (10, 50))
+        self.assertEqual(plan['to_stitch'], [(100,
+            os.path.join(self.directory, 'chunk100.whiskers'), None)])
+        self.assertEqual(plan['to_trace'], [(200, 100,
+            os.path.join(self.directory, 'chunk200.tif'))])
+        self.assertEqual(plan['resume_frame'], 300)
+
+    def test_plan_resume_without_stitched_rows(self):
+        # The HDF5 file lost the rows of chunk 0, so it is stitched again
+        self.record_run()
+        plan = base.RunManifest(self.manifest_filename).plan_resume(
+            self.directory, summary_nrows=5, pixels_nrows=50)
+        self.assertEqual(plan['stitched'], [])
+        self.assertEqual([chunk[0] for chunk in plan['to_stitch']],
+            [0, 100])
+
+    def test_plan_resume_with_changed_files(self):
+        # Changed whiskers are traced again, and a changed tiff stack
+        # is read again along with everything after it
+        self.record_run()
+        self.write_file('chunk100.whiskers', 'changed')
+        self.write_file('chunk200.tif', 'changed')
+        plan = base.RunManifest(self.manifest_filename).plan_resume(
+            self.directory, summary_nrows=10, pixels_nrows=50)
+        self.assertEqual(plan['to_stitch'], [])
+        self.assertEqual([chunk[0] for chunk in plan['to_trace']], [100])
+        self.assertEqual(plan['resume_frame'], 200)
+
+    def test_cut_off_line(self):
+        # The last event was cut off when the process died
+        self.record_run()
+        with open(self.manifest_filename, 'a') as fi:
+            fi.write('{"event": "stitched", "chunk_')
+        manifest = base.RunManifest(self.manifest_filename)
+        self.assertEqual(manifest.params, {'chunk_size': 100})
+        self.assertEqual(manifest.chunks[100]['state'], 'traced')
+
+        # New events can be appended after it
+        manifest.record_stitched(100, 20, 100)
+        manifest = base.RunManifest(self.manifest_filename)
+        self.assertEqual(manifest.chunks[100]['state'], 'stitched')
+
+
+class ChunkSizeTunerTest(unittest.TestCase):
+    def simulate(self, tuner, noise=0., seed=0, n_chunks=300,
+        n_in_flight=8):
+        """Run chunks with 2 s overhead and 0.05 s per frame
+
+        The best size is 360 frames, for 10% overhead. Each size is only
+        recorded once n_in_flight more chunks have been started, as in
+        the pipelines, and the durations are off by up to noise.
+        """
+        random_state = np.random.RandomState(seed)
+        in_flight = collections.deque()
+        for n_chunk in range(n_chunks):
+            in_flight.append(tuner.chunk_size)
+            if len(in_flight) >= n_in_flight:
+                n_frames = in_flight.popleft()
+                tuner.record(n_frames, (2. + 0.05 * n_frames) *
+                    (1 + random_state.uniform(-noise, noise)))
+        return np.array(tuner.chunk_sizes)
+
+    def test_converges(self):
+        chunk_sizes = self.simulate(base.ChunkSizeTuner(200))
+        self.assertTrue(np.all(chunk_sizes[-100:] == chunk_sizes[-1]))
+        self.assertTrue(360 <= chunk_sizes[-1] <= 360 * 1.25)
+
+    def test_stable_with_noise(self):
+        for seed in range(5):
+            chunk_sizes = self.simulate(base.ChunkSizeTuner(200),
+                noise=.3, seed=seed)
+            self.assertLessEqual(np.sum(np.diff(chunk_sizes[-100:]) != 0),
+                5)
+            self.assertTrue(100 <= chunk_sizes[-1] <= 1000)
+
+    def test_probes_until_fit(self):
+        # Chunks of one size cannot tell overhead from frames
+        tuner = base.ChunkSizeTuner(200)
+        for n_chunk in range(3):
+            tuner.record(200, 12.)
+        self.assertIsNone(tuner.overhead)
+        self.assertEqual(tuner.chunk_sizes, [200, 100, 400, 100])
+
+    def test_limits(self):
+        tuner = base.ChunkSizeTuner(200, max_chunk_bytes=150 * 1000)
+        tuner.frame_nbytes = 1000
+        chunk_sizes = self.simulate(tuner)
+        self.assertEqual(chunk_sizes[1:].max(), 150)
+
+        tuner = base.ChunkSizeTuner(200, max_chunk_seconds=10.)
+        chunk_sizes = self.simulate(tuner)
+        self.assertTrue(np.all(chunk_sizes[-100:] <= 200))
+
+        self.assertRaises(ValueError, base.ChunkSizeTuner, 200,
+            min_chunk_size=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
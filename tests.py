@@ -28,7 +28,7 @@ def setup_session_directory(directory, input_video, force=False):
     
     # Erase existing directory and create anew
     whiski_files = ['.mp4', '.avi', '.whiskers', '.tif', '.measurements',
-        '.detectorbank', '.parameters', '.hdf5']
+        '.detectorbank', '.parameters', '.hdf5', '.jsonl']
     if os.path.exists(directory):
         # Check that it looks like a whiskers directory
         file_list = os.listdir(directory)
@@ -195,6 +195,89 @@ def run_offset_test(test_root='~/whiski_wrap_test', start=1525, offset=5,
 
     return test_results, durations
 
+# Settings compared by run_hdf5_storage_benchmark: name, setup_hdf5 kwargs
+HDF5_STORAGE_SETTINGS = [
+    ('uncompressed', {}),
+    ('zlib1', {'complib': 'zlib', 'complevel': 1}),
+    ('zlib5', {'complib': 'zlib', 'complevel': 5}),
+    ('blosc5', {'complib': 'blosc', 'complevel': 5}),
+    ('blosc_lz4_5', {'complib': 'blosc:lz4', 'complevel': 5}),
+    ('blosc_lz4_5_noshuffle', 
+        {'complib': 'blosc:lz4', 'complevel': 5, 'shuffle': False}),
+    ('blosc_lz4_5_bigchunks', {'complib': 'blosc:lz4', 'complevel': 5,
+        'chunkshape': 16384, 'pixels_chunkshape': 1048576}),
+    ]
+
+def run_hdf5_storage_benchmark(whiskers_directory, 
+    test_root='~/whiski_wrap_test', settings=None, measure=False,
+    pixel_layout='flat', n_parse_processes=4, force=False):
+    """Compare HDF5 compression and chunk shape settings on a session
+    
+    The whiskers files in whiskers_directory are stitched into a new HDF5
+    file for each setting with rebuild_hdf5_from_whiskers_directory, and
+    then the summary and every pixel are read back.
+    
+    whiskers_directory : a session directory that has been traced
+    test_root : directory to write the HDF5 files into
+    settings : list of (name, kwargs to pass to setup_hdf5)
+        Default: HDF5_STORAGE_SETTINGS
+    measure, pixel_layout, n_parse_processes : passed to 
+        rebuild_hdf5_from_whiskers_directory
+    force : if True, does not ask permission to use test_root
+    
+    The read times are usually from the OS cache, so they measure 
+    decompression more than I/O. The file size is what determines the 
+    I/O time over a network.
+    
+    Returns: DataFrame with one row per setting
+        write_s, read_s : duration of stitching and reading
+        write_MBps, read_MBps : uncompressed megabytes per second
+        size_MB, ratio : file size, and uncompressed size over file size
+    """
+    if settings is None:
+        settings = HDF5_STORAGE_SETTINGS
+    whiskers_directory = os.path.abspath(os.path.expanduser(
+        whiskers_directory))
+    
+    # Set up test root
+    test_root = normalize_path_and_optionally_get_permission(test_root,
+        force=force)
+    if not os.path.exists(test_root):
+        os.mkdir(test_root)
+    
+    rec_l = []
+    for name, hdf5_kwargs in settings:
+        print name
+        h5_filename = os.path.join(test_root, 'storage_%s.hdf5' % name)
+        
+        # Write
+        start_time = time.time()
+        WhiskiWrap.rebuild_hdf5_from_whiskers_directory(whiskers_directory,
+            h5_filename, measure=measure, pixel_layout=pixel_layout, 
+            n_parse_processes=n_parse_processes, hdf5_kwargs=hdf5_kwargs)
+        write_duration = time.time() - start_time
+        
+        # Read everything back
+        start_time = time.time()
+        with tables.open_file(h5_filename) as fi:
+            summary = fi.root.summary.read()
+        pixels_x, pixels_y = WhiskiWrap.read_pixels(h5_filename)
+        read_duration = time.time() - start_time
+        
+        # Size of the data without compression
+        data_MB = (summary.nbytes + 
+            4 * 2 * np.sum([len(pixels) for pixels in pixels_x])) / 1e6
+        size_MB = os.path.getsize(h5_filename) / 1e6
+        
+        rec_l.append({'name': name, 'n_rows': len(summary),
+            'write_s': write_duration, 'read_s': read_duration,
+            'write_MBps': data_MB / write_duration,
+            'read_MBps': data_MB / read_duration,
+            'size_MB': size_MB, 'ratio': data_MB / size_MB})
+    
+    return pandas.DataFrame.from_records(rec_l, columns=['name', 'n_rows',
+        'write_s', 'read_s', 'write_MBps', 'read_MBps', 'size_MB', 'ratio'])
+
 def get_permission_for_test_root(test_root):
     """Ask for permission to run in test_root"""
     response = raw_input('Run tests in %s? [y/N]: ' % test_root)
@@ -24,6 +24,7 @@ class FileNamer(object):
         fn.whiskers
         fn.tiff_stack
         fn.video(type='mp4')
+        fn.frame_index
     """
     def __init__(self, basename):
         """Initialize based on full path and filename (without extension)."""
@@ -82,6 +83,11 @@ class FileNamer(object):
         """Return the name for the hdf5 file"""
         return self.basename + '.hdf5'
 
+    @property
+    def frame_index(self):
+        """Return the name for the frame index sidecar of a video"""
+        return self.basename + '.frameindex.npz'
+
 
 def probe_command_availability(cmd):
     """Try to run 'cmd' in a subprocess and return availability.
@@ -2,6 +2,15 @@
 
 process_chunks_of_video : used in this module to load an input video with
     ffmpeg and dump tiff stacks to disk of each chunk.
+probe_packets : list the presentation times and keyframes of a video
+    with ffprobe.
+FrameIndex : exact frame count, frame times and keyframes of a video,
+    stored in a sidecar file so that it is only probed once.
+probe_video_metadata, get_video_params_cached : frame size, frame rate 
+    and duration of a video, probed once per version of each file and
+    cached in memory and optionally on disk.
+detect_whisker_roi : choose a crop rectangle containing the moving parts
+    of the video, to be applied by ffmpeg while decoding.
 """
 import os
 import numpy as np
@@ -9,7 +18,427 @@ import subprocess
 import pandas
 import re
 import datetime
-from my.video import get_video_params
+import json
+import hashlib
+from WhiskiWrap.utils import FileNamer
+
+# Cache of probe_video_metadata results, keyed by path, size and mtime
+_METADATA_CACHE = {}
+
+# If not None, the cache is also kept in this JSON file, so that it 
+# persists across sessions and processes
+METADATA_CACHE_FILENAME = None
+
+# Where FrameIndex.load_or_build keeps the index of a video whose own
+# directory cannot be written to, or None to keep it only in memory
+FRAME_INDEX_CACHE_DIRECTORY = os.path.join(os.path.expanduser('~'), 
+    '.cache', 'WhiskiWrap', 'frame_index')
+
+def _metadata_cache_key(filename):
+    """Returns a key that changes whenever filename changes"""
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    return '%s|%d|%r' % (filename, stat.st_size, stat.st_mtime)
+
+def _load_metadata_cache_file(cache_filename):
+    """Add the contents of cache_filename to the in-memory cache"""
+    if cache_filename is None or not os.path.exists(cache_filename):
+        return
+    try:
+        with open(cache_filename) as fi:
+            _METADATA_CACHE.update(json.load(fi))
+    except ValueError:
+        print "warning: ignoring corrupt metadata cache %s" % cache_filename
+
+def _save_metadata_cache_file(cache_filename):
+    """Write the in-memory cache to cache_filename"""
+    # Write to a temporary file first so that readers never see
+    # a partial file
+    temp_filename = '%s.%d.tmp' % (cache_filename, os.getpid())
+    with open(temp_filename, 'w') as fi:
+        json.dump(_METADATA_CACHE, fi)
+    os.rename(temp_filename, cache_filename)
+
+def _parse_frame_rate(rate_string):
+    """Convert an ffprobe rate like '30000/1001' to a float, or None"""
+    numerator, denominator = rate_string.split('/')
+    if float(denominator) == 0 or float(numerator) == 0:
+        return None
+    return float(numerator) / float(denominator)
+
+def probe_video_metadata(filename, cache_filename=None):
+    """Returns the frame size, frame rate, and duration of a video
+    
+    Everything is read with a single call to ffprobe. The result is 
+    cached in memory, keyed by the path, size and mtime of the file, so 
+    repeated calls on the same unchanged file do not call ffprobe again.
+    
+    cache_filename : JSON file to also keep the cache in, so that it 
+        persists across processes. If None, METADATA_CACHE_FILENAME is 
+        used, which is None (in memory only) by default.
+    
+    Returns: dict with keys 'width', 'height', 'frame_rate', 'duration'
+    """
+    if cache_filename is None:
+        cache_filename = METADATA_CACHE_FILENAME
+    
+    # Check the cache
+    key = _metadata_cache_key(filename)
+    if key not in _METADATA_CACHE:
+        _load_metadata_cache_file(cache_filename)
+    if key in _METADATA_CACHE:
+        return dict(_METADATA_CACHE[key])
+    
+    # Probe
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 
+        'stream=width,height,avg_frame_rate,r_frame_rate:format=duration',
+        '-of', 'json', filename]
+    pipe = subprocess.Popen(command, 
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = pipe.communicate()
+    if pipe.returncode != 0:
+        raise IOError("ffprobe failed on %s: %s" % (filename, stderr))
+    probed = json.loads(stdout)
+    if len(probed.get('streams', [])) == 0:
+        raise ValueError("no video stream found in %s" % filename)
+    stream = probed['streams'][0]
+    
+    # Like ffmpeg, use the average frame rate when it is known
+    frame_rate = _parse_frame_rate(stream['avg_frame_rate'])
+    if frame_rate is None:
+        frame_rate = _parse_frame_rate(stream['r_frame_rate'])
+    
+    metadata = {
+        'width': int(stream['width']),
+        'height': int(stream['height']),
+        'frame_rate': frame_rate,
+        'duration': float(probed['format']['duration']),
+        }
+    
+    # Store
+    _METADATA_CACHE[key] = metadata
+    if cache_filename is not None:
+        _save_metadata_cache_file(cache_filename)
+    
+    return dict(metadata)
+
+def get_video_params_cached(filename, cache_filename=None):
+    """Like my.video.get_video_params, but using probe_video_metadata
+    
+    Returns: width, height, frame_rate
+    """
+    metadata = probe_video_metadata(filename, cache_filename=cache_filename)
+    return metadata['width'], metadata['height'], metadata['frame_rate']
+
+def get_video_duration_cached(filename, cache_filename=None):
+    """Like my.video.get_video_duration2, but using probe_video_metadata"""
+    return probe_video_metadata(filename, 
+        cache_filename=cache_filename)['duration']
+
+def crop_filter_args(crop, pix_fmt='gray'):
+    """Returns ffmpeg arguments that crop each frame while decoding
+    
+    crop : (x, y, width, height) of the region to keep, in pixels from
+        the top left corner of the frame
+    pix_fmt : the output pixel format. The frames are converted to this
+        format before cropping, so that x and y need not be multiples of 
+        the chroma subsampling of the input.
+    """
+    x, y, width, height = crop
+    return ['-vf', 'format=%s,crop=%d:%d:%d:%d' % (
+        pix_fmt, width, height, x, y)]
+
+def detect_whisker_roi(filename, n_blocks=10, frames_per_block=20,
+    noise_factor=3, min_fraction=0.01, padding=20, frame_index=None,
+    verbose=False):
+    """Choose a crop rectangle around the moving parts of a video
+    
+    Whiskers move, while most of the background does not, so the pixels
+    with temporal variability mark the region that needs to be traced.
+    Short blocks of frames are sampled evenly from the whole video, the 
+    standard deviation of each pixel is computed over all of them, and 
+    the bounding box of every pixel that varies clearly more than the 
+    typical pixel is returned.
+    
+    This is deliberately conservative: anything else that moves, such as
+    a stimulus, is kept too. Faint whiskers vary much less than large 
+    high-contrast objects, so only keeping the most variable pixels 
+    would crop them out.
+    
+    n_blocks, frames_per_block : how to sample the video
+    noise_factor : pixels whose standard deviation is more than this
+        many times the median standard deviation (the noise of a static
+        pixel) are considered to be moving
+    min_fraction : rows and columns containing fewer than this fraction
+        of the moving pixels of the busiest row or column are ignored,
+        so that isolated noisy pixels do not stretch the box
+    padding : pixels to add on each side of the box, to leave room for
+        the follicles and for whiskers moving more than in the sample
+    frame_index : FrameIndex of the video, used for exact seeks
+        If None, loaded or built from the sidecar file.
+    
+    Returns: (x, y, width, height), with even width and height, suitable
+        for the `crop` argument of FFmpegReader.
+    """
+    if frame_index is None:
+        frame_index = FrameIndex.load_or_build(filename)
+    image_w, image_h, frame_rate = get_video_params_cached(filename)
+    
+    # Sample blocks of frames evenly over the video
+    n_frames = frame_index.n_frames
+    frames_per_block = min(frames_per_block, n_frames)
+    block_starts = np.unique(np.linspace(
+        0, n_frames - frames_per_block, n_blocks).astype(np.int))
+    
+    # Accumulate the mean and variance of each pixel
+    pixel_sum = np.zeros((image_h, image_w), dtype=np.float64)
+    pixel_sum_sq = np.zeros((image_h, image_w), dtype=np.float64)
+    n_sampled = 0
+    for block_start in block_starts:
+        if verbose:
+            print "sampling frames starting with %d" % block_start
+        frames = process_chunks_of_video(filename, 
+            frame_start=block_start, 
+            frame_stop=block_start + frames_per_block,
+            frames_per_chunk=frames_per_block, frame_index=frame_index,
+            image_w=image_w, image_h=image_h, frame_rate=frame_rate,
+            finalize='concatenate').astype(np.float64)
+        pixel_sum += frames.sum(axis=0)
+        pixel_sum_sq += (frames ** 2).sum(axis=0)
+        n_sampled += len(frames)
+    pixel_mean = pixel_sum / n_sampled
+    pixel_std = np.sqrt(np.maximum(
+        pixel_sum_sq / n_sampled - pixel_mean ** 2, 0))
+    
+    # Bounding box of the pixels that vary more than noise
+    moving = pixel_std > noise_factor * np.median(pixel_std)
+    moving_per_row = moving.sum(axis=1)
+    moving_per_col = moving.sum(axis=0)
+    if moving_per_row.max() == 0:
+        # Nothing moves, keep the whole frame
+        return (0, 0, image_w - image_w % 2, image_h - image_h % 2)
+    rows = np.where(moving_per_row >= min_fraction * moving_per_row.max())[0]
+    cols = np.where(moving_per_col >= min_fraction * moving_per_col.max())[0]
+    
+    # Pad and clip to the frame
+    x0 = max(cols[0] - padding, 0)
+    x1 = min(cols[-1] + 1 + padding, image_w)
+    y0 = max(rows[0] - padding, 0)
+    y1 = min(rows[-1] + 1 + padding, image_h)
+    
+    # Even sizes, which encoders like libx264 require
+    width = (x1 - x0) - (x1 - x0) % 2
+    height = (y1 - y0) - (y1 - y0) % 2
+    
+    return (int(x0), int(y0), int(width), int(height))
+
+def readinto_array(fileobj, array):
+    """Fill a contiguous array with bytes read from fileobj
+    
+    The bytes are read directly into the array's memory using readinto,
+    without allocating any intermediate strings. Reading continues until
+    the array is full or fileobj is exhausted.
+    
+    Returns: the number of bytes read, which is less than array.nbytes
+        only if fileobj ran out of data.
+    """
+    view = memoryview(array.reshape(-1).view(np.uint8))
+    n_bytes = 0
+    while n_bytes < len(view):
+        n_new_bytes = fileobj.readinto(view[n_bytes:])
+        if not n_new_bytes:
+            break
+        n_bytes += n_new_bytes
+    return n_bytes
+
+def probe_packets(filename):
+    """Returns the presentation time and keyframe flag of every frame
+    
+    Uses ffprobe to list the packets of the first video stream. The
+    packets are sorted by presentation time, so that entry N corresponds
+    to frame N of the decoded video. Packets without a presentation time
+    are skipped.
+    
+    Returns: pts_times, is_keyframe
+        pts_times : float array of presentation times in seconds
+        is_keyframe : bool array, True for frames that are keyframes
+    """
+    command = ['ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=print_section=0', filename]
+    pipe = subprocess.Popen(command, 
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = pipe.communicate()
+    if pipe.returncode != 0:
+        raise IOError("ffprobe failed on %s: %s" % (filename, stderr))
+    
+    # Each line is pts_time,flags
+    pts_times = []
+    is_keyframe = []
+    for line in stdout.splitlines():
+        fields = line.strip().split(',')
+        if len(fields) < 2 or fields[0] == 'N/A':
+            continue
+        pts_times.append(float(fields[0]))
+        is_keyframe.append('K' in fields[1])
+    pts_times = np.array(pts_times, dtype=np.float64)
+    is_keyframe = np.array(is_keyframe, dtype=np.bool)
+    
+    # Sort from decode order into presentation order
+    ordering = np.argsort(pts_times, kind='mergesort')
+    return pts_times[ordering], is_keyframe[ordering]
+
+def get_keyframe_frame_numbers(filename):
+    """Returns the frame number of every keyframe in the video"""
+    pts_times, is_keyframe = probe_packets(filename)
+    return np.where(is_keyframe)[0]
+
+class FrameIndex(object):
+    """Exact index of the frames and keyframes in a video file
+    
+    The index is built once with probe_packets and saved next to the
+    video in a sidecar file named by FileNamer.frame_index, or in 
+    FRAME_INDEX_CACHE_DIRECTORY if the directory of the video cannot be
+    written to. It records the size and modification time of the video,
+    so that it is rebuilt if the video changes.
+    
+    Typical use:
+        frame_index = FrameIndex.load_or_build('session.mp4')
+        frame_index.n_frames
+        frame_index.seek_time(1000)
+    
+    Frame numbers are positions in presentation order, counting from zero
+    at the start of the video. Everything is an array lookup, so seeking
+    does not depend on rounding frame numbers into times.
+    """
+    def __init__(self, pts_times, is_keyframe, video_size=None, 
+        video_mtime=None):
+        """Initialize from the arrays returned by probe_packets
+        
+        video_size, video_mtime : the video file these were probed from,
+            used to check whether a saved index is still valid.
+        """
+        self.pts_times = np.asarray(pts_times, dtype=np.float64)
+        self.is_keyframe = np.asarray(is_keyframe, dtype=np.bool)
+        self.video_size = video_size
+        self.video_mtime = video_mtime
+        self.keyframes = np.where(self.is_keyframe)[0]
+    
+    @property
+    def n_frames(self):
+        """The exact number of frames in the video"""
+        return len(self.pts_times)
+    
+    def frame_time(self, frame_number):
+        """Time of frame_number, in seconds from the first frame"""
+        return self.pts_times[frame_number] - self.pts_times[0]
+    
+    def seek_time(self, frame_number):
+        """Time to pass to ffmpeg -ss so that frame_number comes first
+        
+        This is halfway between the previous frame and frame_number, so
+        it cannot round onto the wrong frame. Returns 0 for the first 
+        frame.
+        """
+        if frame_number == 0:
+            return 0.
+        return (self.frame_time(frame_number - 1) + 
+            self.frame_time(frame_number)) / 2.
+    
+    def keyframe_before(self, frame_number):
+        """The last keyframe at or before frame_number"""
+        idx = np.searchsorted(self.keyframes, frame_number, side='right')
+        return self.keyframes[max(idx - 1, 0)]
+    
+    def save(self, filename):
+        """Save the index as an npz file"""
+        # Write to a temporary file first, so a partial index is never
+        # mistaken for a valid one
+        temp_filename = filename + '.tmp.npz'
+        np.savez(temp_filename, pts_times=self.pts_times,
+            is_keyframe=self.is_keyframe,
+            video_size=np.int64(-1 if self.video_size is None 
+                else self.video_size),
+            video_mtime=np.float64(np.nan if self.video_mtime is None 
+                else self.video_mtime))
+        os.rename(temp_filename, filename)
+    
+    @classmethod
+    def load(cls, filename):
+        """Load an index saved by save"""
+        data = np.load(filename)
+        video_size = int(data['video_size'])
+        video_mtime = float(data['video_mtime'])
+        return cls(data['pts_times'], data['is_keyframe'],
+            video_size=None if video_size < 0 else video_size,
+            video_mtime=None if np.isnan(video_mtime) else video_mtime)
+    
+    @classmethod
+    def build(cls, video_filename):
+        """Probe video_filename and return its index"""
+        stat = os.stat(video_filename)
+        pts_times, is_keyframe = probe_packets(video_filename)
+        return cls(pts_times, is_keyframe, 
+            video_size=stat.st_size, video_mtime=stat.st_mtime)
+    
+    def matches(self, video_filename):
+        """True if video_filename has the size and mtime of this index"""
+        stat = os.stat(video_filename)
+        return (self.video_size == stat.st_size and 
+            self.video_mtime == stat.st_mtime)
+    
+    @classmethod
+    def load_or_build(cls, video_filename, index_filename=None):
+        """Load the sidecar index of video_filename, building it if needed
+        
+        index_filename : where to store the index
+            If None, uses FileNamer.frame_index, or a file in 
+            FRAME_INDEX_CACHE_DIRECTORY if that cannot be written.
+        
+        The index is rebuilt and saved if the sidecar does not exist or
+        was made from a different version of the video. If it cannot be
+        saved anywhere, it is only kept in memory, with a warning.
+        """
+        if index_filename is None:
+            index_filenames = [
+                FileNamer.from_video(video_filename).frame_index]
+            if FRAME_INDEX_CACHE_DIRECTORY is not None:
+                index_filenames.append(cls.cache_filename(video_filename))
+        else:
+            index_filenames = [index_filename]
+        
+        for filename in index_filenames:
+            if os.path.exists(filename):
+                frame_index = cls.load(filename)
+                if frame_index.matches(video_filename):
+                    return frame_index
+        
+        frame_index = cls.build(video_filename)
+        for filename in index_filenames:
+            try:
+                directory = os.path.dirname(filename)
+                if directory != '' and not os.path.exists(directory):
+                    os.makedirs(directory)
+                frame_index.save(filename)
+            except (IOError, OSError) as error:
+                save_error = error
+            else:
+                break
+        else:
+            print "warning: keeping the frame index of %s in memory only, "\
+                "because it cannot be saved: %s" % (video_filename, save_error)
+        return frame_index
+    
+    @staticmethod
+    def cache_filename(video_filename):
+        """The index file of video_filename in FRAME_INDEX_CACHE_DIRECTORY
+        
+        This is named by a hash of the absolute path of the video.
+        """
+        path_hash = hashlib.sha1(os.path.abspath(video_filename)).hexdigest()
+        return os.path.join(FRAME_INDEX_CACHE_DIRECTORY, 
+            path_hash + '.frameindex.npz')
 
 def process_chunks_of_video(filename, 
     frame_start=None, frame_stop=None, n_frames=None, frame_rate=None,
@@ -17,7 +446,7 @@ def process_chunks_of_video(filename,
     image_w=None, image_h=None,
     verbose=False,
     frames_per_chunk=1000, bufsize=10**9,
-    pix_fmt='gray', finalize='list'):
+    pix_fmt='gray', finalize='list', frame_index=None, crop=None):
     """Read frames from video, apply function, return result
     
     This has some advantage over my.video.process_chunks_of_video
@@ -39,7 +468,7 @@ def process_chunks_of_video(filename,
         If frame_stop is None: defaults to frame_start + n_frames
         If frame_stop and n_frames are both None: processes the entire video
     frame_rate : used to convert frame_start etc. to times, as required by
-        ffmpeg. If None, it will be inferred from ffprobe
+        ffmpeg. If None, it will be inferred from ffprobe (cached)
     frame_func : function to apply to each frame
         If None, nothing is applied. This obviously requires a lot of memory.
     chunk_func : function to apply to each chunk
@@ -58,6 +487,13 @@ def process_chunks_of_video(filename,
         'listcomp' : uses a list comprehension to collapse over the chunks,
             so the result is a list of length equal to the total number of
             frames processed
+    frame_index : FrameIndex of the video, or None
+        If provided, the start time is taken from the index instead of
+        from frame_start and frame_rate, and frame_stop is truncated to
+        the number of frames in the video.
+    crop : (x, y, width, height) to crop each frame to while decoding,
+        as in crop_filter_args, or None. image_w and image_h are then
+        taken from the crop.
     
     This function has been modified from my.video to be optimized for
     processing chunks rather than entire videos.
@@ -65,10 +501,15 @@ def process_chunks_of_video(filename,
     Returns: result, as described above
     """
     # Get aspect
-    if image_w is None or image_h is None:
-        image_w, image_h, junk = get_video_params(filename)
-    if frame_rate is None:
-        frame_rate = get_video_params(filename)[2]
+    if image_w is None or image_h is None or frame_rate is None:
+        probed_w, probed_h, probed_frame_rate = get_video_params_cached(
+            filename)
+        if image_w is None or image_h is None:
+            image_w, image_h = probed_w, probed_h
+        if frame_rate is None:
+            frame_rate = probed_frame_rate
+    if crop is not None:
+        image_w, image_h = crop[2], crop[3]
     
     # Frame range defaults
     if frame_start is None:
@@ -79,6 +520,10 @@ def process_chunks_of_video(filename,
             n_frames = np.inf
         else:
             frame_stop = n_frames - frame_start
+    if frame_index is not None and frame_stop > frame_index.n_frames:
+        print "warning: only %d frames in video" % frame_index.n_frames
+        frame_stop = frame_index.n_frames
+        n_frames = None
     if n_frames is None:
         n_frames = frame_stop - frame_start
     assert n_frames == frame_stop - frame_start
@@ -99,14 +544,21 @@ def process_chunks_of_video(filename,
     # ffmpeg requires start time and total time to be in seconds, not frames
     # It seems to round up .. if I want start_time to be 0.0 and I set it to
     # 0.003 (1/10th of a frame), then the first frame is skipped.
-    start_frame_time = (frame_start - 0.1) / float(frame_rate)
+    if frame_index is not None:
+        # Exact, from the index
+        start_frame_time = frame_index.seek_time(frame_start)
+    else:
+        start_frame_time = (frame_start - 0.1) / float(frame_rate)
     total_time = (n_frames + 0.2) / float(frame_rate)
     
     # Create the command
     command = ['ffmpeg', 
         '-ss', '%0.4f' % start_frame_time,
         '-i', filename,
-        '-t', '%0.4f' % total_time,
+        '-t', '%0.4f' % total_time]
+    if crop is not None:
+        command += crop_filter_args(crop, pix_fmt)
+    command += [
         '-f', 'image2pipe',
         '-pix_fmt', pix_fmt,
         '-vcodec', 'rawvideo', '-']
@@ -136,23 +588,18 @@ def process_chunks_of_video(filename,
                 this_chunk = frames_per_chunk
             
             # Read this_chunk, or as much as we can
-            raw_image = pipe.stdout.read(read_size_per_frame * this_chunk)
+            # This reads straight into the array, without an intermediate
+            # string or a copy
+            video = np.empty((this_chunk,) + reshape_size, dtype=np.uint8)
+            n_bytes = readinto_array(pipe.stdout, video)
             
             # check if we ran out of frames
-            if len(raw_image) < read_size_per_frame * this_chunk:
+            if n_bytes < read_size_per_frame * this_chunk:
                 print "warning: ran out of frames"
                 out_of_frames = True
-                this_chunk = len(raw_image) / read_size_per_frame
-                assert this_chunk * read_size_per_frame == len(raw_image)
-            
-            # Process
-            flattened_im = np.fromstring(raw_image, dtype='uint8')
-            if bytes_per_pixel == 1:
-                video = flattened_im.reshape(
-                    (this_chunk, image_h, image_w))
-            else:
-                video = flattened_im.reshape(
-                    (this_chunk, image_h, image_w, bytes_per_pixel))
+                this_chunk = n_bytes / read_size_per_frame
+                assert this_chunk * read_size_per_frame == n_bytes
+                video = video[:this_chunk]
             
             # Apply the frame_func to each frame
             # We make it an array again, but note this can lead to 
@@ -0,0 +1,287 @@
+"""Reading whisk output files with numpy, without the whisk library
+
+read_whiskers : parse a .whiskers file in the binary format written by
+    trace ("whiskbin1") into a WhiskerSegments.
+WhiskerSegments : the segments of a .whiskers file as flat arrays, one
+    entry per segment plus the concatenated pixels of every segment.
+read_measurements : parse a .measurements file in the binary format
+    written by measure ("measv3") into a structured array.
+join_measurements : match measurements to whisker segments by frame and
+    whisker id.
+FormatError : raised for files in some other format, which whisk itself
+    may still be able to read. Truncated files raise a plain IOError.
+
+The whiskbin1 format is a 12-byte header, then each segment as
+    int32 id, int32 time, int32 len,
+    float32 x[len], float32 y[len], float32 thick[len], float32 scores[len]
+and finally the number of segments as int32, all little-endian.
+
+The measv3 format is an 8-byte header, int32 n_rows, int32 n_measures,
+and then each row as
+    int32 row, fid, wid, state, face_x, face_y, col_follicle_x,
+        col_follicle_y, valid_velocity, n; char face_axis;
+    float64 data[n], float64 velocity[n]
+all little-endian and unaligned, in reverse order of row. The first 8
+entries of data are MEASUREMENT_COLUMNS.
+"""
+import struct
+import numpy as np
+
+WHISKBIN1_HEADER = 'bwhiskbin1\0\0'
+MEASV3_HEADER = 'measv3\0\0'
+
+# The measurements made by measure, in order
+MEASUREMENT_COLUMNS = ['length', 'score', 'angle', 'curvature', 
+    'fol_x', 'fol_y', 'tip_x', 'tip_y']
+
+# What read_measurements returns
+# fid is the frame, and wid is the whisker id, as in the whiskers file
+MEASUREMENTS_DTYPE = np.dtype([('fid', np.int32), ('wid', np.int32),
+    ('state', np.int32)] + 
+    [(column, np.float64) for column in MEASUREMENT_COLUMNS])
+
+class FormatError(IOError):
+    """The file is not in the binary format that this module reads"""
+    pass
+
+class WhiskerSegments(object):
+    """The whisker segments of one .whiskers file, stored as flat arrays
+
+    Segment i was found in frame time[i] with whisker id id[i], and has
+    pixlen[i] pixels. Its pixels are
+        x[offsets[i]:offsets[i] + pixlen[i]]
+    and likewise for y, thick and scores.
+
+    Segments are sorted by time and then id, which is the order in which
+    trace writes them, and the order of iterating over the dict returned
+    by whisk's Load_Whiskers.
+    """
+    def __init__(self, time, id, pixlen, x, y, thick=None, scores=None):
+        """Initialize from arrays, as described above
+
+        thick and scores can be None, if they are not available.
+        """
+        self.time = np.asarray(time, dtype=np.int32)
+        self.id = np.asarray(id, dtype=np.int32)
+        self.pixlen = np.asarray(pixlen, dtype=np.int64)
+        self.offsets = np.cumsum(self.pixlen) - self.pixlen
+        self.x = np.asarray(x, dtype=np.float32)
+        self.y = np.asarray(y, dtype=np.float32)
+        self.thick = thick
+        self.scores = scores
+
+        if len(self.x) != self.pixlen.sum() or len(self.y) != len(self.x):
+            raise ValueError("pixels do not match pixlen")
+
+    def __len__(self):
+        return len(self.time)
+
+    def segment_pixels(self, idx):
+        """Returns the x and y coordinates of segment idx"""
+        start = self.offsets[idx]
+        stop = start + self.pixlen[idx]
+        return self.x[start:stop], self.y[start:stop]
+
+    def sort(self):
+        """Sort the segments by time and then id, in place"""
+        ordering = np.lexsort((self.id, self.time))
+        if np.all(ordering == np.arange(len(ordering))):
+            return
+
+        # Gather the pixels of each segment in the new order
+        pixel_idxs = _ranges_to_indices(self.offsets[ordering],
+            self.pixlen[ordering])
+        for attr in ['x', 'y', 'thick', 'scores']:
+            if getattr(self, attr) is not None:
+                setattr(self, attr, getattr(self, attr)[pixel_idxs])
+        self.time = self.time[ordering]
+        self.id = self.id[ordering]
+        self.pixlen = self.pixlen[ordering]
+        self.offsets = np.cumsum(self.pixlen) - self.pixlen
+
+    @classmethod
+    def from_whisk_dict(cls, whiskers):
+        """Convert the dict returned by whisk's trace.Load_Whiskers"""
+        segs = [wseg for frame_whiskers in whiskers.itervalues()
+            for wseg in frame_whiskers.itervalues()]
+        if len(segs) == 0:
+            return cls([], [], [], [], [])
+        segments = cls(
+            time=[wseg.time for wseg in segs],
+            id=[wseg.id for wseg in segs],
+            pixlen=[len(wseg.x) for wseg in segs],
+            x=np.concatenate([wseg.x for wseg in segs]),
+            y=np.concatenate([wseg.y for wseg in segs]),
+            )
+        segments.sort()
+        return segments
+
+def _ranges_to_indices(starts, lengths):
+    """Returns the concatenation of arange(start, start + length)"""
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if len(lengths) == 0:
+        return np.array([], dtype=np.int64)
+    range_offsets = np.cumsum(lengths) - lengths
+    return (np.repeat(np.asarray(starts, dtype=np.int64) - range_offsets,
+        lengths) + np.arange(lengths.sum()))
+
+def read_whiskers(filename):
+    """Read a .whiskers file in the whiskbin1 format into WhiskerSegments
+
+    Only the segment headers are read one at a time. The pixels are then
+    gathered into flat arrays all at once.
+
+    Raises FormatError if the file is not in the whiskbin1 format, for
+    instance because it was written in one of whisk's text formats, or
+    IOError if it is truncated.
+    """
+    with open(filename, 'rb') as fi:
+        data = fi.read()
+
+    if not data.startswith(WHISKBIN1_HEADER):
+        raise FormatError("%s is not a whiskbin1 file" % filename)
+
+    # Every field is 4 bytes, so view everything after the header as words
+    n_words = (len(data) - len(WHISKBIN1_HEADER)) // 4
+    if n_words < 1:
+        raise IOError("%s is truncated" % filename)
+    words = np.frombuffer(data, dtype='<i4', count=n_words,
+        offset=len(WHISKBIN1_HEADER))
+    floats = words.view('<f4')
+
+    # Walk the segment headers to find where each segment is
+    # The last word is the number of segments, used as a check
+    header_positions = []
+    pixlens = []
+    position = 0
+    while position < n_words - 1:
+        pixlen = struct.unpack_from('<i', data,
+            len(WHISKBIN1_HEADER) + 4 * (position + 2))[0]
+        if pixlen < 0 or position + 3 + 4 * pixlen > n_words - 1:
+            raise IOError("%s is truncated" % filename)
+        header_positions.append(position)
+        pixlens.append(pixlen)
+        position += 3 + 4 * pixlen
+    if len(header_positions) != words[-1]:
+        raise IOError("%s does not contain %d segments" % (
+            filename, words[-1]))
+    header_positions = np.array(header_positions, dtype=np.int64)
+    pixlen = np.array(pixlens, dtype=np.int64)
+
+    # Gather the pixels, which follow each header as x, y, thick, scores
+    x_idxs = _ranges_to_indices(header_positions + 3, pixlen)
+    pixlen_of_pixel = np.repeat(pixlen, pixlen)
+
+    segments = WhiskerSegments(
+        time=words[header_positions + 1],
+        id=words[header_positions],
+        pixlen=pixlen,
+        x=floats[x_idxs],
+        y=floats[x_idxs + pixlen_of_pixel],
+        thick=floats[x_idxs + 2 * pixlen_of_pixel],
+        scores=floats[x_idxs + 3 * pixlen_of_pixel],
+        )
+    segments.sort()
+    return segments
+
+def read_measurements(filename):
+    """Read a .measurements file in the measv3 format
+    
+    The rows are read all at once as a structured array, which requires
+    every row to have the same number of measurements, as measure writes.
+    
+    Raises FormatError if the file is not in the measv3 format, or has 
+    rows of different lengths, or IOError if it is truncated.
+    
+    Returns: array of MEASUREMENTS_DTYPE, sorted by fid and then wid
+    """
+    with open(filename, 'rb') as fi:
+        data = fi.read()
+
+    if not data.startswith(MEASV3_HEADER):
+        raise FormatError("%s is not a measv3 file" % filename)
+    if len(data) < len(MEASV3_HEADER) + 8:
+        raise IOError("%s is truncated" % filename)
+    n_rows, n_measures = struct.unpack_from('<ii', data, 
+        len(MEASV3_HEADER))
+    if n_measures < len(MEASUREMENT_COLUMNS):
+        raise FormatError("%s has %d measurements instead of %d" % (
+            filename, n_measures, len(MEASUREMENT_COLUMNS)))
+    
+    # The layout of each row on disk
+    row_dtype = np.dtype([(name, '<i4') for name in ['row', 'fid', 'wid',
+        'state', 'face_x', 'face_y', 'col_follicle_x', 'col_follicle_y', 
+        'valid_velocity', 'n']] + [('face_axis', 'S1'), 
+        ('data', '<f8', (n_measures,)), ('velocity', '<f8', (n_measures,))])
+    if len(data) != len(MEASV3_HEADER) + 8 + n_rows * row_dtype.itemsize:
+        raise IOError("%s is truncated or has rows of different lengths" %
+            filename)
+    rows = np.frombuffer(data, dtype=row_dtype, count=n_rows,
+        offset=len(MEASV3_HEADER) + 8)
+    if np.any(rows['n'] != n_measures):
+        raise FormatError("%s has rows of different lengths" % filename)
+    
+    measurements = np.zeros(n_rows, dtype=MEASUREMENTS_DTYPE)
+    for name in ['fid', 'wid', 'state']:
+        measurements[name] = rows[name]
+    for n_column, column in enumerate(MEASUREMENT_COLUMNS):
+        measurements[column] = rows['data'][:, n_column]
+    
+    return measurements[np.lexsort((measurements['wid'], 
+        measurements['fid']))]
+
+def measurements_from_table_array(table_array):
+    """Convert the array from whisk's MeasurementsTable.asarray()
+    
+    Its columns are state, fid, wid, and then MEASUREMENT_COLUMNS.
+    
+    Returns: array of MEASUREMENTS_DTYPE, sorted by fid and then wid
+    """
+    table_array = np.asarray(table_array)
+    measurements = np.zeros(len(table_array), dtype=MEASUREMENTS_DTYPE)
+    if len(table_array) == 0:
+        return measurements
+    measurements['state'] = table_array[:, 0]
+    measurements['fid'] = table_array[:, 1]
+    measurements['wid'] = table_array[:, 2]
+    for n_column, column in enumerate(MEASUREMENT_COLUMNS):
+        measurements[column] = table_array[:, 3 + n_column]
+    
+    return measurements[np.lexsort((measurements['wid'], 
+        measurements['fid']))]
+
+def join_measurements(segments, measurements):
+    """Find the measurements of each whisker segment
+    
+    segments : WhiskerSegments
+    measurements : array of MEASUREMENTS_DTYPE
+    
+    Each segment is matched to the measurement with the same frame
+    (time == fid) and whisker id (id == wid).
+    
+    Raises ValueError if any segment has no measurement.
+    
+    Returns: array of MEASUREMENTS_DTYPE, one row for each segment
+    """
+    # Combine frame and whisker id into a single sortable key
+    segment_keys = ((segments.time.astype(np.int64) << 32) | 
+        segments.id.astype(np.int64))
+    measurement_keys = ((measurements['fid'].astype(np.int64) << 32) | 
+        measurements['wid'].astype(np.int64))
+    
+    ordering = np.argsort(measurement_keys, kind='mergesort')
+    sorted_keys = measurement_keys[ordering]
+    idxs = np.searchsorted(sorted_keys, segment_keys)
+    idxs = np.clip(idxs, 0, max(len(sorted_keys) - 1, 0))
+    
+    if len(sorted_keys) == 0:
+        matched = np.zeros(len(segment_keys), dtype=bool)
+    else:
+        matched = sorted_keys[idxs] == segment_keys
+    if not np.all(matched):
+        n_missing = np.sum(~matched)
+        raise ValueError("%d whisker segments have no measurements, "
+            "e.g. frame %d whisker %d" % (n_missing, 
+            segments.time[~matched][0], segments.id[~matched][0]))
+    
+    return measurements[ordering[idxs]]